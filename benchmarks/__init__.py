@@ -0,0 +1 @@
+"""Performance benchmarks. These are not run as part of the test suite."""
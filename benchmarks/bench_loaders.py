@@ -0,0 +1,70 @@
+"""Compare load time per MB of the available config file loaders.
+
+Run with: python -m benchmarks.bench_loaders [target size in MB]
+"""
+import json
+import sys
+import time
+
+import yaml
+
+def synthetic_config(target_bytes):
+    """Build a config dict whose yaml rendering is roughly target_bytes long."""
+    groups = []
+    config = {"groups": groups}
+    size = 0
+    i = 0
+    while size < target_bytes:
+        group = {
+            "name": f"customer-group-{i}",
+            "policies": [
+                {
+                    "path": f"customer/app-{i}/env-{j}/*",
+                    "capabilities": ["create", "read", "update", "delete", "list"],
+                }
+                for j in range(10)
+            ],
+        }
+        groups.append(group)
+        size += len(yaml.safe_dump(group))
+        i += 1
+    return config
+
+def _time(load, content, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(megabytes=1.0, repeat=3):
+    """Print the best of `repeat` load times, in seconds per MB, for each loader."""
+    config = synthetic_config(int(megabytes * 1024 * 1024))
+    yaml_content = yaml.safe_dump(config).encode("utf-8")
+    json_content = json.dumps(config).encode("utf-8")
+
+    loaders = {
+        "yaml SafeLoader": (lambda c: yaml.load(c, Loader=yaml.SafeLoader), yaml_content),
+        "json": (json.loads, json_content),
+    }
+    if hasattr(yaml, "CSafeLoader"):
+        loaders["yaml CSafeLoader"] = (
+            lambda c: yaml.load(c, Loader=yaml.CSafeLoader), yaml_content,
+        )
+    else:
+        print("PyYAML was built without libyaml, skipping CSafeLoader")
+
+    for name, (load, content) in loaders.items():
+        mbytes = len(content) / (1024 * 1024)
+        seconds = _time(load, content, repeat)
+        print("{n:<18} {s:8.4f} s/MB  ({m:.2f} MB in {t:.4f} s)".format(
+            n = name,
+            s = seconds / mbytes,
+            m = mbytes,
+            t = seconds,
+        ))
+
+if __name__ == "__main__":
+    main(*[float(a) for a in sys.argv[1:2]])
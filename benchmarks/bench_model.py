@@ -0,0 +1,85 @@
+"""Measure the CPU time and memory of the parsed model, flatten and mangle.
+
+Run with: python -m benchmarks.bench_model [groups] [rules per group]
+
+Configs are built in memory, skipping file loading, so only the cost of
+validating into model objects, merging and mangling is measured.
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from self_service import config, hashivault, parse, translate
+
+CAPABILITIES = ["create", "read", "update", "delete", "list"]
+
+def synthetic_configs(groups, rules, files=10):
+    """Raw config dicts for `files` files, splitting `groups` groups between them."""
+    return [
+        {
+            "groups": [
+                {
+                    "name": f"team-{g}",
+                    "policies": [
+                        {
+                            "path": f"customer/app-{g % 50}/env-{r % 4}/secret-{r}",
+                            "capabilities": CAPABILITIES[:1 + (g + r) % len(CAPABILITIES)],
+                        }
+                        for r in range(rules)
+                    ],
+                }
+                for g in range(f, groups, files)
+            ],
+        }
+        for f in range(files)
+    ]
+
+def _measure(func):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, elapsed, retained, peak
+
+def main(groups=2000, rules=50):
+    """Print time, retained and peak memory of each stage."""
+    config.customer_prefix = "customer"
+    config.invalid_group_prefix = ""
+    config.quiet = True
+    config.verbose = False
+    raw = synthetic_configs(groups, rules)
+
+    stages = [
+        ("parse", lambda: [parse.CustomerConfig(**c) for c in raw]),
+        ("flatten", lambda: translate.flatten(customer_configs)),
+        ("mangle", lambda: [
+            hashivault._mangle_kv_v2_policy(p) for p in flat["policies"].values()
+        ]),
+    ]
+    print(f"{groups} groups x {rules} rules")
+    results = {}
+    for name, func in stages:
+        # Tracing slows everything down, so time a separate untraced run
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        value, _, retained, peak = _measure(func)
+        results[name] = value
+        if name == "parse":
+            customer_configs = value
+        elif name == "flatten":
+            flat = value
+        print("{n:<8} {s:8.3f} s  {r:8.1f} MB retained  {p:8.1f} MB peak".format(
+            n = name,
+            s = seconds,
+            r = retained / (1024 * 1024),
+            p = peak / (1024 * 1024),
+        ))
+    return results
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
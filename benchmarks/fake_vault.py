@@ -0,0 +1,169 @@
+"""In-process stand-in for the vault endpoints the applicator uses.
+
+Only what hashivault needs is implemented: token lookup, approle login,
+LDAP groups, approle roles and ACL policies, including LIST. Every request
+can be delayed by `latency` seconds, and a fraction `error_rate` of writes
+fail with `error_status`, to measure behaviour against a slow or unhealthy
+server.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+ROUTES = [
+    ("groups", re.compile(r"^/v1/auth/ldap/groups/?(?P<name>[^?]*)")),
+    ("approles", re.compile(r"^/v1/auth/approle/role/?(?P<name>[^?]*)")),
+    ("policies", re.compile(r"^/v1/sys/policy/?(?P<name>[^?]*)")),
+    ("policies", re.compile(r"^/v1/sys/policies/acl/?(?P<name>[^?]*)")),
+]
+
+class FakeVault():
+    """Threaded HTTP server holding vault objects in memory."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=500, retry_after=None, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.objects = {"groups": {}, "approles": {}, "policies": {}}
+        self.requests = []
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def addr(self):
+        """Base url of the server."""
+        return "http://127.0.0.1:{p}".format(p=self._server.server_port)
+
+    def count(self, method=None):
+        """Count requests received, optionally only those with one method."""
+        with self._lock:
+            return len([r for r in self.requests if method is None or r[0] == method])
+
+    def should_fail(self):
+        """Decide whether to inject an error into a write."""
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def record(self, method, path):
+        """Remember a request."""
+        with self._lock:
+            self.requests.append((method, path))
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+def _handler(vault):
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Avoid 40ms delayed ACK stalls between the header and body writes
+        disable_nagle_algorithm = True
+
+        def _reply(self, status, body=None, headers=None):
+            data = json.dumps(body).encode("utf-8") if body is not None else b""
+            self.send_response(status)
+            for key, val in (headers or {}).items():
+                self.send_header(key, val)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length)) if length else {}
+
+        def _route(self):
+            for kind, pattern in ROUTES:
+                match = pattern.match(self.path)
+                if match:
+                    return kind, unquote(match.group("name"))
+            return None, None
+
+        def _handle(self):
+            vault.record(self.command, self.path)
+            if vault.latency:
+                time.sleep(vault.latency)
+            body = self._body()
+
+            if self.path.startswith("/v1/auth/token/lookup-self"):
+                return self._reply(200, {"data": {
+                    "ttl": 3600, "creation_ttl": 3600, "renewable": True,
+                }})
+            if self.path.startswith("/v1/auth/approle/login") or \
+                    self.path.startswith("/v1/auth/token/renew-self"):
+                return self._reply(200, {"auth": {
+                    "client_token": "fake-token", "lease_duration": 3600, "renewable": True,
+                }})
+
+            kind, name = self._route()
+            if kind is None:
+                return self._reply(404, {"errors": []})
+            store = vault.objects[kind]
+
+            listing = self.command == "GET" and "list=true" in self.path.lower()
+            if self.command == "LIST" or listing:
+                return self._reply(200, {"data": {"keys": sorted(store)}})
+            if self.command == "GET":
+                if name not in store:
+                    return self._reply(404, {"errors": []})
+                return self._reply(200, {"data": store[name]})
+
+            if self.command in ("POST", "PUT") and vault.should_fail():
+                headers = {}
+                if vault.retry_after is not None:
+                    headers["Retry-After"] = str(vault.retry_after)
+                return self._reply(vault.error_status, {"errors": ["injected error"]}, headers)
+            if self.command in ("POST", "PUT"):
+                if kind == "groups":
+                    policies = body.get("policies", "")
+                    if isinstance(policies, str):
+                        policies = [p for p in policies.split(",") if p]
+                    store[name] = {"name": name, "policies": policies}
+                elif kind == "approles":
+                    store[name] = {"token_policies": body.get("policies", [])}
+                else:
+                    store[name] = {"name": name, "rules": body.get("policy", "")}
+                return self._reply(204)
+            if self.command == "DELETE":
+                store.pop(name, None)
+                return self._reply(204)
+            return self._reply(405, {"errors": []})
+
+        # pylint: disable=invalid-name
+        def do_GET(self):
+            self._handle()
+
+        # pylint: disable=invalid-name
+        def do_POST(self):
+            self._handle()
+
+        # pylint: disable=invalid-name
+        def do_PUT(self):
+            self._handle()
+
+        # pylint: disable=invalid-name
+        def do_DELETE(self):
+            self._handle()
+
+        # pylint: disable=invalid-name
+        def do_LIST(self):
+            self._handle()
+
+        def log_message(self, *args):
+            pass
+    return _Handler
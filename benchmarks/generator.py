@@ -0,0 +1,59 @@
+"""Generate synthetic customer config directories for benchmarks."""
+import os
+import random
+
+import yaml
+
+CAPABILITIES = ["create", "read", "update", "delete", "list"]
+
+# pylint: disable=too-many-arguments
+def generate_tenant(directory, prefix="customer", files=10, groups=10, approles=5,
+        rules=5, accessor_groups=2, seed=0):
+    """Write `files` config files into directory.
+
+    Each file defines `groups` groups and `approles` approles, each with
+    `rules` policy rules. Every approle lists `accessor_groups` of the
+    groups as accessors. Group names overlap between files, so flattening
+    has to merge them, like real configs split by project. Returns the list
+    of files written."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    written = []
+
+    def _rules(app):
+        return [
+            {
+                "path": "{p}/{a}/env-{e}/{s}".format(
+                    p=prefix,
+                    a=app,
+                    e=rng.randrange(4),
+                    s=rng.choice(["*", "+/config", f"secret-{i}"]),
+                ),
+                "capabilities": rng.sample(CAPABILITIES, rng.randrange(1, len(CAPABILITIES))),
+            }
+            for i in range(rules)
+        ]
+
+    for file_num in range(files):
+        app = f"app-{file_num}"
+        group_names = [f"{prefix}-team-{(file_num + g) % (groups * 2)}" for g in range(groups)]
+        config = {
+            "groups": [
+                {"name": name, "policies": _rules(app)} for name in group_names
+            ],
+            "approles": [
+                {
+                    "name": f"{prefix}-{app}-role-{a}",
+                    "policies": _rules(app),
+                    "accessor_groups": rng.sample(
+                        group_names, min(accessor_groups, len(group_names)),
+                    ),
+                }
+                for a in range(approles)
+            ],
+        }
+        file_path = os.path.join(directory, f"{app}.yml")
+        with open(file_path, "w", encoding="utf-8") as handle:
+            yaml.safe_dump(config, handle)
+        written.append(file_path)
+    return written
@@ -0,0 +1,106 @@
+"""Time each phase of a run against a synthetic tenant and a fake vault.
+
+    python -m benchmarks.run                         # print results
+    python -m benchmarks.run --save baseline.json    # record a baseline
+    python -m benchmarks.run --compare benchmarks/baseline.json
+
+With --compare, the exit status is non-zero if any phase is slower than the
+baseline by more than --tolerance (a fraction, default 0.5). Baselines are
+machine specific; record one on the machine that compares against it.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+from self_service import auth, config, hashivault, self_service, translate
+from .fake_vault import FakeVault
+from .generator import generate_tenant
+
+def _timed(results, name, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    results[name] = round(time.perf_counter() - start, 6)
+    return value
+
+def _configure(directory, vault_addr):
+    config.customer_prefix = "customer"
+    config.customer_config_dir = directory
+    config.invalid_group_prefix = ""
+    config.vault_addr = vault_addr
+    config.vault_token = "fake-token"
+    config.only_validate = False
+    config.plan_only = False
+    config.quiet = True
+    config.verbose = False
+    auth.reset()
+
+# pylint: disable=too-many-arguments
+def run(files=20, groups=20, approles=10, rules=10, accessor_groups=2, latency=0.0):
+    """Run every phase once and return { phase: seconds }."""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, FakeVault(latency=latency) as vault:
+        generate_tenant(directory, files=files, groups=groups, approles=approles,
+            rules=rules, accessor_groups=accessor_groups)
+        _configure(directory, vault.addr)
+
+        customer_files = _timed(results, "get_customer_files", self_service.get_customer_files)
+        customer_configs = _timed(results, "parse_customer_configs",
+            self_service.parse_customer_configs, customer_files)
+        flat = _timed(results, "flatten", translate.flatten, customer_configs)
+        _timed(results, "mangle_kv_v2_policy",
+            lambda: [hashivault._mangle_kv_v2_policy(p) for p in flat["policies"].values()])
+
+        _timed(results, "apply_cold", self_service.apply_flat_configs, flat)
+        results["apply_cold_requests"] = vault.count()
+        before = vault.count()
+        _timed(results, "apply_steady_state", self_service.apply_flat_configs, flat)
+        results["apply_steady_state_requests"] = vault.count() - before
+        results["objects"] = sum(len(flat[k]) for k in ["groups", "approles", "policies"])
+    return results
+
+def compare(results, baseline, tolerance):
+    """Return a list of phases that regressed against the baseline."""
+    regressions = []
+    for phase, seconds in baseline.items():
+        if phase.endswith("_requests") or phase == "objects" or phase not in results:
+            continue
+        if results[phase] > seconds * (1 + tolerance):
+            regressions.append("{p}: {r:.4f}s vs baseline {b:.4f}s".format(
+                p=phase, r=results[phase], b=seconds,
+            ))
+    return regressions
+
+def main(argv=None):
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--approles", type=int, default=10)
+    parser.add_argument("--rules", type=int, default=10)
+    parser.add_argument("--accessor-groups", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="seconds of simulated latency per vault request")
+    parser.add_argument("--save", help="write results to this json file")
+    parser.add_argument("--compare", help="baseline json file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    results = run(args.files, args.groups, args.approles, args.rules,
+        args.accessor_groups, args.latency)
+    print(json.dumps(results, indent=2))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as handle:
+            json.dump(results, handle, indent=2)
+            handle.write("\n")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
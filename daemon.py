@@ -0,0 +1,4 @@
+from self_service import daemon
+
+if __name__ == "__main__":
+    daemon.main()
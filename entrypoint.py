@@ -1,4 +1,8 @@
 import self_service
+from self_service import batch
 
 if __name__ == "__main__":
-    self_service.self_service.main()
+    if self_service.config.batch_manifest:
+        batch.main()
+    else:
+        self_service.self_service.main()
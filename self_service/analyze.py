@@ -0,0 +1,114 @@
+"""Find deny rules that shadow grants, and files that override each other.
+
+Every policy rule of every group and approle is indexed in a trie keyed by
+path segment, so the rules overlapping any one rule are found by walking only
+the branches that can match it, instead of comparing every pair of rules.
+
+Two things are reported:
+
+* shadowed: a deny rule covers every path another rule grants on, and wins
+  over it. Vault uses the highest priority rule matching a request, across
+  every policy of the token, and merges rules on the same path, so the deny
+  only wins if it has the same path or a higher priority. Across groups and
+  approles, this applies to tokens that have both policies.
+* conflicts: rules for the same group or approle, in different files, that
+  overlap with different capabilities. On the overlap, only the more specific
+  rule counts (or, on the exact same path, the union of both).
+"""
+from collections import defaultdict
+from os import path as os_path
+
+from . import config, metrics
+from .compact import Pattern, PathTrie, covers
+from .parse import Capability
+
+# pylint: disable=too-few-public-methods
+class Rule():
+    """A single policy rule, and where it came from."""
+    __slots__ = ["pattern", "capabilities", "deny", "target", "source"]
+
+    def __init__(self, path, capabilities, target, source):
+        self.pattern = Pattern(path)
+        self.capabilities = capabilities
+        self.deny = bool(capabilities & Capability.DENY)
+        self.target = target
+        self.source = source
+
+    def describe(self):
+        """Human readable summary, for reports."""
+        return "{k} '{n}' {c} on '{p}' ({f})".format(
+            k = self.target[0],
+            n = self.target[1],
+            c = "[" + ", ".join(self.capabilities.names()) + "]",
+            p = self.pattern.path,
+            f = self.source,
+        )
+
+def collect_rules(customer_configs):
+    """Every policy rule of every group and approle in a list of CustomerConfigs."""
+    rules = []
+    for customer_conf in customer_configs:
+        source = customer_conf.source
+        if source is not None:
+            source = os_path.relpath(source, config.customer_config_dir)
+        for target in customer_conf.groups + customer_conf.approles:
+            for pol in target.policies:
+                rules.append(Rule(
+                    pol.path,
+                    pol.capabilities,
+                    (target.kind, target.name),
+                    source,
+                ))
+    return rules
+
+def analyze(rules):
+    """Return { "shadowed": [(rule, deny)], "conflicts": [(rule, overriding)] }."""
+    # Deny rules are checked against everything, other rules only against
+    # rules of the same group or approle, so keep separate, smaller tries
+    denies = PathTrie()
+    targets = defaultdict(PathTrie)
+    for rule in rules:
+        if rule.deny:
+            denies.insert(rule)
+        targets[rule.target].insert(rule)
+
+    shadowed = []
+    conflicts = []
+    for rule in rules:
+        if not rule.deny:
+            for deny in denies.overlapping(rule.pattern):
+                # A narrower grant wins over the deny, even from another policy
+                if covers(deny.pattern, rule.pattern) and deny.pattern.key >= rule.pattern.key:
+                    shadowed.append((rule, deny))
+
+        for other in targets[rule.target].overlapping(rule.pattern):
+            if other.source == rule.source or other.capabilities == rule.capabilities:
+                continue
+            if (rule.deny or other.deny) and other.pattern.path == rule.pattern.path:
+                # Reported as shadowed
+                continue
+            # Report each pair once, from the side that is overridden
+            if (other.pattern.key, other.source) > (rule.pattern.key, rule.source):
+                conflicts.append((rule, other))
+    metrics.count("shadowed_rules", len(shadowed))
+    metrics.count("conflicting_rules", len(conflicts))
+    return { "shadowed": shadowed, "conflicts": conflicts }
+
+def format_report(report):
+    """Render an analysis as text."""
+    lines = []
+    for rule, deny in report["shadowed"]:
+        lines.append("Shadowed: {r}\n    by deny {d}{t}".format(
+            r = rule.describe(),
+            d = deny.describe(),
+            t = "" if deny.target == rule.target else ", for tokens with both policies",
+        ))
+    for rule, other in report["conflicts"]:
+        lines.append("Conflict: {r}\n    {how} {o}".format(
+            r = rule.describe(),
+            how = "merged with" if rule.pattern.path == other.pattern.path else "overridden by",
+            o = other.describe(),
+        ))
+    if not lines:
+        return "No shadowed or conflicting rules."
+    return "\n".join(lines)
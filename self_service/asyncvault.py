@@ -0,0 +1,226 @@
+"""Apply groups, approles and policies from a single asyncio event loop.
+
+This is an alternative to the thread pool in hashivault, selected with
+APPLY_BACKEND=asyncio. Thousands of writes can be in flight at once, limited
+by ASYNC_CONCURRENCY, without a thread per request. It only performs the
+three writes hashivault does; authentication and reads still go through
+the hvac client.
+
+To avoid a new dependency, requests are plain HTTP/1.1 over asyncio streams,
+with idle connections kept open for reuse.
+"""
+import asyncio
+import json
+import ssl
+import time
+from urllib.parse import urlsplit, quote
+
+from . import config, log, metrics, ratelimit, reconcile, transport
+
+class AsyncVaultClient():
+    """Minimal keep-alive HTTP client for the vault api."""
+
+    def __init__(self, addr, token, concurrency):
+        url = urlsplit(addr)
+        self.host = url.hostname
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.port = url.port or (443 if self.ssl else 80)
+        self.token = token
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._idle = []
+
+    async def _connect(self):
+        conn = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl),
+            config.vault_connect_timeout,
+        )
+        transport.stats.count_opened()
+        return conn
+
+    async def _roundtrip(self, conn, method, path, body):
+        reader, writer = conn
+        head = "\r\n".join([
+            f"{method} {path} HTTP/1.1",
+            f"Host: {self.host}:{self.port}",
+            f"X-Vault-Token: {self.token}",
+            "X-Vault-Request: true",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "", "",
+        ])
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+        return await self._read_response(reader)
+
+    @staticmethod
+    async def _read_response(reader):
+        """Read (status, headers, body) of one response."""
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by vault server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, val = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = val.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await reader.readexactly(int(headers.get("content-length", "0")))
+        return status, headers, data
+
+    async def request(self, method, path, payload):
+        """Send a json request and return (status, headers, body).
+
+        Requests vault throttles are retried, at a rate set by ratelimit."""
+        body = json.dumps(payload).encode("utf-8")
+        attempt = 0
+        while True:
+            token = await self._acquire()
+            status = "error"
+            try:
+                res = await self._send_once(method, path, body)
+                status = res[0]
+            finally:
+                retry = ratelimit.controller.finish(token, status, attempt)
+            if not retry:
+                return res
+            delay = ratelimit.backoff(attempt, res[1].get("retry-after"))
+            log.debug("Retrying %s %s in %.2fs, vault answered %d", method, path, delay, status)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    async def _acquire():
+        # The controller is shared with threads, so poll it rather than block on its lock
+        while True:
+            token, wait = ratelimit.controller.try_acquire()
+            if token is not None:
+                return token
+            await asyncio.sleep(wait or 0.01)
+
+    async def _send_once(self, method, path, body):
+        async with self._semaphore:
+            transport.stats.count_request()
+            start = time.perf_counter()
+            status = "error"
+            try:
+                res = await self._request(method, path, body)
+                status = res[0]
+                return res
+            finally:
+                metrics.observe(method, path, time.perf_counter() - start, status, len(body))
+
+    async def _request(self, method, path, body):
+        """Send a request, reusing an idle connection when there is one."""
+        reused = bool(self._idle)
+        conn = self._idle.pop() if reused else await self._connect()
+        try:
+            return await self._attempt(conn, method, path, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if not reused:
+                raise
+        # The server may have closed an idle connection, try a fresh one once
+        return await self._attempt(await self._connect(), method, path, body)
+
+    async def _attempt(self, conn, method, path, body):
+        """Send a request on conn, then keep it idle for reuse, or close it."""
+        try:
+            res = await asyncio.wait_for(
+                self._roundtrip(conn, method, path, body),
+                config.vault_read_timeout,
+            )
+        except BaseException:
+            conn[1].close()
+            raise
+        if res[1].get("connection", "").lower() == "close":
+            conn[1].close()
+        else:
+            self._idle.append(conn)
+        return res
+
+    async def close(self):
+        """Close every idle connection."""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+async def _write(client, target, method, path, payload):
+    kind, name = target
+    start = time.perf_counter()
+    status, headers, body = await client.request(method, path, payload)
+    log.record(kind, name, status, time.perf_counter() - start)
+    transport.consistency.record(headers.get("x-vault-index"))
+    if status < 200 or status > 299:
+        log.critical("Failed to apply %s %s: %s", kind, name, body.decode("utf-8", "replace"))
+        return False
+    return True
+
+def _write_group(client, name, policy_name):
+    return _write(client, ("group", name), "POST",
+        "/v1/auth/ldap/groups/{n}".format(n=quote(name)),
+        { "policies": [ policy_name ] },
+    )
+
+def _write_approle(client, name, policy_name):
+    return _write(client, ("approle", name), "POST",
+        "/v1/auth/approle/role/{n}".format(n=quote(name)),
+        { "policies": [ policy_name ] },
+    )
+
+def _write_policy(client, name, policy):
+    return _write(client, ("policy", name), "PUT",
+        "/v1/sys/policy/{n}".format(n=quote(name)),
+        { "policy": json.dumps(reconcile.render_policy(policy)) },
+    )
+
+async def _apply(token, groups, approles, policies):
+    client = AsyncVaultClient(config.vault_addr, token, config.async_concurrency)
+
+    async def _guard(key, coro):
+        # pylint: disable=broad-except
+        try:
+            return key, await coro
+        except Exception as err:
+            log.critical("Failed to apply %s %s: %r", key[0], key[1], err)
+            return key, False
+
+    policy_tasks = {
+        name: asyncio.ensure_future(_guard(("policy", name), _write_policy(client, name, pol)))
+        for name, pol in policies.items()
+    }
+
+    async def _after_policy(key, policy_name, write):
+        # Never point a group or approle at a policy that failed to be written
+        if policy_name in policy_tasks:
+            _, success = await policy_tasks[policy_name]
+            if not success:
+                log.critical("Skipping %s %s, policy %s failed", key[0], key[1], policy_name)
+                return key, False
+        return await _guard(key, write(client, key[1], policy_name))
+
+    try:
+        results = await asyncio.gather(
+            *policy_tasks.values(),
+            *[_after_policy(("group", n), p, _write_group) for n, p in groups.items()],
+            *[_after_policy(("approle", n), p, _write_approle) for n, p in approles.items()],
+        )
+    finally:
+        await client.close()
+    return dict(results)
+
+def apply(token, groups, approles, policies):
+    """Write every group, approle and (already mangled) policy.
+
+    Returns { (kind, name): success }, like scheduler.run."""
+    return asyncio.run(_apply(token, groups, approles, policies))
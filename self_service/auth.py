@@ -0,0 +1,202 @@
+"""Keep one vault token per process, renewing it instead of logging in again.
+
+Logging in with the approle on every run issues a new token (and lease) each
+time, and checking an unknown token costs a round trip. Instead, the token
+issued by the approle login is cached in memory with its expiry, and
+optionally in VAULT_TOKEN_CACHE_FILE (readable by its owner only) so that
+consecutive runs can share it. Once less than a third of its TTL remains,
+the token is renewed; it is only replaced when it can no longer be renewed.
+
+A static VAULT_TOKEN is looked up once for its TTL, and renewed on the same
+schedule when it is renewable. Once it is about to expire and cannot be
+renewed, that is logged, since only a restart with a new token helps.
+
+Every client in the process, and therefore every worker thread, shares the
+same token.
+"""
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+
+from hvac.exceptions import VaultError
+
+from . import config, log
+
+_lock = threading.Lock()
+_cached = {}
+
+# pylint: disable=too-few-public-methods
+class Token():
+    """A client token with its lease information."""
+    def __init__(self, token, ttl, renewable, expires_at=None):
+        self.token = token
+        self.ttl = int(ttl)
+        self.renewable = bool(renewable)
+        self.expires_at = expires_at if expires_at is not None else time.time() + self.ttl
+
+    @classmethod
+    def from_auth(cls, res):
+        """Build from the 'auth' section of a login or renew response."""
+        return cls(
+            token = res["auth"]["client_token"],
+            ttl = res["auth"]["lease_duration"],
+            renewable = res["auth"]["renewable"],
+        )
+
+    def remaining(self):
+        """Seconds until expiry, or None if the token never expires."""
+        if self.ttl == 0:
+            return None
+        return self.expires_at - time.time()
+
+    def fresh(self):
+        """Whether the token can be used without renewing it first."""
+        remaining = self.remaining()
+        return remaining is None or remaining > self.ttl / 3
+
+def _cache_key():
+    """Tokens are only reused for the same server and approle."""
+    return hashlib.sha256(
+        f"{config.vault_addr}\0{config.vault_role_id}".encode("utf-8")
+    ).hexdigest()
+
+def _load_file():
+    """Read the token cache file, ignoring it unless only its owner can read it."""
+    cache_file = config.vault_token_cache_file
+    if not cache_file:
+        return None
+    try:
+        with open(cache_file, "r", encoding="utf-8") as handle:
+            mode = os.fstat(handle.fileno()).st_mode
+            if mode & (stat.S_IRWXG | stat.S_IRWXO):
+                log.critical("Ignoring %s, it must only be accessible by its owner", cache_file)
+                return None
+            cached = json.load(handle)
+        if cached.pop("key") != _cache_key():
+            return None
+        return Token(**cached)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        log.debug("Ignoring unreadable token cache %s: %s", cache_file, err)
+        return None
+
+def _save_file(token):
+    """Write the token cache file with owner only permissions."""
+    cache_file = config.vault_token_cache_file
+    if not cache_file:
+        return
+    tmp_file = f"{cache_file}.tmp"
+    try:
+        handle = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(handle, 0o600)
+        with os.fdopen(handle, "w", encoding="utf-8") as tmp:
+            json.dump({
+                "key": _cache_key(),
+                "token": token.token,
+                "ttl": token.ttl,
+                "renewable": token.renewable,
+                "expires_at": token.expires_at,
+            }, tmp)
+        os.replace(tmp_file, cache_file)
+    except OSError as err:
+        log.debug("Could not write token cache %s: %s", cache_file, err)
+
+def _store(token):
+    _cached[_cache_key()] = token
+    _save_file(token)
+    return token
+
+def _renew(client, token):
+    """Renew a token, returning None if that is not possible."""
+    remaining = token.remaining()
+    if not token.renewable or remaining is None or remaining <= 0:
+        return None
+    client.token = token.token
+    try:
+        renewed = Token.from_auth(client.auth.token.renew_self())
+    except (VaultError, TypeError, KeyError) as err:
+        log.debug("Could not renew vault token: %s", err)
+        return None
+    # Close to its max TTL, a renewal does not extend the token enough to be useful
+    if not renewed.fresh() or renewed.ttl < token.ttl / 3:
+        return None
+    log.debug("Renewed vault token")
+    return renewed
+
+def _lookup(client):
+    """Look up VAULT_TOKEN, returning None if it is not valid."""
+    client.token = config.vault_token
+    try:
+        data = client.auth.token.lookup_self()["data"]
+        return Token(
+            token = config.vault_token,
+            ttl = data.get("creation_ttl") or data["ttl"],
+            renewable = data.get("renewable"),
+            expires_at = time.time() + int(data["ttl"]),
+        )
+    except (VaultError, TypeError, KeyError) as err:
+        log.debug("VAULT_TOKEN is not valid: %s", err)
+        return None
+
+def _static(client, token):
+    """VAULT_TOKEN, renewed if needed, or None once it is not usable."""
+    if not isinstance(token, Token) or token.token != config.vault_token:
+        token = _lookup(client)
+        if token is None:
+            return None
+    if token.fresh():
+        return token
+    renewed = _renew(client, token)
+    if renewed is not None:
+        return renewed
+    remaining = token.remaining()
+    if remaining <= 0:
+        log.critical("VAULT_TOKEN has expired and cannot be renewed, it must be replaced")
+        return None
+    log.critical("VAULT_TOKEN expires in %ds and cannot be renewed, it must be replaced",
+        remaining)
+    return token
+
+def _login(client):
+    res = client.auth_approle(config.vault_role_id, config.vault_role_secret)
+    try:
+        return Token.from_auth(res)
+    except (TypeError, KeyError):
+        # Without lease information, nothing can be cached
+        return None
+
+def authenticate(client):
+    """Point client at a valid token, logging in only when needed."""
+    with _lock:
+        key = _cache_key()
+        if config.vault_token:
+            static = _static(client, _cached.get(key))
+            if static is not None:
+                _cached[key] = static
+                client.token = static.token
+                return
+            _cached.pop(key, None)
+
+        token = _cached.get(key) or _load_file()
+        if isinstance(token, Token):
+            if token.fresh():
+                client.token = token.token
+                return
+            renewed = _renew(client, token)
+            if renewed is not None:
+                client.token = _store(renewed).token
+                return
+
+        token = _login(client)
+        if token is not None:
+            client.token = _store(token).token
+        log.debug("Logged in to vault with approle")
+
+def reset():
+    """Forget every token cached in memory."""
+    with _lock:
+        _cached.clear()
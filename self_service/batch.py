@@ -0,0 +1,161 @@
+"""Apply the configs of many customers in one process.
+
+A manifest lists one entry per customer (tenant), for example:
+
+    tenants:
+      - customer_prefix: foo
+        customer_config_dir: /configs/foo
+      - customer_prefix: bar
+        customer_config_dir: /configs/bar
+        invalid_group_prefix: bar-admins
+
+Every tenant is parsed and flattened with its own settings, then all tenants
+are applied with a single authenticated vault client. With SHARD_COUNT, only
+the tenants this replica owns are processed (see shard).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import yaml
+from . import config, log, metrics, shard
+from .self_service import (
+    get_customer_files, flatten_customer_files, apply_flat_configs, run_main, vault_client,
+)
+
+TENANT_SETTINGS = [
+    "customer_prefix",
+    "customer_config_dir",
+    "invalid_group_prefix",
+]
+
+# pylint: disable=too-few-public-methods
+class Tenant():
+    """Represent one manifest entry."""
+    def __init__(self, customer_prefix=None, customer_config_dir=None, invalid_group_prefix=""):
+        if not customer_prefix:
+            raise ValueError("Tenant is missing customer_prefix")
+        if not customer_config_dir:
+            raise ValueError("Tenant '{p}' is missing customer_config_dir".format(
+                p = customer_prefix,
+            ))
+        self.customer_prefix = customer_prefix
+        self.customer_config_dir = customer_config_dir
+        self.invalid_group_prefix = invalid_group_prefix or ""
+
+
+def parse_manifest(path):
+    """Parse a batch manifest into a list of Tenant objects."""
+    with open(path, 'r', encoding='utf-8') as handle:
+        manifest = yaml.safe_load(handle) or {}
+    tenants = []
+    for i, tenant in enumerate(manifest.get("tenants", [])):
+        try:
+            tenants.append(Tenant(**tenant))
+        except (TypeError, ValueError) as err:
+            raise ValueError("Error in tenant {n} of '{f}':\n{e}".format(
+                n = i + 1,
+                f = path,
+                e = err,
+            )) from err
+    prefixes = [t.customer_prefix for t in tenants]
+    duplicates = sorted({p for p in prefixes if prefixes.count(p) > 1})
+    if duplicates:
+        raise ValueError("Duplicate tenants in '{f}': {d}".format(
+            f = path,
+            d = ", ".join(duplicates),
+        ))
+    return tenants
+
+@contextmanager
+def tenant_config(tenant):
+    """Temporarily point the global config at a single tenant."""
+    saved = {key: getattr(config, key) for key in TENANT_SETTINGS}
+    try:
+        for key in TENANT_SETTINGS:
+            setattr(config, key, getattr(tenant, key))
+        yield
+    finally:
+        for key, val in saved.items():
+            setattr(config, key, val)
+
+def prepare_tenant(tenant):
+    """Parse, validate and flatten the configs of a single tenant."""
+    with tenant_config(tenant):
+        log.debug("Scanning customer dir %s", config.customer_config_dir)
+        return flatten_customer_files(get_customer_files())
+
+def run(tenants, concurrency=None):
+    """Validate and (unless only validating) apply every tenant.
+
+    Tenants are prepared one at a time, since parsing reads the global config,
+    then applied in parallel with one shared vault client. Returns a dict of
+    customer_prefix to an error message, or None on success."""
+    results = {}
+    prepared = {}
+    for tenant in tenants:
+        # pylint: disable=broad-except
+        try:
+            prepared[tenant.customer_prefix] = prepare_tenant(tenant)
+        except Exception as err:
+            results[tenant.customer_prefix] = str(err)
+
+    if config.only_validate or len(prepared) == 0:
+        for prefix in prepared:
+            results[prefix] = None
+        return results
+
+    concurrency = concurrency or config.batch_concurrency
+    client = vault_client(concurrency * config.apply_concurrency)
+
+    def _apply(prefix):
+        # pylint: disable=broad-except
+        try:
+            with log.context(tenant=prefix):
+                if apply_flat_configs(prepared[prefix], client, customer_prefix=prefix):
+                    return None
+                return "Failed to apply one or more objects"
+        except Exception as err:
+            return str(err)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for prefix, error in zip(prepared, pool.map(_apply, prepared)):
+            results[prefix] = error
+    return results
+
+def main():
+    """Apply every tenant listed in the batch manifest."""
+    return run_main(_main, config.batch_concurrency)
+
+def _main():
+    tenants = parse_manifest(config.batch_manifest)
+    log.debug("Found %d tenants in %s", len(tenants), config.batch_manifest)
+    if config.shard_report:
+        log.log(shard.format_report([t.customer_prefix for t in tenants]))
+        return True
+    if config.shard_count > 1:
+        total = len(tenants)
+        tenants = [t for t in tenants if shard.owns(t.customer_prefix)]
+        log.log("Shard %d of %d owns %d of %d tenants",
+            config.shard_index, config.shard_count, len(tenants), total)
+    results = run(tenants)
+
+    errors = []
+    metrics.count("tenants", len(tenants))
+    for tenant in tenants:
+        error = results[tenant.customer_prefix]
+        if error is None:
+            log.log("Tenant %s: OK", tenant.customer_prefix, tenant=tenant.customer_prefix)
+        else:
+            log.critical("Tenant %s: FAILED", tenant.customer_prefix, tenant=tenant.customer_prefix)
+            metrics.count("failed_tenants")
+            errors.append("Tenant '{p}':\n{e}".format(
+                p = tenant.customer_prefix,
+                e = error,
+            ))
+    if len(errors) != 0:
+        raise ValueError("Error(s) processing {n} of {t} tenants:\n{e}".format(
+            n = len(errors),
+            t = len(tenants),
+            e = "\n-----------\n".join(errors),
+        ))
+    return True
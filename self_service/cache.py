@@ -0,0 +1,119 @@
+"""On-disk cache of parsed and validated customer config files.
+
+Entries are keyed by a hash of the file content plus every setting that
+affects validation, so an unchanged file skips YAML loading and validation
+entirely. Set PARSE_CACHE_DIR to enable it, and PARSE_CACHE_MAX_ENTRIES to
+bound its size; the least recently used entries are evicted first.
+
+Entries are pickles, and loading a pickle can run any code, with the vault
+token at hand. So entries (and the flat index, which is saved the same way)
+are written readable by their owner only, and only loaded if they are owned
+by the user running the applicator and nobody else can write to them.
+"""
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+
+from . import config, log
+
+# Bump whenever the parsed object model changes, to invalidate old entries
+CACHE_VERSION = "3"
+
+def enabled():
+    """Whether a cache directory is configured."""
+    return bool(config.parse_cache_dir)
+
+def key(content):
+    """Hash file content together with the settings used to validate it."""
+    digest = hashlib.sha256()
+    for part in [
+        CACHE_VERSION,
+        config.customer_prefix,
+        config.invalid_group_prefix,
+    ]:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(content)
+    return digest.hexdigest()
+
+def load_file(file_path):
+    """Unpickle a file, or raise PermissionError if someone else could have written it."""
+    with open(file_path, "rb") as handle:
+        info = os.fstat(handle.fileno())
+        if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise PermissionError(
+                f"Refusing to load {file_path}, it is not owned by this user "
+                "or can be written by others"
+            )
+        return pickle.load(handle)
+
+def save_file(file_path, value):
+    """Pickle value to a file only its owner can read, replacing it atomically."""
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as tmp:
+            pickle.dump(value, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def _entry_path(entry_key):
+    return os.path.join(config.parse_cache_dir, entry_key + ".pickle")
+
+def get(entry_key):
+    """Return the cached object for a key, or None."""
+    if not enabled():
+        return None
+    entry = _entry_path(entry_key)
+    # pylint: disable=broad-except
+    try:
+        value = load_file(entry)
+    except FileNotFoundError:
+        return None
+    except PermissionError as err:
+        log.warning("Ignoring cache entry: %s", err)
+        return None
+    except Exception as err:
+        log.debug("Ignoring unreadable cache entry %s: %s", entry, err)
+        return None
+    # Record the access for LRU eviction
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+    return value
+
+def put(entry_key, value):
+    """Store an object under a key. Failing to write the cache is not an error."""
+    if not enabled():
+        return
+    try:
+        os.makedirs(config.parse_cache_dir, mode=0o700, exist_ok=True)
+        save_file(_entry_path(entry_key), value)
+    except OSError as err:
+        log.debug("Could not write parse cache entry: %s", err)
+
+def evict():
+    """Remove the least recently used entries beyond PARSE_CACHE_MAX_ENTRIES."""
+    if not enabled():
+        return 0
+    try:
+        entries = [
+            e for e in os.scandir(config.parse_cache_dir) if e.name.endswith(".pickle")
+        ]
+    except FileNotFoundError:
+        return 0
+    excess = len(entries) - config.parse_cache_max_entries
+    if excess <= 0:
+        return 0
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:excess]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+    log.debug("Evicted %d parse cache entries", excess)
+    return excess
@@ -0,0 +1,233 @@
+"""Remove policy rules that can never change what a token is allowed to do.
+
+Within one policy, vault does not combine the capabilities of every rule that
+matches a request; only the highest priority match counts (see
+https://www.vaultproject.io/docs/concepts/policies#priority-matching). So a
+narrow rule with the same capabilities as a broader glob is not always
+redundant: a third rule in between could take over once it is gone.
+
+A rule R is only removed when another rule B matches every path R matches, and
+either B always wins over R, or B has exactly the same capabilities as R and so
+does every rule that overlaps R with a priority between the two. Capabilities,
+including deny, are compared as whole bitmasks and never merged, so the rule that
+decides each request path keeps the same capabilities.
+
+A token can hold several policies, and vault then matches against the rules of
+all of them, merging the capabilities of rules on the same path. So in the
+second case, no rule of any other policy of the run may overlap R with a
+priority from B's to R's either.
+"""
+from . import log, metrics
+
+# pylint: disable=too-few-public-methods
+class Pattern():
+    """A policy path, split into segments, with its vault priority."""
+    __slots__ = ["path", "segments", "glob", "literal", "key", "opaque"]
+
+    def __init__(self, path):
+        self.path = path
+        self.glob = path.endswith("*")
+        stem = path[:-1] if self.glob else path
+        # For globs, the last segment is a prefix that may run into later segments
+        self.segments = stem.split("/")
+        wildcards = [i for i in (stem.find("+"), path.find("*")) if i >= 0]
+        first_wildcard = min(wildcards) if wildcards else len(path)
+        self.literal = path[:first_wildcard]
+        # Higher keys win, in the order vault compares them
+        self.key = (
+            first_wildcard,
+            not self.glob,
+            -self.segments.count("+"),
+            len(path),
+            path,
+        )
+        # e.g. 'foo/+*', which this module does not try to reason about
+        self.opaque = self.glob and self.segments[-1] == "+"
+
+def _segment_covers(outer, inner):
+    return outer in ("+", inner)
+
+def covers(outer, inner):
+    """Whether every path matched by inner is also matched by outer."""
+    if outer.opaque or inner.opaque:
+        return False
+    if not inner.path.startswith(outer.literal):
+        return False
+    if not outer.glob:
+        return not inner.glob and len(outer.segments) == len(inner.segments) and all(
+            _segment_covers(o, i) for o, i in zip(outer.segments, inner.segments)
+        )
+    return _glob_covers(outer, inner)
+
+def _glob_covers(outer, inner):
+    last = len(outer.segments) - 1
+    if len(inner.segments) <= last:
+        return False
+    if not all(_segment_covers(o, i) for o, i in zip(outer.segments[:last], inner.segments)):
+        return False
+    prefix = outer.segments[last]
+    if inner.segments[last] == "+":
+        return prefix == ""
+    return inner.segments[last].startswith(prefix)
+
+def overlaps(first, second):
+    """Whether some path is matched by both patterns. May report false overlaps."""
+    if first.opaque or second.opaque:
+        return True
+    for i, (one, two) in enumerate(zip(first.segments, second.segments)):
+        one_open = first.glob and i == len(first.segments) - 1
+        two_open = second.glob and i == len(second.segments) - 1
+        if one_open or two_open:
+            # Past the end of a glob, anything matches
+            if "+" in (one, two):
+                return True
+            if one_open and two_open:
+                return one.startswith(two) or two.startswith(one)
+            return two.startswith(one) if one_open else one.startswith(two)
+        if one != two and "+" not in (one, two):
+            return False
+    return not first.glob and not second.glob and \
+        len(first.segments) == len(second.segments)
+
+# pylint: disable=too-few-public-methods
+class _Node():
+    __slots__ = ["children", "exact", "globs"]
+
+    def __init__(self):
+        self.children = {}
+        # Rules ending at this node
+        self.exact = []
+        # (prefix, rule) for globs whose last, partial segment starts here
+        self.globs = []
+
+class PathTrie():
+    """Index of rules by path segment, with vault's + and trailing * semantics."""
+
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    def insert(self, rule):
+        """Add a rule to the index."""
+        segments = rule.pattern.segments
+        full = segments[:-1] if rule.pattern.glob else segments
+        node = self.root
+        for segment in full:
+            node = node.children.setdefault(segment, _Node())
+        if rule.pattern.glob:
+            node.globs.append((segments[-1], rule))
+        else:
+            node.exact.append(rule)
+        self.size += 1
+
+    def overlapping(self, pattern):
+        """Yield every indexed rule that matches at least one path pattern matches."""
+        yield from self._walk(self.root, pattern, 0)
+
+    def _walk(self, node, pattern, depth):
+        segments = pattern.segments
+        last = len(segments) - 1
+        open_end = pattern.glob and depth == last
+
+        if depth <= last:
+            segment = segments[depth]
+            for prefix, rule in node.globs:
+                if "+" in (segment, prefix) or segment.startswith(prefix) or \
+                        (open_end and prefix.startswith(segment)):
+                    yield rule
+        else:
+            yield from node.exact
+            return
+
+        if open_end:
+            # Everything below a matching child overlaps the open end of the glob
+            for key, child in node.children.items():
+                if "+" in (segment, key) or key.startswith(segment):
+                    yield from _subtree(child)
+            return
+
+        if segment == "+":
+            children = node.children.values()
+        else:
+            children = [c for c in (node.children.get(segment), node.children.get("+")) if c]
+        for child in children:
+            yield from self._walk(child, pattern, depth + 1)
+
+def _subtree(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield from node.exact
+        for _, rule in node.globs:
+            yield rule
+        stack.extend(node.children.values())
+
+# pylint: disable=too-few-public-methods
+class _Rule():
+    """A rule in the index of every policy, for PathTrie."""
+    __slots__ = ["pattern", "policy"]
+
+    def __init__(self, pattern, policy):
+        self.pattern = pattern
+        self.policy = policy
+
+def _foreign_between(target, broader, index, policy):
+    """Whether another policy has a rule overlapping target, with a priority
+    from broader's to target's. For a token with both policies, vault picks
+    the highest priority match among the rules of all of them, so such a rule
+    could take over from broader once target is gone."""
+    return index is not None and any(
+        other.policy != policy and broader.key <= other.pattern.key <= target.key
+        for other in index.overlapping(target)
+    )
+
+def _removable(rule, rules, patterns, index=None, policy=None):
+    """Whether removing rule leaves every request path with the same capabilities."""
+    target = patterns[rule]
+    for other in rules:
+        if other == rule or not covers(patterns[other], target):
+            continue
+        broader = patterns[other]
+        if broader.key > target.key:
+            # rule never wins, broader always matches first, in any set of policies
+            return True
+        if rules[other] != rules[rule]:
+            continue
+        if all(
+            rules[between] == rules[rule]
+            for between in rules
+            if broader.key < patterns[between].key < target.key
+            and overlaps(patterns[between], target)
+        ) and not _foreign_between(target, broader, index, policy):
+            return True
+    return False
+
+def compact_policy(policy, index=None, name=None):
+    """Return a copy of { path: capabilities } without redundant rules.
+
+    index is a PathTrie of the rules of every policy, by policy name, that may
+    be attached to the same token as this one (name)."""
+    rules = dict(policy)
+    patterns = { path: Pattern(path) for path in rules }
+    # Narrowest first, those are the rules most often covered by another
+    for path in sorted(rules, key=lambda p: patterns[p].key, reverse=True):
+        if _removable(path, rules, patterns, index, name):
+            del rules[path]
+    return rules
+
+def compact(flat_configs):
+    """Compact every policy of a flattened config, without modifying it."""
+    # Any policies may end up on the same token, through group membership
+    index = PathTrie()
+    for name, pol in flat_configs["policies"].items():
+        for path in pol:
+            index.insert(_Rule(Pattern(path), name))
+    policies = {
+        name: compact_policy(pol, index, name) for name, pol in flat_configs["policies"].items()
+    }
+    before = sum(len(pol) for pol in flat_configs["policies"].values())
+    after = sum(len(pol) for pol in policies.values())
+    metrics.count("policy_rules", before)
+    metrics.count("compacted_policy_rules", after)
+    log.log("Compacted %d policy rules to %d", before, after)
+    return { **flat_configs, "policies": policies }
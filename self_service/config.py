@@ -31,18 +31,92 @@ def _try_env_bool(key, default):
         )
     return val
 
+def _try_env_int(key, default, minimum=1):
+    """Get an environment variable and parse it as an integer, positive by default"""
+    encoded = _try_env(key, default)
+    try:
+        val = int(encoded)
+    except ValueError:
+        val = minimum - 1
+    if val < minimum:
+        expected = "a positive integer" if minimum == 1 else f"an integer of at least {minimum}"
+        raise ValueError(
+            f"Invalid value in {key} environment variable.\nMust be {expected}."
+        )
+    return val
+
+def _try_env_choice(key, default, choices):
+    """Get an environment variable and check it is one of the allowed choices"""
+    val = _try_env(key, default).lower()
+    if val not in choices:
+        raise ValueError(
+            f"Invalid value in {key} environment variable.\nMust be one of {', '.join(choices)}."
+        )
+    return val
+
 customer_config_dir = _try_env("CUSTOMER_CONFIG_DIR", "/customer_configs")
+customer_config_recursive = _try_env_bool("CUSTOMER_CONFIG_RECURSIVE", "False")
 customer_prefix = _try_env("CUSTOMER_PREFIX", "")
 create_secret_paths = _try_env_bool("CREATE_PATHS", "False")
 
 vault_addr = _try_env("VAULT_ADDR", "")
+vault_read_addr = _try_env("VAULT_READ_ADDR", "")
 vault_token = _try_env("VAULT_TOKEN", "")
 vault_role_id = _try_env("VAULT_ROLE_ID", "")
 vault_role_secret = _try_env("VAULT_ROLE_SECRET", "")
+vault_token_cache_file = _try_env("VAULT_TOKEN_CACHE_FILE", "")
+vault_connect_timeout = _try_env_int("VAULT_CONNECT_TIMEOUT", "5")
+vault_read_timeout = _try_env_int("VAULT_READ_TIMEOUT", "30")
+vault_tcp_keepalive = _try_env_bool("VAULT_TCP_KEEPALIVE", "True")
+vault_max_retries = _try_env_int("VAULT_MAX_RETRIES", "5")
+vault_error_threshold = _try_env_int("VAULT_ERROR_THRESHOLD", "50")
 
 quiet = _try_env_bool("QUIET", "False")
 verbose = _try_env_bool("VERBOSE", "True")
+log_level = _try_env_choice("LOG_LEVEL", "", ["", "debug", "info", "warning", "critical"])
+log_format = _try_env_choice("LOG_FORMAT", "text", ["text", "json"])
+log_buffer_lines = _try_env_int("LOG_BUFFER_LINES", "512")
 
 only_validate = _try_env_bool("ONLY_VALIDATE", "True")
+analyze_policies = _try_env_bool("ANALYZE_POLICIES", "False")
+diff_apply = _try_env_bool("DIFF_APPLY", "True")
+plan_only = _try_env_bool("PLAN_ONLY", "False")
+apply_concurrency = _try_env_int("APPLY_CONCURRENCY", "8")
+apply_backend = _try_env_choice("APPLY_BACKEND", "threads", ["threads", "asyncio"])
+async_concurrency = _try_env_int("ASYNC_CONCURRENCY", "256")
+compact_policies = _try_env_bool("COMPACT_POLICIES", "False")
+prune_orphans = _try_env_bool("PRUNE_ORPHANS", "False")
+prune_max_deletions = _try_env_int("PRUNE_MAX_DELETIONS", "25")
 
 invalid_group_prefix = _try_env("INVALID_GROUP_PREFIX", "")
+ldap_groups_file = _try_env("LDAP_GROUPS_FILE", "")
+ldap_group_attribute = _try_env("LDAP_GROUP_ATTRIBUTE", "cn")
+ldap_groups_ttl = _try_env_int("LDAP_GROUPS_TTL", "300", minimum=0)
+
+flat_index_file = _try_env("FLAT_INDEX_FILE", "")
+changed_files = _try_env("CHANGED_FILES", None)
+
+parse_workers = _try_env_int("PARSE_WORKERS", "1")
+parse_cache_dir = _try_env("PARSE_CACHE_DIR", "")
+parse_cache_max_entries = _try_env_int("PARSE_CACHE_MAX_ENTRIES", "10000")
+
+metrics_prometheus_file = _try_env("METRICS_PROMETHEUS_FILE", "")
+metrics_json_file = _try_env("METRICS_JSON_FILE", "")
+
+batch_manifest = _try_env("BATCH_MANIFEST", "")
+batch_concurrency = _try_env_int("BATCH_CONCURRENCY", "4")
+
+shard_index = _try_env_int("SHARD_INDEX", "0", minimum=0)
+shard_count = _try_env_int("SHARD_COUNT", "1")
+shard_report = _try_env_bool("SHARD_REPORT", "False")
+if shard_index >= shard_count:
+    raise ValueError("Invalid value in SHARD_INDEX environment variable.\n"
+        f"Must be less than SHARD_COUNT ({shard_count}).")
+
+daemon_poll_seconds = _try_env_int("DAEMON_POLL_SECONDS", "10")
+daemon_debounce_seconds = _try_env_int("DAEMON_DEBOUNCE_SECONDS", "2")
+daemon_health_port = _try_env_int("DAEMON_HEALTH_PORT", "8080")
+
+validate_host = _try_env("VALIDATE_HOST", "127.0.0.1")
+validate_port = _try_env_int("VALIDATE_PORT", "8081")
+validate_socket = _try_env("VALIDATE_SOCKET", "")
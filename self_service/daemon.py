@@ -0,0 +1,294 @@
+"""Long running mode: watch the customer config dir and re-apply on change.
+
+The vault client and the flattened state of every file stay in memory. When
+files change, the burst of changes is debounced, then only the changed files
+are parsed and only the groups, approles and policies they affect are applied.
+Invalid files are reported and skipped, without holding back the others.
+
+Changes are detected with inotify where available (Linux), and by polling
+the directory otherwise. /healthz and /readyz are served on DAEMON_HEALTH_PORT
+for an orchestrator.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from os import path
+
+from . import config, log, metrics, ratelimit, translate
+from .httpjson import JSONHandler
+from .self_service import (
+    get_customer_files, stream_customer_configs, apply_flat_configs, vault_client,
+)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+def snapshot(customer_files):
+    """Identify the current version of every file, without reading it."""
+    result = {}
+    for customer_file in customer_files:
+        try:
+            stat = os.stat(customer_file)
+        except FileNotFoundError:
+            continue
+        result[path.abspath(customer_file)] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    return result
+
+class PollingWatcher():
+    """Wake up every DAEMON_POLL_SECONDS and report whether the directory changed."""
+    def __init__(self, directory):
+        self.directory = directory
+        self._last = snapshot(get_customer_files())
+
+    def wait(self, timeout):
+        """Sleep up to timeout seconds, returning True if anything changed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            current = snapshot(get_customer_files())
+            if current != self._last:
+                self._last = current
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(remaining, config.daemon_poll_seconds))
+
+    def close(self):
+        """Nothing to release."""
+
+class InotifyWatcher():
+    """Block on inotify events for the directory. Events are only used as a
+    wake up call, the actual changes are found by comparing snapshots."""
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self._fd, directory.encode(), self.MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+        self.directory = directory
+
+    def wait(self, timeout):
+        """Block up to timeout seconds, returning True if any event arrived."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self._fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        """Release the inotify file descriptor."""
+        os.close(self._fd)
+
+def make_watcher(directory):
+    """Use inotify when possible, and fall back to polling."""
+    if config.customer_config_recursive:
+        # inotify only watches a single directory
+        log.debug("Polling %s and its subdirectories", directory)
+        return PollingWatcher(directory)
+    try:
+        watcher = InotifyWatcher(directory)
+        log.debug("Watching %s with inotify", directory)
+        return watcher
+    except (OSError, AttributeError) as err:
+        log.warning("Falling back to polling %s: %s", directory, err)
+        return PollingWatcher(directory)
+
+def _fold_valid(index, customer_files):
+    """Fold the valid files into index, skipping invalid ones.
+
+    Returns (affected targets, error message of the invalid files or None)."""
+    affected = set()
+    try:
+        for customer_file, customer_config in stream_customer_configs(customer_files):
+            with metrics.phase("flatten"):
+                affected |= index.update(path.abspath(customer_file), customer_config)
+    except ValueError as err:
+        return affected, str(err)
+    return affected, None
+
+class Daemon():
+    """Warm state shared between the watch loop and the health server."""
+
+    def __init__(self):
+        self.client = None
+        self.index = None
+        self.files = {}
+        # What status() reports, besides the heartbeat
+        self.health = { "ready": False, "last_success": None, "last_error": None }
+        self.heartbeat = time.monotonic()
+        self.stopping = threading.Event()
+
+    def _apply(self, flat, partial=False):
+        if config.only_validate:
+            log.debug("Validation complete.")
+            return True
+        if self.client is None:
+            self.client = vault_client()
+        return apply_flat_configs(flat, self.client, partial)
+
+    def full_reconcile(self):
+        """Parse every file and apply every valid one.
+
+        Returns (success, error message of the invalid files or None)."""
+        customer_files = get_customer_files()
+        files = snapshot(customer_files)
+        index = translate.FlatIndex()
+        _, invalid = _fold_valid(index, customer_files)
+        with metrics.phase("flatten"):
+            flat_configs = index.flatten()
+        # The objects of invalid files are missing, they must not be pruned
+        success = self._apply(flat_configs, partial=invalid is not None)
+        self.index = index
+        self.files = files
+        return success, invalid
+
+    def incremental_reconcile(self):
+        """Parse the files that changed since the last reconcile, and apply what they affect.
+
+        Invalid files keep what they last applied, and are skipped until they
+        change again. Returns None if nothing changed, like full_reconcile otherwise."""
+        files = snapshot(get_customer_files())
+        changed = sorted(f for f, v in files.items() if self.files.get(f) != v)
+        deleted = sorted(f for f in self.files if f not in files)
+        if not changed and not deleted:
+            return None
+        log.log("Changed files:\n%s", "\n".join(changed + deleted))
+
+        affected = set()
+        with metrics.phase("flatten"):
+            for customer_file in deleted:
+                affected |= self.index.remove(customer_file)
+        updated, invalid = _fold_valid(self.index, changed)
+        affected |= updated
+        self.files = files
+        log.debug("Applying %d affected targets", len(affected))
+        with metrics.phase("flatten"):
+            flat_configs = self.index.flatten(affected)
+        return self._apply(flat_configs, partial=True), invalid
+
+    def reconcile(self, full=False):
+        """Reconcile and record the outcome for the health endpoints."""
+        metrics.reset()
+        ratelimit.reset()
+        errors = []
+        # pylint: disable=broad-except
+        try:
+            if full or self.index is None:
+                success, invalid = self.full_reconcile()
+            else:
+                result = self.incremental_reconcile()
+                if result is None:
+                    # Nothing changed, keep the metrics of the last reconcile
+                    return
+                success, invalid = result
+            self.health["ready"] = True
+            if invalid is not None:
+                log.critical(invalid)
+                errors.append(invalid)
+            if not success:
+                errors.append("Failed to apply one or more objects")
+                # Retry everything, rather than only what changes next
+                self.index = None
+        except Exception as err:
+            # Anything else leaves the server in an unknown state, so start over
+            log.critical(err)
+            errors.append(str(err))
+            self.index = None
+        self.health["last_error"] = "\n".join(errors) or None
+        self.health["last_success"] = not errors
+        if not errors:
+            log.log("Reconcile complete.")
+        metrics.write()
+        log.flush()
+
+    def status(self):
+        """Health summary as a dict."""
+        return {
+            **self.health,
+            "seconds_since_heartbeat": round(time.monotonic() - self.heartbeat, 1),
+        }
+
+    def run(self):
+        """Watch for changes until stopped."""
+        watcher = make_watcher(config.customer_config_dir)
+        try:
+            self.reconcile(full=True)
+            while not self.stopping.is_set():
+                self.heartbeat = time.monotonic()
+                if not watcher.wait(config.daemon_poll_seconds):
+                    if self.index is None:
+                        self.reconcile(full=True)
+                    continue
+                # Let a burst of changes (e.g. a git checkout) settle first
+                while watcher.wait(config.daemon_debounce_seconds):
+                    if self.stopping.is_set():
+                        return
+                self.reconcile()
+        finally:
+            watcher.close()
+
+def _health_handler(daemon):
+    class _Handler(JSONHandler):
+        # pylint: disable=invalid-name
+        def do_GET(self):
+            """Serve /healthz (loop is alive) and /readyz (initial apply done)."""
+            status = daemon.status()
+            if self.path == "/healthz":
+                # The loop wakes up at least every poll interval, plus time to reconcile
+                healthy = status["seconds_since_heartbeat"] < \
+                    config.daemon_poll_seconds + config.vault_read_timeout * 10
+                code = 200 if healthy else 503
+            elif self.path == "/readyz":
+                code = 200 if status["ready"] else 503
+            else:
+                code = 404
+            self.reply(code, status)
+    return _Handler
+
+def main():
+    """Run until SIGTERM or SIGINT."""
+    daemon = Daemon()
+
+    def _stop(*_):
+        log.log("Stopping.")
+        daemon.stopping.set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    server = ThreadingHTTPServer(("", config.daemon_health_port), _health_handler(daemon))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        daemon.run()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,122 @@
+"""Check that the groups customers name exist in LDAP.
+
+Group names must match an LDAP group exactly to be of any use, and a typo
+otherwise only shows up as a vault group mapping nobody is a member of.
+
+Groups are looked up in a snapshot of the directory, LDAP_GROUPS_FILE:
+
+* an LDIF export, e.g. from
+  ldapsearch -LLL '(objectClass=groupOfNames)' cn > groups.ldif
+  where the group name is the LDAP_GROUP_ATTRIBUTE (default cn) of each entry,
+* or a local stand-in with one group name per line, for tests or directories
+  that cannot be exported as LDIF.
+
+The whole snapshot is loaded in one pass the first time a run needs it, and
+every group and accessor group of every file is then checked in memory, so
+thousands of groups cost one read instead of one query each. Long running
+processes (daemon, validator) reload it once it is LDAP_GROUPS_TTL seconds
+old and the file has changed. Names are compared ignoring case, like LDAP
+compares cn.
+"""
+import base64
+import os
+import threading
+import time
+
+from . import config, log
+
+_lock = threading.Lock()
+# names, loaded (monotonic time), mtime of the file and path, once loaded
+_snapshot = {}
+
+def enabled():
+    """Whether a directory snapshot is configured."""
+    return bool(config.ldap_groups_file)
+
+def _entries(lines):
+    """Yield each LDIF entry as a list of (attribute, value)."""
+    entry = []
+    logical = None
+    for line in lines + [""]:
+        line = line.rstrip("\r\n")
+        if line.startswith(" ") and logical is not None:
+            # Folded line, continued without the leading space
+            logical += line[1:]
+            continue
+        if logical is not None:
+            entry.append(logical)
+            logical = None
+        if line.startswith("#"):
+            continue
+        if line == "":
+            if entry:
+                yield [_attribute(item) for item in entry]
+            entry = []
+            continue
+        logical = line
+
+def _attribute(line):
+    attribute, _, value = line.partition(":")
+    if value.startswith(":"):
+        value = base64.b64decode(value[1:].strip()).decode("utf-8")
+    else:
+        value = value.strip()
+    return attribute.strip().lower(), value
+
+def parse_snapshot(text):
+    """Return the group names in an LDIF export or a one name per line list."""
+    lines = text.splitlines()
+    if not any(line.lower().startswith("dn:") for line in lines):
+        return { line.strip() for line in lines if line.strip() and not line.startswith("#") }
+    attribute = config.ldap_group_attribute.lower()
+    names = set()
+    for entry in _entries(lines):
+        names.update(value for key, value in entry if key == attribute)
+    return names
+
+def groups():
+    """The names in the directory snapshot, casefolded, loading it when needed."""
+    with _lock:
+        path = config.ldap_groups_file
+        current = _snapshot.get("path") == path
+        if current and time.monotonic() - _snapshot["loaded"] < config.ldap_groups_ttl:
+            return _snapshot["names"]
+        mtime = os.stat(path).st_mtime_ns
+        if current and _snapshot["mtime"] == mtime:
+            _snapshot["loaded"] = time.monotonic()
+            return _snapshot["names"]
+        with open(path, encoding="utf-8") as handle:
+            names = frozenset(name.casefold() for name in parse_snapshot(handle.read()))
+        _snapshot.update(names=names, loaded=time.monotonic(), mtime=mtime, path=path)
+        log.debug("Loaded %d LDAP group(s) from %s", len(names), path)
+        return names
+
+def reset():
+    """Forget the loaded snapshot."""
+    with _lock:
+        _snapshot.clear()
+
+def referenced(customer_config):
+    """Every group name a config refers to, including approle accessor groups."""
+    names = [group.name for group in customer_config.groups]
+    for approle in customer_config.approles:
+        names.extend(group.name for group in approle.accessor_groups)
+    return names
+
+def missing(names):
+    """The names, in order and without duplicates, that are not in the directory."""
+    known = groups()
+    return list(dict.fromkeys(name for name in names if name.strip().casefold() not in known))
+
+def format_missing(path, absent):
+    """The error message for the groups of a file missing from the directory."""
+    return "Error parsing '{f}', no LDAP group named {g}".format(
+        f = path,
+        g = ", ".join(f"'{name}'" for name in absent),
+    )
+
+def check(path, customer_config):
+    """Raise a ValueError naming every group of the config missing from the directory."""
+    absent = missing(referenced(customer_config))
+    if absent:
+        raise ValueError(format_missing(path, absent))
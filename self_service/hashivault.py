@@ -1,168 +1,410 @@
 """Connect to a Hashicorp Vault server and apply group/approle/policy configurations."""
+import functools
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import hvac
+from hvac import exceptions
+from hvac.exceptions import InvalidPath
 
-from . import config, log
+from . import auth, config, log, metrics, reconcile, scheduler, transport
+from .parse import Capability
 
 non_kv_roots = [
     "auth",
     "sys"
 ]
 
-def _success(res):
-    return res.status_code >= 200 and res.status_code <= 299
+# hvac raises these for responses with an error status, without the status
+ERROR_STATUSES = [
+    (exceptions.InvalidRequest, 400),
+    (exceptions.Unauthorized, 401),
+    (exceptions.Forbidden, 403),
+    (exceptions.InvalidPath, 404),
+    (exceptions.RateLimitExceeded, 429),
+    (exceptions.InternalServerError, 500),
+    (exceptions.VaultNotInitialized, 501),
+    (exceptions.BadGateway, 502),
+    (exceptions.VaultDown, 503),
+]
+
+def _error_status(err):
+    for error, status in ERROR_STATUSES:
+        if isinstance(err, error):
+            return status
+    return "error"
+
+def _write(target, send, **kwargs):
+    """Send a write with hvac and log its outcome, with vault's answer if it failed."""
+    kind, name = target
+    start = time.perf_counter()
+    try:
+        res = send(**kwargs)
+    except exceptions.VaultError as err:
+        log.record(kind, name, _error_status(err), time.perf_counter() - start)
+        log.critical("Failed to apply %s %s: %s", kind, name, err.text or err)
+        return False
+    # hvac returns the decoded body of responses that have one
+    log.record(kind, name, getattr(res, "status_code", 200), time.perf_counter() - start)
+    return True
 
 def _create_or_update_group(client, name, policy_name):
-    res = client.auth.ldap.create_or_update_group(
+    return _write(("group", name), client.auth.ldap.create_or_update_group,
         name = name,
         policies = [ policy_name ],
     )
-    log.debug(name, res)
-    if not _success(res):
-        log.critical(f"Failed to apply group {name}")
-        log.critical(res)
-        log.critical(res.headers)
-        log.critical(res.text)
-        return False
-    return True
 
 def _create_or_update_approle(client, name, policy_name):
-    res = client.write(
+    return _write(("approle", name), client.write,
         path = f"auth/approle/role/{name}",
         policies = [ policy_name ],
     )
-    log.debug(name, res)
-    if not _success(res):
-        log.critical(f"Failed to apply approle {name}")
-        log.critical(res)
-        log.critical(res.headers)
-        log.critical(res.text)
-        return False
-    return True
 
 def _create_or_update_policy(client, name, policy):
-    res = client.sys.create_or_update_policy(
+    return _write(("policy", name), client.sys.create_or_update_policy,
         name = name,
-        # This dumpster fire of an object format is still better than templating hcl. The exact
-        # format is found by running: policy = client.get_policy('mypolicy', parse=True)
-        #
-        # The policy object should look like:
-        #
-        #    { 'path': {
-        #        'foobar/*': { 'capabilities': ['read', 'list'] },
-        #        'foobaz/*': { 'capabilities': ['read', 'list', 'update'] },
-        #    }}
-        #
-        # Sort capabilities to enable mock testing.
-        #
-        policy = {
-            "path": { p: { "capabilities": sorted(c)} for p, c in policy.items() }
+        policy = reconcile.render_policy(policy),
+    )
+
+def _read_group(client, name):
+    """Read the policies currently attached to an LDAP group, or None if it is missing."""
+    try:
+        res = client.auth.ldap.read_group(name=name)
+        return list(res['data']['policies'])
+    except (InvalidPath, TypeError, KeyError):
+        return None
+
+def _read_approle(client, name):
+    """Read the policies currently attached to an approle, or None if it is missing."""
+    try:
+        res = client.read(f"auth/approle/role/{name}")
+        return list(res['data']['token_policies'])
+    except (InvalidPath, TypeError, KeyError):
+        return None
+
+def _read_policy(client, name):
+    """Read a policy as { path: capabilities }, or None if it is missing.
+
+    Policies are written as json, so anything that does not parse as json, or
+    uses capabilities customers cannot grant, was written by someone else and
+    is treated as missing."""
+    try:
+        res = client.sys.read_policy(name=name)
+        rules = json.loads(res['data']['rules'])
+        return { p: Capability.from_names(r['capabilities']) for p, r in rules['path'].items() }
+    except (InvalidPath, TypeError, KeyError, AttributeError, ValueError):
+        return None
+
+def read_state(client, desired):
+    """Read the current server state of every object in the desired state."""
+    readers = {
+        "groups": _read_group,
+        "approles": _read_approle,
+        "policies": _read_policy,
+    }
+    with ThreadPoolExecutor(max_workers=config.apply_concurrency) as pool:
+        return {
+            kind: dict(zip(
+                desired[kind],
+                pool.map(functools.partial(reader, client), desired[kind]),
+            ))
+            for kind, reader in readers.items()
         }
+
+# Where each kind of object is listed and deleted
+OBJECT_PATHS = {
+    "groups": "auth/ldap/groups",
+    "approles": "auth/approle/role",
+    "policies": "sys/policies/acl",
+}
+
+def _list(client, kind):
+    """Names of every object of one kind on the server."""
+    try:
+        res = client.list(OBJECT_PATHS[kind])
+        return list(res['data']['keys'])
+    except (InvalidPath, TypeError, KeyError):
+        return []
+
+def _attached(current, policy_name):
+    """Whether a group or approle is attached to exactly one policy, policy_name."""
+    return current is not None and [p.lower() for p in current] == [policy_name.lower()]
+
+def _owns_path(path, prefix, approles):
+    """Whether a policy path is one this customer's configs can grant.
+
+    Accessor group paths name an approle, which may belong to a longer prefix
+    ('foo-bar-app' of prefix 'foo-bar'), so it must be one of approles."""
+    parts = path.split('/')
+    if parts[:3] == ["auth", "approle", "role"]:
+        return len(parts) > 3 and parts[3].lower() in approles
+    return parts[0] == prefix
+
+def _owned_policy(policy, prefix, approles=frozenset()):
+    """Whether a policy grants something, and only paths this customer's configs can grant.
+
+    An empty policy could have been written for any prefix, so it is not owned."""
+    return bool(policy) and all(_owns_path(path, prefix, approles) for path in policy)
+
+def _owned_policies(pool, read_policy, names, prefix, approles):
+    """The policies out of names that are owned by prefix, see _owned_policy."""
+    read = pool.map(read_policy, names)
+    return [n for n, policy in zip(names, read) if _owned_policy(policy, prefix, approles)]
+
+def _attached_objects(pool, read_object, policy_start, policies, listed):
+    """The listed objects named after one of policies, and attached to nothing else."""
+    by_name = { n.lower(): n for n in listed }
+    names = [
+        by_name[n.lower()[len(policy_start):]] for n in policies
+        if n.lower()[len(policy_start):] in by_name
+    ]
+    attached = pool.map(lambda n: _attached(read_object(n), f"{policy_start}{n}"), names)
+    return [n for n, ok in zip(names, attached) if ok]
+
+def find_orphans(client, desired, customer_prefix=None):
+    """Objects of the customer prefix that are on the server, but not in desired.
+
+    desired maps each kind to the names to keep. Vault lowercases some names,
+    so names are compared case insensitively. A name alone does not prove
+    ownership (prefix 'foo' also matches the objects of prefix 'foo-bar'), so
+    only policies that grant nothing but this prefix's paths are orphans, and
+    only the groups and approles attached to exactly one of those policies.
+    customer_prefix defaults to CUSTOMER_PREFIX. Returns { kind: [name] }."""
+    prefix = customer_prefix or config.customer_prefix
+    keep = { kind: { n.lower() for n in names } for kind, names in desired.items() }
+    read_policy = functools.partial(_read_policy, client)
+
+    with ThreadPoolExecutor(max_workers=config.apply_concurrency) as pool:
+        listed = dict(zip(
+            OBJECT_PATHS, pool.map(functools.partial(_list, client), OBJECT_PATHS),
+        ))
+        candidates = [n for n in listed["policies"] if n.lower() not in keep["policies"]]
+        # Approle policies come first, accessor groups may only grant their approles
+        approle_policies = _owned_policies(pool, read_policy, [
+            n for n in candidates if n.lower().startswith(f"approle-{prefix}-".lower())
+        ], prefix, frozenset())
+        approles = _attached_objects(pool, functools.partial(_read_approle, client),
+            "approle-", approle_policies, listed["approles"])
+        group_policies = _owned_policies(pool, read_policy, [
+            n for n in candidates if n.lower().startswith(f"group-{prefix}-".lower())
+        ], prefix, keep["approles"] | { n.lower() for n in approles })
+        # LDAP group names do not carry the prefix, find them through their policy
+        groups = _attached_objects(pool, functools.partial(_read_group, client),
+            f"group-{prefix}-", group_policies, listed["groups"])
+    return {
+        "groups": groups,
+        "approles": approles,
+        "policies": [n for n in candidates if n in group_policies or n in approle_policies],
+    }
+
+def _delete(client, kind, name):
+    return _write((f"{reconcile.SINGULAR[kind]} deletion", name), client.adapter.delete,
+        url = f"/v1/{OBJECT_PATHS[kind]}/{name}",
     )
-    log.debug(name, res)
-    if not _success(res):
-        log.critical(f"Failed to apply policy {name}")
-        log.critical(res)
-        log.critical(res.headers)
-        log.critical(res.text)
+
+def delete_orphans(client, orphans, customer_prefix=None):
+    """Delete objects found by find_orphans, groups and approles before their policies.
+
+    Nothing is deleted when there are more than PRUNE_MAX_DELETIONS of them,
+    which more likely means configs went missing than that they were removed."""
+    total = sum(len(names) for names in orphans.values())
+    if total > config.prune_max_deletions:
+        log.critical(
+            "Refusing to delete %d objects, more than PRUNE_MAX_DELETIONS (%d):\n%s",
+            total, config.prune_max_deletions, reconcile.format_deletions(orphans),
+        )
         return False
-    return True
+    if total == 0:
+        return True
+    log.log(reconcile.format_deletions(orphans))
+
+    tasks = {}
+    dependencies = {}
+    for kind in reconcile.KINDS:
+        for name in orphans[kind]:
+            tasks[(reconcile.SINGULAR[kind], name)] = functools.partial(
+                _delete, client, kind, name,
+            )
+    policies = { n.lower(): ("policy", n) for n in orphans["policies"] }
+    prefix = customer_prefix or config.customer_prefix
+    attached = [("group", n, f"group-{prefix}-{n}") for n in orphans["groups"]] \
+        + [("approle", n, f"approle-{n}") for n in orphans["approles"]]
+    for kind, name, policy_name in attached:
+        if policy_name.lower() in policies:
+            dependencies.setdefault(policies[policy_name.lower()], []).append((kind, name))
+    results = scheduler.run(tasks, dependencies, config.apply_concurrency)
+    metrics.count("deletes", len(results))
+    metrics.count("failed_deletes", len([r for r in results.values() if not r]))
+    return all(results.values())
 
 def _create_path_placeholder(client, path):
     log.log("Path placeholders not implemented yet")
-    log.log(client, path)
+    log.log("%s %s", client, path)
+
+# Capabilities on the base path (what you would put in a GET request) become
+# capabilities on special sub-paths, like this
+#
+#        read @ customer/foo/*  -->
+#
+#        read @ customer/data/foo/*
+#     +  read @ customer/metadata/foo/*
+#
+CAPABILITY_PREFIX_MAP = {
+    Capability.CREATE: [
+        { 'prefix': 'data',     'capability': Capability.CREATE },
+    ],
+    Capability.READ: [
+        { 'prefix': 'data',     'capability': Capability.READ },
+    ],
+    Capability.UPDATE: [
+        { 'prefix': 'data',     'capability': Capability.UPDATE },
+    ],
+    Capability.DELETE: [
+        { 'prefix': 'data',     'capability': Capability.DELETE },
+        { 'prefix': 'delete',   'capability': Capability.UPDATE },
+        { 'prefix': 'destroy',  'capability': Capability.UPDATE },
+        { 'prefix': 'undelete', 'capability': Capability.UPDATE },
+        { 'prefix': 'metadata', 'capability': Capability.DELETE },
+    ],
+    Capability.LIST: [
+        { 'prefix': 'metadata', 'capability': Capability.LIST | Capability.READ },
+    ],
+    Capability.DENY: [
+        { 'prefix': 'data',     'capability': Capability.DENY },
+    ],
+}
+
+@functools.lru_cache(maxsize=None)
+def _kv_v2_prefixes(capabilities):
+    """The (prefix, capabilities) sub-paths for a capability bitmask."""
+    prefixes = {}
+    for cap, mapped in CAPABILITY_PREFIX_MAP.items():
+        if capabilities & cap:
+            for pol in mapped:
+                prefixes[pol['prefix']] = prefixes.get(pol['prefix'], 0) | pol['capability']
+    return tuple((prefix, Capability(caps)) for prefix, caps in prefixes.items())
 
 def _mangle_kv_v2_policy(policies):
     """Apply reasonable set of transformations, per the
        strange behavior here: https://www.vaultproject.io/docs/secrets/kv/kv-v2#acl-rules"""
-    # Convert capability on the base path (what you would put in a GET request), to a set of
-    # capabilities on special sub-paths, like this
-    #
-    #        read @ customer/foo/*  -->
-    #
-    #        read @ customer/data/foo/*
-    #     +  read @ customer/metadata/foo/*
-    #
-    capability_prefix_map = {
-        'create': [
-            { 'prefix': 'data',     'capability': 'create' },
-        ],
-        'read': [
-            { 'prefix': 'data',     'capability': 'read' },
-        ],
-        'update': [
-            { 'prefix': 'data',     'capability': 'update' },
-        ],
-        'delete': [
-            { 'prefix': 'data',     'capability': 'delete' },
-            { 'prefix': 'delete',   'capability': 'update' },
-            { 'prefix': 'destroy',  'capability': 'update' },
-            { 'prefix': 'undelete', 'capability': 'update' },
-            { 'prefix': 'metadata', 'capability': 'delete' },
-        ],
-        'list': [
-            { 'prefix': 'metadata', 'capability': 'list' },
-            { 'prefix': 'metadata', 'capability': 'read' },
-        ],
-        'deny': [
-            { 'prefix': 'data',     'capability': 'deny' },
-        ],
-    }
     new_policies = {}
     for path, capabilities in policies.items():
-        path_sections = path.split('/')
+        root, sep, rest = path.partition('/')
 
         # Don't mangle system (non kv) paths
-        if path_sections[0] in non_kv_roots:
+        if root in non_kv_roots:
             new_policies[path] = capabilities
-        else:
-            for cap in capabilities:
-                for pol in capability_prefix_map[cap]:
+            continue
 
-                    # customer/foo/* -> customer/prefix/foo/*
-                    new_path = path_sections.copy()
-                    new_path.insert(1, pol['prefix'])
-                    new_path = '/'.join(new_path)
+        for prefix, mapped in _kv_v2_prefixes(capabilities):
+            # customer/foo/* -> customer/prefix/foo/*
+            new_path = sys.intern(f"{root}/{prefix}{sep}{rest}")
+            existing = new_policies.get(new_path)
+            new_policies[new_path] = mapped if existing is None else existing | mapped
+    return new_policies
 
-                    if new_path not in new_policies:
-                        new_policies[new_path] = set()
+def _apply_threaded(client, groups, approles, policies):
+    """Write every object on the thread pool, returning { (kind, name): success }."""
+    tasks = {}
+    dependencies = {}
+    for name, policy in policies.items():
+        tasks[("policy", name)] = functools.partial(
+            _create_or_update_policy, client, name, policy,
+        )
+    # Write policies before the groups and approles that reference them, so a
+    # group is never pointed at a policy that does not exist yet.
+    for name, policy_name in groups.items():
+        tasks[("group", name)] = functools.partial(
+            _create_or_update_group, client, name, policy_name,
+        )
+        dependencies[("group", name)] = [("policy", policy_name)]
+    for name, policy_name in approles.items():
+        tasks[("approle", name)] = functools.partial(
+            _create_or_update_approle, client, name, policy_name,
+        )
+        dependencies[("approle", name)] = [("policy", policy_name)]
+    return scheduler.run(tasks, dependencies, config.apply_concurrency)
 
-                    new_policies[new_path].add(
-                        pol['capability']
-                    )
-    return new_policies
+def get_client(pool_size=None):
+    """Build a vault client and authenticate it with the configured credentials.
 
-# pylint: disable=unused-argument,fixme
-# todo: implement path placeholding
-def apply_flat_config(groups, approles, policies, paths):
-    """Loop through flattened configuration and apply it to a running server."""
-    client = hvac.Client(config.vault_addr)
+    The connection pool holds pool_size connections, by default one per apply worker."""
+    client = hvac.Client(
+        config.vault_addr,
+        session=transport.build_session(pool_size or config.apply_concurrency),
+        timeout=transport.timeout(),
+    )
+    auth.authenticate(client)
 
-    client.token = config.vault_token
-    if not client.is_authenticated():
-        client.auth_approle(config.vault_role_id, config.vault_role_secret)
+    log.debug("Authenticated with vault server %s", config.vault_addr)
+    return client
 
-    log.debug("Authenticated with vault server {s}".format(
-        s=config.vault_addr
-    ))
+# pylint: disable=unused-argument,fixme,too-many-arguments
+# todo: implement path placeholding
+def apply_flat_config(groups, approles, policies, paths, client=None, prune=False,
+        customer_prefix=None):
+    """Loop through flattened configuration and apply it to a running server.
 
-    success = True
+    An already authenticated client may be passed in to share it between runs.
+    With prune, objects of the customer prefix (customer_prefix, or
+    CUSTOMER_PREFIX) that are not in this configuration are deleted, once
+    everything else was applied."""
+    if client is None:
+        client = get_client()
+    else:
+        # Long lived clients may need their token renewed
+        auth.authenticate(client)
 
-    for name, policy in groups.items():
-        log.debug(f"Applying group {name}")
-        if not _create_or_update_group(client, name, policy):
-            success = False
+    with metrics.phase("mangle"):
+        desired = {
+            "groups": { n: [p] for n, p in groups.items() },
+            "approles": { n: [p] for n, p in approles.items() },
+            "policies": { n: _mangle_kv_v2_policy(p) for n, p in policies.items() },
+        }
+    names = { kind: list(desired[kind]) for kind in reconcile.KINDS }
 
-    for name, policy in approles.items():
-        log.debug(f"Applying approle {name}")
-        if not _create_or_update_approle(client, name, policy):
-            success = False
+    if config.diff_apply or config.plan_only:
+        with metrics.phase("read"):
+            current = read_state(client, desired)
+        changes = reconcile.plan(desired, current)
+        if config.plan_only:
+            log.log(reconcile.format_plan(changes))
+            if prune:
+                log.log(reconcile.format_deletions(
+                    find_orphans(client, names, customer_prefix),
+                ))
+            return True
+        if log.enabled(log.DEBUG):
+            log.debug(reconcile.format_plan(changes))
+        desired = { k: { n: w for n, (_, w) in changes[k].items() } for k in reconcile.KINDS }
 
-    for name, policy in policies.items():
-        log.debug(f"Applying policy {name}")
-        if not _create_or_update_policy(client, name, _mangle_kv_v2_policy(policy)):
-            success = False
+    groups = { n: groups[n] for n in desired["groups"] }
+    approles = { n: approles[n] for n in desired["approles"] }
+    log.debug("Applying %d objects", len(groups) + len(approles) + len(desired["policies"]))
+    with metrics.phase("write"):
+        if config.apply_backend == "asyncio":
+            # Only imported by runs that use asyncio
+            # pylint: disable=import-outside-toplevel
+            from . import asyncvault
+            results = asyncvault.apply(client.token, groups, approles, desired["policies"])
+        else:
+            results = _apply_threaded(client, groups, approles, desired["policies"])
+    log.debug("Vault connections: %s", transport.stats)
+    metrics.count("writes", len(results))
+    metrics.count("failed_writes", len([r for r in results.values() if not r]))
 
     #for path in paths:
         #_create_path_placeholder(client, path)
 
+    success = all(results.values())
+    if prune:
+        if not success:
+            log.critical("Not pruning, since some objects failed to apply")
+            return False
+        with metrics.phase("prune"):
+            success = delete_orphans(
+                client, find_orphans(client, names, customer_prefix), customer_prefix,
+            )
     return success
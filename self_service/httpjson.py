@@ -0,0 +1,21 @@
+"""HTTP request handler for the JSON endpoints of the daemon and the validator."""
+import json
+from http.server import BaseHTTPRequestHandler
+
+class JSONHandler(BaseHTTPRequestHandler):
+    """Answer requests with JSON documents, without logging each request."""
+
+    def reply(self, code, document, close=False):
+        """Send document as the response, then close the connection if close is set."""
+        body = json.dumps(document).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if close:
+            # Also makes the handler close the connection once this is sent
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
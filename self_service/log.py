@@ -1,16 +1,166 @@
-"""Print stuff unless it shouldn't"""
+"""Level based, buffered logging, as plain text or JSON lines.
+
+Messages use %-style arguments, which are only formatted once a record is
+actually going to be written:
+
+    log.debug("Applying %s objects", count)
+
+Records are collected in a buffer and written to stdout in batches of
+LOG_BUFFER_LINES, when a critical record is logged, and at exit. Worker
+processes `hold` their records instead, and hand them to the parent process
+with `drain`, which writes them with `extend`: workers exit without running
+atexit handlers. With
+LOG_FORMAT=json every record is one json object per line, carrying any
+keyword fields passed to it and those set with `context`, e.g. the tenant.
+"""
+import atexit
+import contextvars
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
 from . import config
 
-def log(*msg, **kwargs):
-    """Print msg unless quiet"""
-    if not config.quiet:
-        print(*msg, **kwargs)
+DEBUG = 10
+INFO = 20
+WARNING = 30
+CRITICAL = 50
+
+LEVELS = {
+    "debug": DEBUG,
+    "info": INFO,
+    "warning": WARNING,
+    "critical": CRITICAL,
+}
+_NAMES = { num: name for name, num in LEVELS.items() }
+
+_context = contextvars.ContextVar("log_context", default={})
+# Reentrant, so a signal handler can log while the main thread is flushing
+_lock = threading.RLock()
+_buffer = []
+# Set in worker processes, which never write records themselves
+_held = threading.Event()
 
-def debug(*msg, **kwargs):
-    """Print msg if verbose"""
+def threshold():
+    """The lowest level that is written.
+
+    LOG_LEVEL wins if set, otherwise QUIET and VERBOSE decide, as they always have."""
+    if config.log_level:
+        return LEVELS[config.log_level]
+    if config.quiet:
+        return CRITICAL
     if config.verbose:
-        print(*msg, **kwargs)
+        return DEBUG
+    return INFO
+
+def enabled(level):
+    """Whether records at level would be written. Use it to skip expensive arguments."""
+    return level >= threshold()
+
+@contextmanager
+def context(**fields):
+    """Add fields to every record logged inside the block, in this thread or task.
+
+    Thread pools do not inherit the context by themselves; submit work with
+    contextvars.copy_context().run to carry it over."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def _format(msg, args):
+    msg = str(msg)
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except (TypeError, ValueError):
+        return " ".join([msg, *[str(a) for a in args]])
+
+def _render(level, msg, args, fields):
+    text = _format(msg, args)
+    if config.log_format != "json":
+        return text
+    entry = {
+        "time": round(time.time(), 6),
+        "level": _NAMES[level],
+        "tenant": config.customer_prefix,
+        **_context.get(),
+        **fields,
+        "msg": text,
+    }
+    return json.dumps(entry, default=str)
+
+def _flush_locked():
+    if _buffer:
+        sys.stdout.write("\n".join(_buffer) + "\n")
+        sys.stdout.flush()
+        _buffer.clear()
+
+def flush():
+    """Write out every buffered record."""
+    with _lock:
+        _flush_locked()
+
+atexit.register(flush)
+
+def hold():
+    """Keep every record in the buffer until it is drained, in a worker process."""
+    _held.set()
+
+def drain():
+    """Remove and return the buffered records, rendered."""
+    with _lock:
+        lines = list(_buffer)
+        _buffer.clear()
+        return lines
+
+def extend(lines):
+    """Buffer records rendered by drain in another process."""
+    with _lock:
+        _buffer.extend(lines)
+        if len(_buffer) >= config.log_buffer_lines and not _held.is_set():
+            _flush_locked()
+
+def emit(level, msg, *args, **fields):
+    """Log msg % args at level, with extra fields for json output."""
+    if level < threshold():
+        return
+    line = _render(level, msg, args, fields)
+    with _lock:
+        _buffer.append(line)
+        if _held.is_set():
+            return
+        if level >= CRITICAL or len(_buffer) >= config.log_buffer_lines:
+            _flush_locked()
+
+def debug(msg, *args, **fields):
+    """Log details, shown if verbose"""
+    emit(DEBUG, msg, *args, **fields)
+
+def log(msg, *args, **fields):
+    """Log progress, shown unless quiet"""
+    emit(INFO, msg, *args, **fields)
+
+def warning(msg, *args, **fields):
+    """Log something that did not stop the run, shown unless quiet"""
+    emit(WARNING, msg, *args, **fields)
+
+def critical(msg, *args, **fields):
+    """Log a failure, always shown"""
+    emit(CRITICAL, msg, *args, **fields)
+
+def record(kind, name, status, latency, **fields):
+    """Log the outcome of writing one vault object.
 
-def critical(*msg, **kwargs):
-    """Print msg"""
-    print(*msg, **kwargs)
+    Successful writes are logged at debug level, failures at critical."""
+    success = isinstance(status, int) and 200 <= status <= 299
+    emit(
+        DEBUG if success else CRITICAL,
+        "%s %s: %s in %.1fms", kind, name, status, latency * 1000,
+        kind=kind, name=name, status=status, latency=round(latency, 6),
+        **fields,
+    )
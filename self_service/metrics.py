@@ -0,0 +1,192 @@
+"""Record where a run spends its time, and write it out at the end.
+
+Phases (scan, parse, flatten, mangle, read, write) are timed with `phase`,
+every vault request is recorded by the transport layer with `observe`, and
+`count` tracks objects and retries. At the end of a run, `write` saves a
+Prometheus textfile (METRICS_PROMETHEUS_FILE, for node_exporter's textfile
+collector) and/or a JSON summary (METRICS_JSON_FILE).
+"""
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from . import config
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Collapse object names out of vault paths, to keep label cardinality bounded
+ENDPOINTS = [
+    (re.compile(r"^/v1/auth/ldap/groups/.+"), "/v1/auth/ldap/groups/:name"),
+    (re.compile(r"^/v1/auth/approle/role/[^/]+/.+"), "/v1/auth/approle/role/:name/:sub"),
+    (re.compile(r"^/v1/auth/approle/role/.+"), "/v1/auth/approle/role/:name"),
+    (re.compile(r"^/v1/sys/policy/.+"), "/v1/sys/policy/:name"),
+    (re.compile(r"^/v1/sys/policies/acl/.+"), "/v1/sys/policies/acl/:name"),
+]
+
+_lock = threading.Lock()
+
+# pylint: disable=too-few-public-methods
+class _Histogram():
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add one observation."""
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+# pylint: disable=too-few-public-methods
+class _Metrics():
+    def __init__(self):
+        self.started = time.time()
+        self.phases = defaultdict(float)
+        self.latency = defaultdict(_Histogram)
+        self.responses = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        self.counts = defaultdict(int)
+
+_metrics = _Metrics()
+
+def reset():
+    """Start recording a new run."""
+    global _metrics # pylint: disable=global-statement,invalid-name
+    with _lock:
+        _metrics = _Metrics()
+
+def endpoint(method, path):
+    """Label a request by method and path template."""
+    path = path.split("?")[0]
+    for pattern, template in ENDPOINTS:
+        if pattern.match(path):
+            return f"{method} {template}"
+    return f"{method} {path}"
+
+@contextmanager
+def phase(name):
+    """Time a phase of the run. Repeated phases (e.g. per tenant) add up."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _metrics.phases[name] += elapsed
+
+# pylint: disable=too-many-arguments
+def observe(method, path, seconds, status, bytes_sent=0):
+    """Record one vault request. status is the HTTP status, or 'error'."""
+    label = endpoint(method, path)
+    with _lock:
+        _metrics.latency[label].observe(seconds)
+        _metrics.responses[(label, str(status))] += 1
+        _metrics.bytes_sent[label] += bytes_sent
+
+def count(name, amount=1):
+    """Add to a counter, e.g. objects applied or retries."""
+    with _lock:
+        _metrics.counts[name] += amount
+
+def summary():
+    """Everything recorded so far, as a json serializable dict."""
+    with _lock:
+        return {
+            "started": _metrics.started,
+            "duration_seconds": time.time() - _metrics.started,
+            "phases": dict(_metrics.phases),
+            "counts": dict(_metrics.counts),
+            "requests": {
+                label: {
+                    "count": hist.count,
+                    "seconds_sum": hist.sum,
+                    "bytes_sent": _metrics.bytes_sent[label],
+                    "statuses": {
+                        status: num for (lbl, status), num in _metrics.responses.items()
+                        if lbl == label
+                    },
+                    "buckets": dict(zip([str(b) for b in BUCKETS], hist.buckets)),
+                }
+                for label, hist in _metrics.latency.items()
+            },
+        }
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus():
+    """Render everything recorded so far in the Prometheus text format."""
+    data = summary()
+    lines = [
+        "# HELP self_service_run_duration_seconds Duration of the last run.",
+        "# TYPE self_service_run_duration_seconds gauge",
+        "self_service_run_duration_seconds {v}".format(v=data["duration_seconds"]),
+        "# HELP self_service_last_run_timestamp_seconds Start time of the last run.",
+        "# TYPE self_service_last_run_timestamp_seconds gauge",
+        "self_service_last_run_timestamp_seconds {v}".format(v=data["started"]),
+        "# HELP self_service_phase_seconds Time spent in each phase of the last run.",
+        "# TYPE self_service_phase_seconds gauge",
+    ]
+    for name, seconds in sorted(data["phases"].items()):
+        lines.append(f'self_service_phase_seconds{{phase="{_escape(name)}"}} {seconds}')
+    lines += [
+        "# HELP self_service_count Objects, retries and other counts of the last run.",
+        "# TYPE self_service_count gauge",
+    ]
+    for name, num in sorted(data["counts"].items()):
+        lines.append(f'self_service_count{{name="{_escape(name)}"}} {num}')
+
+    lines += [
+        "# HELP self_service_vault_request_seconds Latency of vault requests.",
+        "# TYPE self_service_vault_request_seconds histogram",
+    ]
+    for label, req in sorted(data["requests"].items()):
+        labels = f'endpoint="{_escape(label)}"'
+        for bound, num in req["buckets"].items():
+            lines.append(
+                f'self_service_vault_request_seconds_bucket{{{labels},le="{bound}"}} {num}'
+            )
+        lines.append(
+            f'self_service_vault_request_seconds_bucket{{{labels},le="+Inf"}} {req["count"]}'
+        )
+        lines.append(f'self_service_vault_request_seconds_sum{{{labels}}} {req["seconds_sum"]}')
+        lines.append(f'self_service_vault_request_seconds_count{{{labels}}} {req["count"]}')
+
+    lines += [
+        "# HELP self_service_vault_responses Vault responses by status.",
+        "# TYPE self_service_vault_responses gauge",
+    ]
+    for label, req in sorted(data["requests"].items()):
+        for status, num in sorted(req["statuses"].items()):
+            lines.append('self_service_vault_responses{{endpoint="{e}",status="{s}"}} {n}'.format(
+                e=_escape(label), s=_escape(status), n=num,
+            ))
+    lines += [
+        "# HELP self_service_vault_request_bytes Bytes sent in vault request bodies.",
+        "# TYPE self_service_vault_request_bytes gauge",
+    ]
+    for label, req in sorted(data["requests"].items()):
+        lines.append('self_service_vault_request_bytes{{endpoint="{e}"}} {n}'.format(
+            e=_escape(label), n=req["bytes_sent"],
+        ))
+    return "\n".join(lines) + "\n"
+
+def _write_atomic(file_path, content):
+    tmp_file = f"{file_path}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as handle:
+        handle.write(content)
+    os.replace(tmp_file, file_path)
+
+def write():
+    """Write the configured metrics files, if any."""
+    if config.metrics_prometheus_file:
+        _write_atomic(config.metrics_prometheus_file, prometheus())
+    if config.metrics_json_file:
+        _write_atomic(config.metrics_json_file, json.dumps(summary(), indent=2) + "\n")
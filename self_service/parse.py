@@ -5,11 +5,19 @@ conventions. Provide useful error messages with as
 much context as possible to help customer fix bad
 configs.
 """
+import functools
+import json
 import re
-from enum import Enum
+import sys
+from enum import IntFlag
 
 import yaml
-from . import config, log
+# Prefer the much faster libyaml based loader, when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError: # pragma: no cover
+    from yaml import SafeLoader
+from . import cache, config, log
 
 
 # Yes, I know this returns 21th if you get that far.
@@ -24,20 +32,51 @@ def prettify_number(num):
 
     return "{}th".format(num)
 
-class Capability(Enum):
-    """Enforce which capability strings are valid."""
-    CREATE = "create"
-    READ = "read"
-    UPDATE = "update"
-    DELETE = "delete"
-    LIST = "list"
-    DENY = "deny"
+class Capability(IntFlag):
+    """Enforce which capability strings are valid.
+
+    Capabilities are bits, so a set of them is a single int that is merged
+    with |. Use parse/from_names to read them, and names to render them."""
+    CREATE = 1
+    READ = 2
+    UPDATE = 4
+    DELETE = 8
+    LIST = 16
+    DENY = 32
     # Don't let customers grant sudo permissions
-    #SUDO = "sudo"
+    #SUDO = 64
+
+    @classmethod
+    def parse(cls, name):
+        """The capability called name, e.g. 'read'."""
+        try:
+            return _CAPABILITY_BY_NAME[name]
+        except (KeyError, TypeError):
+            raise ValueError(f"{name!r} is not a valid Capability") from None
+
+    @classmethod
+    def from_names(cls, names):
+        """Combine capability names into one bitmask."""
+        # Or plain ints, flag arithmetic builds a new member every step
+        mask = 0
+        for name in names:
+            mask |= cls.parse(name).value
+        return cls(mask)
+
+    def names(self):
+        """The names of every capability in this bitmask, sorted."""
+        return list(_capability_names(int(self)))
+
+_CAPABILITY_BY_NAME = { cap.name.lower(): cap for cap in Capability }
+
+@functools.lru_cache(maxsize=None)
+def _capability_names(mask):
+    return tuple(sorted(name for name, cap in _CAPABILITY_BY_NAME.items() if mask & cap))
 
 # pylint: disable=too-few-public-methods
 class PolicyRule():
     """Represent combination of path with capabilities to be granted."""
+    __slots__ = ["path", "capabilities"]
     ALLOWED_PATH_SECTIONS = [
         # a single + character
         re.compile(r'^\+$'),
@@ -97,16 +136,18 @@ class PolicyRule():
                     p = path,
                 ))
 
-        self.path = path
+        # Many rules share a path, keep one copy of it
+        self.path = sys.intern(path)
         if capabilities is None:
             raise ValueError("Policy path '{p}' does not have any capabilities.".format(
                 p = path,
             ))
-        self.capabilities = [Capability(cap) for cap in capabilities]
+        self.capabilities = Capability.from_names(capabilities)
 
 # pylint: disable=too-few-public-methods
 class PolicyTarget():
     """Represent entity to which a policy can be applied, and its policies."""
+    __slots__ = ["name", "policies"]
     ALLOWED_NAME_PATTERN = None
     INVALID_NAME_EXPLANATION = None
     kind = None
@@ -139,6 +180,7 @@ class PolicyTarget():
 # pylint: disable=too-few-public-methods
 class Group(PolicyTarget):
     """Represent LDAP group."""
+    __slots__ = []
     # At least one of a-z, A-Z, 0-9, _, space, or -
     ALLOWED_NAME_PATTERN = re.compile(r'^[ ]*[\w\-]+[\w\- ]*$')
     INVALID_NAME_EXPLANATION = "Group names must only contain a-z, A-Z, 0-9, _, space, or -."
@@ -160,6 +202,7 @@ class Group(PolicyTarget):
 # pylint: disable=too-few-public-methods
 class AppRole(PolicyTarget):
     """Represent approle."""
+    __slots__ = ["accessor_groups"]
     # At least one of a-z, A-Z, 0-9, _ or -
     ALLOWED_NAME_PATTERN = re.compile(r'^[\w\-]+$')
     INVALID_NAME_EXPLANATION = "Approle names must only contain a-z, A-Z, 0-9, _, or -."
@@ -183,14 +226,17 @@ class AppRole(PolicyTarget):
 # pylint: disable=too-few-public-methods
 class CustomerConfig():
     """Represent partial or complete customer-defined configuration."""
+    __slots__ = ["source", "groups", "approles"]
     # Neither group nor approle array is required
     # pylint: disable=dangerous-default-value
     def __init__(self, groups=[], approles=[]):
+        # The file this config was parsed from, set by parse_file
+        self.source = None
         self.groups = []
         for i, grp in enumerate(groups):
             try:
                 self.groups.append(Group(**grp))
-                log.debug(f"Found group {self.groups[-1].name}")
+                log.debug("Found group %s", self.groups[-1].name)
             except ValueError as err:
                 raise ValueError("group '{g}':\n{e}".format(
                     g = grp["name"] if "name" in grp else str(i + 1),
@@ -200,7 +246,7 @@ class CustomerConfig():
         for i, apr in enumerate(approles):
             try:
                 self.approles.append(AppRole(**apr))
-                log.debug(f"Found approle {self.approles[-1].name}")
+                log.debug("Found approle %s", self.approles[-1].name)
             except ValueError as err:
                 msg = ""
                 if "name" in apr:
@@ -210,18 +256,46 @@ class CustomerConfig():
                 raise ValueError(msg + str(err)) from err
 
 
+def load_content(path, content):
+    """Load the raw content of a .json, .yml or .yaml file."""
+    try:
+        if path.endswith(".json"):
+            return json.loads(content)
+        return yaml.load(content, Loader=SafeLoader)
+    except (ValueError, yaml.YAMLError) as err:
+        raise ValueError("Error parsing '{f}':\n{e}".format(
+            f=path,
+            e=err,
+        )) from err
+
+def validate(path, loaded):
+    """Validate the loaded content of a single config file into a CustomerConfig."""
+    try:
+        return CustomerConfig(**loaded)
+    except ValueError as err:
+        raise ValueError("Error parsing '{f}', in {e}".format(
+            f=path,
+            e=err,
+        )) from err
+
+def _parse_content(path, content):
+    """Parse and validate the raw content of a single config file."""
+    return validate(path, load_content(path, content))
+
 def parse_file(path):
-    """Parse single .yml file into a CustomerConfig object."""
-    with open(path, 'r', encoding='utf-8') as handle:
-        _customer_config = yaml.safe_load(handle)
-        try:
-            customer_config = CustomerConfig(**_customer_config)
-            log.log("{f} is valid.".format(
-                f=path.split("/")[-1]
-            ))
-            return customer_config
-        except ValueError as err:
-            raise ValueError("Error parsing '{f}', in {e}".format(
-                f=path,
-                e=err,
-            )) from err
+    """Parse single .yml, .yaml or .json file into a CustomerConfig object."""
+    with open(path, 'rb') as handle:
+        content = handle.read()
+
+    cache_key = cache.key(content) if cache.enabled() else None
+    customer_config = cache.get(cache_key) if cache_key else None
+    if customer_config is None:
+        customer_config = _parse_content(path, content)
+        if cache_key:
+            cache.put(cache_key, customer_config)
+    else:
+        log.debug("Using cached parse of %s", path)
+    customer_config.source = path
+
+    log.log("%s is valid.", path.split("/")[-1], file=path)
+    return customer_config
@@ -0,0 +1,191 @@
+"""Adapt the rate of vault requests to what the server accepts.
+
+Vault answers 429 when a rate limit quota is exceeded, and 503 while it has no
+active node, e.g. during a leader election. Neither request was processed, so
+both are retried. Every request the applicator makes is idempotent anyway
+(reads, and writes of whole objects).
+
+* The number of requests in flight is adjusted like TCP congestion control
+  (AIMD): each success adds 1/limit, each throttled response halves it, at
+  most once per round of requests that were in flight together.
+* Retry-After pauses every worker, not only the throttled one, since quotas
+  apply to all of them.
+* Retries back off exponentially with full jitter, so workers throttled at the
+  same moment do not all retry at the same moment.
+* A circuit breaker opens once VAULT_ERROR_THRESHOLD percent of the recent
+  requests failed for good (5xx, 429 or no response at all). Every later
+  request of the run fails immediately, instead of piling onto an unhealthy
+  server.
+
+One controller is shared by every vault client in the process, and reset at
+the start of each run.
+"""
+import random
+import threading
+import time
+from collections import deque
+
+from . import config, log, metrics
+
+THROTTLE_STATUSES = (429, 503)
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 10.0
+MAX_RETRY_AFTER = 60.0
+# The circuit breaker looks at this many recent requests, once it has enough
+BREAKER_WINDOW = 50
+BREAKER_MIN_REQUESTS = 20
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request, once too many requests failed."""
+
+def _failed(status):
+    return not isinstance(status, int) or status >= 500 or status == 429
+
+# pylint: disable=too-few-public-methods
+class _Breaker():
+    """The outcomes of the recent requests, and whether they opened the circuit."""
+
+    def __init__(self):
+        self.recent = deque(maxlen=BREAKER_WINDOW)
+        self.open = False
+
+    def record(self, status):
+        """Record an outcome, returning whether it opened the circuit."""
+        self.recent.append(_failed(status))
+        failed = sum(self.recent)
+        if self.open or len(self.recent) < BREAKER_MIN_REQUESTS:
+            return False
+        if failed * 100 >= config.vault_error_threshold * len(self.recent):
+            self.open = True
+            log.critical("%d of the last %d vault requests failed, stopping",
+                failed, len(self.recent))
+        return self.open
+
+class RateController():
+    """AIMD limit on vault requests in flight, with a circuit breaker."""
+
+    def __init__(self, maximum=1):
+        # Condition's default lock is reentrant, acquire calls try_acquire with it held
+        self._cond = threading.Condition()
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.generation = 0
+        self.resume_at = 0.0
+        self.breaker = _Breaker()
+
+    def reset(self, maximum):
+        """Start over, allowing up to maximum requests in flight."""
+        with self._cond:
+            self.maximum = maximum
+            self.limit = float(maximum)
+            self.in_flight = 0
+            self.generation = 0
+            self.resume_at = 0.0
+            self.breaker = _Breaker()
+            self._cond.notify_all()
+
+    def try_acquire(self):
+        """Take a slot if one is free, returning (token, None), or (None, seconds to wait).
+
+        Seconds to wait is None when waiting for another request to finish."""
+        with self._cond:
+            if self.breaker.open:
+                raise CircuitOpenError("Too many vault requests failed, not sending any more")
+            wait = self.resume_at - time.monotonic()
+            if wait > 0:
+                return None, wait
+            if self.in_flight >= max(1, int(self.limit)):
+                return None, None
+            self.in_flight += 1
+            return self.generation, None
+
+    def acquire(self):
+        """Block until a request may be sent, and return a token to release it with."""
+        with self._cond:
+            while True:
+                token, wait = self.try_acquire()
+                if token is not None:
+                    return token
+                self._cond.wait(wait)
+
+    def release(self, token, status):
+        """Adjust the limit to the response (or 'error') of one attempt."""
+        with self._cond:
+            self.in_flight -= 1
+            if status in THROTTLE_STATUSES:
+                # Requests sent before the last decrease were sent at the old
+                # limit, they say nothing about the new one
+                if token == self.generation:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.generation += 1
+                    metrics.count("rate_limit_decreases")
+                    log.debug("Throttled by vault, %d request(s) in flight allowed",
+                        int(self.limit))
+            elif not _failed(status):
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def finish(self, token, status, attempt):
+        """Release the slot of the attempt'th (from 0) attempt, returning whether to retry.
+
+        The outcome of requests that are not retried is recorded."""
+        with self._cond:
+            self.release(token, status)
+            retry = should_retry(status, attempt)
+            if not retry:
+                self.record(status)
+            return retry
+
+    def pause(self, seconds):
+        """Send no requests for the next seconds."""
+        with self._cond:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    def record(self, status):
+        """Record the final outcome of a request, after any retries."""
+        with self._cond:
+            if self.breaker.record(status):
+                self._cond.notify_all()
+
+controller = RateController()
+
+def reset(runs=1):
+    """Reset the shared controller, for runs applies sharing it at once."""
+    per_run = config.async_concurrency if config.apply_backend == "asyncio" \
+        else config.apply_concurrency
+    controller.reset(per_run * runs)
+
+reset()
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        # Rare, and email is slow to import on the validate only path
+        # pylint: disable=import-outside-toplevel
+        import email.utils
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+def should_retry(status, attempt):
+    """Whether to retry after the attempt'th (from 0) response with status."""
+    return status in THROTTLE_STATUSES and attempt < config.vault_max_retries
+
+def backoff(attempt, retry_after=None):
+    """Wait before a retry: full jitter, but never less than Retry-After.
+
+    Retry-After also pauses every other request."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    seconds = parse_retry_after(retry_after)
+    if seconds is not None:
+        controller.pause(seconds)
+        delay = max(delay, seconds)
+    metrics.count("retries")
+    return delay
@@ -0,0 +1,107 @@
+"""Compare the desired flattened config with what a vault server already has.
+
+Desired and current state share one shape:
+
+    {
+        "groups":   { "group name": ["policy name"] },
+        "approles": { "approle name": ["policy name"] },
+        "policies": { "policy name": { "path": Capability bitmask } },
+    }
+
+Objects missing from the server have a current value of None. Policies are
+rendered to the object format vault expects here too, for every apply backend.
+"""
+from .parse import Capability
+
+KINDS = ["groups", "approles", "policies"]
+SINGULAR = {"groups": "group", "approles": "approle", "policies": "policy"}
+
+def render_policy(policy):
+    """Convert { path: capabilities } into the object format vault expects."""
+    # This dumpster fire of an object format is still better than templating hcl. The exact
+    # format is found by running: policy = client.get_policy('mypolicy', parse=True)
+    #
+    # The policy object should look like:
+    #
+    #    { 'path': {
+    #        'foobar/*': { 'capabilities': ['read', 'list'] },
+    #        'foobaz/*': { 'capabilities': ['read', 'list', 'update'] },
+    #    }}
+    #
+    # Sort capabilities to enable mock testing.
+    #
+    return {
+        "path": { p: { "capabilities": c.names() } for p, c in policy.items() }
+    }
+
+def _normalize(kind, value):
+    """Make values comparable regardless of ordering, and of the case of policy
+    names, which vault stores lowercased."""
+    if value is None:
+        return None
+    if kind == "policies":
+        return { path: int(caps) for path, caps in value.items() }
+    return sorted(policy.lower() for policy in value)
+
+def plan(desired, current):
+    """Return the subset of desired state that differs from the current state.
+
+    The result maps each kind to { name: (current, desired) }."""
+    changes = {}
+    for kind in KINDS:
+        changes[kind] = {}
+        for name, want in desired[kind].items():
+            have = current[kind].get(name)
+            if _normalize(kind, have) != _normalize(kind, want):
+                changes[kind][name] = (have, want)
+    return changes
+
+def count(changes):
+    """Count the writes needed to apply a plan."""
+    return sum(len(changes[kind]) for kind in KINDS)
+
+def describe(kind, name, have, want):
+    """Render a single change as human readable lines."""
+    singular = SINGULAR[kind]
+    if have is None:
+        lines = [f"+ {singular} {name}"]
+        have = {} if kind == "policies" else []
+    else:
+        lines = [f"~ {singular} {name}"]
+
+    if kind != "policies":
+        for pol in sorted(set(have) - set(want)):
+            lines.append(f"    - {pol}")
+        for pol in sorted(set(want) - set(have)):
+            lines.append(f"    + {pol}")
+        return lines
+
+    for path in sorted(set(have) | set(want)):
+        old = Capability(have.get(path, 0)).names()
+        new = Capability(want.get(path, 0)).names()
+        if old == new:
+            continue
+        if not old:
+            lines.append(f"    + {path} {new}")
+        elif not new:
+            lines.append(f"    - {path} {old}")
+        else:
+            lines.append(f"    ~ {path} {old} -> {new}")
+    return lines
+
+def format_deletions(orphans):
+    """Render objects to prune, as returned by hashivault.find_orphans."""
+    lines = [f"- {SINGULAR[kind]} {name}" for kind in KINDS for name in orphans[kind]]
+    lines.append("{n} object(s) to delete.".format(
+        n = sum(len(orphans[kind]) for kind in KINDS),
+    ))
+    return "\n".join(lines)
+
+def format_plan(changes):
+    """Render a plan as a human readable diff."""
+    lines = []
+    for kind in KINDS:
+        for name, (have, want) in changes[kind].items():
+            lines.extend(describe(kind, name, have, want))
+    lines.append("{n} object(s) to write.".format(n=count(changes)))
+    return "\n".join(lines)
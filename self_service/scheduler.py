@@ -0,0 +1,93 @@
+"""Run interdependent tasks on a bounded thread pool.
+
+Tasks are keyed by any hashable, usually a (kind, name) tuple. A task is only
+started once every task it depends on has succeeded. If a dependency fails,
+its dependents are skipped and reported as failed too.
+"""
+import contextvars
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import log
+
+def _describe(key):
+    if isinstance(key, tuple):
+        return " ".join(str(k) for k in key)
+    return str(key)
+
+def _submit(pool, task):
+    # Carry the caller's log context (e.g. the tenant) into the worker thread
+    return pool.submit(contextvars.copy_context().run, task)
+
+def _result(key, future):
+    """Whether a finished task succeeded, logging why not if it raised."""
+    # pylint: disable=broad-except
+    try:
+        return bool(future.result())
+    except Exception as err:
+        log.critical("Failed to apply %s: %s", _describe(key), err)
+        return False
+
+class _Run():
+    """The state of one run: what each task waits for, and what finished."""
+
+    def __init__(self, tasks, dependencies):
+        self.tasks = tasks
+        self.results = {}
+        self.waiting = {
+            key: {dep for dep in dependencies.get(key, []) if dep in tasks and dep != key}
+            for key in tasks
+        }
+        self.dependents = defaultdict(list)
+        for key, deps in self.waiting.items():
+            for dep in deps:
+                self.dependents[dep].append(key)
+
+    def ready(self):
+        """The tasks that wait for nothing."""
+        return [key for key, deps in self.waiting.items() if not deps]
+
+    def skip(self, key, reason):
+        """Fail key and everything depending on it, since reason failed."""
+        if key in self.results:
+            return
+        log.critical("Skipping %s, %s failed", _describe(key), _describe(reason))
+        self.results[key] = False
+        for dependent in self.dependents[key]:
+            self.skip(dependent, reason)
+
+    def complete(self, key, success):
+        """Record the outcome of key, returning the dependents it made ready."""
+        self.results[key] = success
+        ready = []
+        for dependent in self.dependents[key]:
+            if not success:
+                self.skip(dependent, key)
+                continue
+            self.waiting[dependent].discard(key)
+            if not self.waiting[dependent] and dependent not in self.results:
+                ready.append(dependent)
+        return ready
+
+def run(tasks, dependencies, concurrency):
+    """Run every task and return { key: success }.
+
+    tasks maps a key to a callable returning True on success. dependencies
+    maps a key to the keys it must wait for; keys that are not themselves
+    tasks are assumed to already be satisfied."""
+    state = _Run(tasks, dependencies)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = { _submit(pool, tasks[key]): key for key in state.ready() }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                for dependent in state.complete(key, _result(key, future)):
+                    pending[_submit(pool, tasks[dependent])] = dependent
+
+    # Anything left over is part of a dependency cycle
+    for key in tasks:
+        if key not in state.results:
+            log.critical("Skipping %s, dependency cycle", _describe(key))
+            state.results[key] = False
+    return state.results
@@ -1,63 +1,349 @@
 """Main entrypoint to parse and apply customer configs."""
-from glob import glob
+import os
 from os import path
 
-from . import parse, config, translate, hashivault, log
+from . import (
+    analyze, cache, compact, directory, parse, config, translate, log, metrics, ratelimit,
+    shard,
+)
+
+CONFIG_EXTENSIONS = ('.yml', '.yaml', '.json')
+
+def iter_customer_files(config_dir=None):
+    """Yield the .yml, .yaml and .json files in the customer config dir, in name order.
+
+    Subdirectories are searched too if CUSTOMER_CONFIG_RECURSIVE is set. Hidden
+    files and directories (like .git) are skipped."""
+    pending = [config_dir or config.customer_config_dir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            entries = sorted(entries, key=lambda e: e.name)
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name.endswith(CONFIG_EXTENSIONS) and entry.is_file():
+                yield entry.path
+        if config.customer_config_recursive:
+            # Depth first, in name order
+            pending.extend(reversed(subdirs))
 
 def get_customer_files():
-    """Search customer config dir for .yml and .yaml files."""
-    return [
-        *glob(
-            path.join(config.customer_config_dir, '*.yml')
-        ),
-        *glob(
-            path.join(config.customer_config_dir, '*.yaml')
-        ),
-    ]
+    """List the customer config files, in a single pass over the directory."""
+    with metrics.phase("scan"):
+        return list(iter_customer_files())
 
-def parse_customer_configs(customer_files):
-    """Parse and validate a list of customer config files."""
-    customer_configs = []
+# Settings a parse worker process needs, in case it was spawned rather than forked
+WORKER_SETTINGS = [
+    "customer_prefix",
+    "invalid_group_prefix",
+    "parse_cache_dir",
+    "parse_cache_max_entries",
+    "quiet",
+    "verbose",
+    "log_level",
+    "log_format",
+]
+
+def _init_parse_worker(settings):
+    """Copy the parent's config into a parse worker process."""
+    for key, val in settings.items():
+        setattr(config, key, val)
+    # Workers exit without flushing, their records are written by the parent
+    log.hold()
+
+def _parse_file_or_error(customer_file):
+    """Parse a file, returning (CustomerConfig, None) or (None, error message)."""
+    # pylint: disable=broad-except
+    try:
+        return parse.parse_file(customer_file), None
+    except Exception as err:
+        return None, str(err)
+
+def _parse_in_worker(customer_file):
+    """Parse a file in a worker process, returning (CustomerConfig, error, log records)."""
+    return (*_parse_file_or_error(customer_file), log.drain())
+
+def _timed(phase, items):
+    """Yield items, adding the time spent waiting for each one to a metrics phase."""
+    items = iter(items)
+    done = object()
+    while True:
+        with metrics.phase(phase):
+            item = next(items, done)
+        if item is done:
+            return
+        yield item
+
+def _parse_files(customer_files):
+    """Yield (file, CustomerConfig, error) in order, in parallel if PARSE_WORKERS allows it."""
+    workers = 1
+    if config.parse_workers > 1:
+        customer_files = list(customer_files)
+        workers = min(config.parse_workers, len(customer_files))
+    if workers <= 1:
+        for customer_file in customer_files:
+            with metrics.phase("parse"):
+                result = _parse_file_or_error(customer_file)
+            yield (customer_file, *result)
+        return
+
+    # multiprocessing is slow to import, and most runs parse in this process
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_parse_worker,
+        initargs=({key: getattr(config, key) for key in WORKER_SETTINGS},),
+    )
+    with pool:
+        # map returns results in the order of customer_files, as they complete
+        results = pool.map(
+            _parse_in_worker,
+            customer_files,
+            chunksize=max(1, len(customer_files) // (workers * 4)),
+        )
+        for customer_file, result in zip(customer_files, _timed("parse", results)):
+            customer_config, error, records = result
+            log.extend(records)
+            yield (customer_file, customer_config, error)
+
+def stream_customer_configs(customer_files):
+    """Parse and validate customer config files one at a time.
+
+    Yields (file, CustomerConfig) for every valid file as soon as it is parsed,
+    so callers can fold it into their state and drop it. Invalid files, and
+    files naming groups missing from LDAP_GROUPS_FILE, are reported as they
+    are found, and once every file has been read a ValueError lists all of
+    their errors."""
     errors = []
-    for customer_file in customer_files:
-        # pylint: disable=broad-except
-        try:
-            customer_configs.append(parse.parse_file(customer_file))
-        except Exception as err:
-            errors.append(str(err))
+    count = 0
+    for customer_file, customer_config, error in _parse_files(customer_files):
+        count += 1
+        if error is None and directory.enabled():
+            try:
+                directory.check(customer_file, customer_config)
+            except ValueError as err:
+                error = str(err)
+        if error is None:
+            yield customer_file, customer_config
+        else:
+            log.critical("%s is invalid.", path.basename(customer_file), file=customer_file)
+            errors.append(error)
+    cache.evict()
+    metrics.count("files", count)
+    metrics.count("invalid_files", len(errors))
     if len(errors) != 0:
         raise ValueError("Error(s) parsing customer configs:\n{e}".format(
             e="\n-----------\n".join(errors)
         ))
-    return customer_configs
 
-def apply_customer_configs(customer_configs):
-    """Flatten/combine a list of customer configs and apply them to a vault server."""
-    flat_configs = translate.flatten(customer_configs)
+def parse_customer_configs(customer_files):
+    """Parse and validate a list of customer config files."""
+    return [customer_config for _, customer_config in stream_customer_configs(customer_files)]
+
+def _hashivault():
+    # The vault client stack is slow to import, and not needed to only validate
+    # pylint: disable=import-outside-toplevel
+    from . import hashivault
+    return hashivault
+
+def vault_client(pool_size=None):
+    """Build an authenticated vault client, see hashivault.get_client."""
+    return _hashivault().get_client(pool_size)
+
+def apply_flat_configs(flat_configs, client=None, partial=False, customer_prefix=None):
+    """Apply already flattened customer configs to a vault server.
+
+    Orphaned objects are only pruned when flat_configs is the whole
+    configuration, not just the targets affected by some changed files.
+    customer_prefix names the tenant being applied, when it is not
+    CUSTOMER_PREFIX (batch mode)."""
+    for kind in ['groups', 'approles', 'policies']:
+        metrics.count(kind, len(flat_configs[kind]))
+    if config.compact_policies:
+        with metrics.phase("compact"):
+            flat_configs = compact.compact(flat_configs)
     try:
-        return hashivault.apply_flat_config(
+        return _hashivault().apply_flat_config(
             groups=flat_configs['groups'],
             approles=flat_configs['approles'],
             policies=flat_configs['policies'],
             paths=flat_configs['paths'],
+            client=client,
+            prune=config.prune_orphans and not partial,
+            customer_prefix=customer_prefix,
         )
     except Exception as err:
         raise Exception("Error applying customer config to vault server:\n{e}".format(
             e=err,
         )) from err
 
+def apply_customer_configs(customer_configs, client=None):
+    """Flatten/combine a list of customer configs and apply them to a vault server."""
+    with metrics.phase("flatten"):
+        flat_configs = translate.flatten(customer_configs)
+    return apply_flat_configs(flat_configs, client)
+
+def flatten_customer_files(customer_files):
+    """Parse, validate and flatten customer config files, without keeping the parsed configs."""
+    flat_configs = translate.empty()
+    for _, customer_config in stream_customer_configs(customer_files):
+        with metrics.phase("flatten"):
+            translate.fold(flat_configs, customer_config)
+    return flat_configs
+
+def get_changed_files():
+    """Resolve CHANGED_FILES (e.g. from `git diff --name-only`) into config file paths.
+
+    Returns (changed, deleted) lists of absolute paths inside the customer config dir."""
+    config_dir = path.abspath(config.customer_config_dir)
+    changed = []
+    deleted = []
+    for entry in config.changed_files.replace(',', '\n').splitlines():
+        entry = entry.strip()
+        if not entry or not entry.endswith(CONFIG_EXTENSIONS):
+            continue
+        # Paths relative to a repository root are matched by file name, or when
+        # recursing, by their path inside the customer config dir
+        if not path.isabs(entry) and not path.exists(entry):
+            entry = path.join(
+                config_dir,
+                entry if config.customer_config_recursive else path.basename(entry),
+            )
+        entry = path.abspath(entry)
+        if config.customer_config_recursive:
+            if not entry.startswith(config_dir + os.sep):
+                continue
+        elif path.dirname(entry) != config_dir:
+            continue
+        if path.exists(entry):
+            changed.append(entry)
+        else:
+            deleted.append(entry)
+    return changed, deleted
+
+def load_flat_index():
+    """Load the index saved by the last successful apply, or None if unusable."""
+    # pylint: disable=broad-except
+    try:
+        index = cache.load_file(config.flat_index_file)
+    except PermissionError as err:
+        log.warning("Not using flat index: %s", err)
+        return None
+    except Exception as err:
+        log.debug("Not using flat index %s: %s", config.flat_index_file, err)
+        return None
+    if getattr(index, "version", None) != translate.FlatIndex.VERSION:
+        log.debug("Flat index %s was saved by another version", config.flat_index_file)
+        return None
+    if index.customer_prefix != config.customer_prefix:
+        log.debug("Flat index %s is for another customer prefix", config.flat_index_file)
+        return None
+    return index
+
+def save_flat_index(index):
+    """Save the index for the next incremental run."""
+    cache.save_file(config.flat_index_file, index)
+
+def discard_flat_index():
+    """Force the next run to be a full one."""
+    if path.exists(config.flat_index_file):
+        os.remove(config.flat_index_file)
+
+def build_flat_index(customer_files):
+    """Parse customer config files into an index, keyed by absolute file path."""
+    index = translate.FlatIndex()
+    for customer_file, customer_config in stream_customer_configs(customer_files):
+        with metrics.phase("flatten"):
+            index.update(path.abspath(customer_file), customer_config)
+    return index
+
+def apply_flat_index(index, affected=None):
+    """Apply (the affected targets of) an index, and keep it only if that succeeded."""
+    with metrics.phase("flatten"):
+        flat_configs = index.flatten(affected)
+    success = apply_flat_configs(flat_configs, partial=affected is not None)
+    if success:
+        save_flat_index(index)
+    else:
+        discard_flat_index()
+    return success
+
+def incremental_main(index):
+    """Re-parse only CHANGED_FILES and apply only the targets they affect."""
+    changed, deleted = get_changed_files()
+    if log.enabled(log.DEBUG):
+        log.debug("Changed files:\n%s\nDeleted files:\n%s", "\n".join(changed), "\n".join(deleted))
+    parsed = stream_customer_configs(changed)
+    if config.only_validate:
+        for _ in parsed:
+            pass
+        log.debug("Validation complete.")
+        return True
+
+    affected = set()
+    with metrics.phase("flatten"):
+        for customer_file in deleted:
+            affected |= index.remove(customer_file)
+    for customer_file, customer_config in parsed:
+        with metrics.phase("flatten"):
+            affected |= index.update(customer_file, customer_config)
+    log.debug("Applying %d affected targets", len(affected))
+    return apply_flat_index(index, affected)
+
+def run_main(body, runs=1):
+    """Call body as a whole run, writing its metrics and logs even if it fails.
+
+    runs is the number of applies that share the rate controller at once."""
+    metrics.reset()
+    ratelimit.reset(runs)
+    try:
+        return body()
+    finally:
+        metrics.write()
+        log.flush()
+
 def main():
     """Apply a directory of customer config files to a vault server."""
-    log.debug(f"Scanning customer dir {config.customer_config_dir}")
+    return run_main(_main)
+
+def _main():
+    if config.plan_only and config.only_validate:
+        log.warning("PLAN_ONLY needs ONLY_VALIDATE=False to read the server, only validating")
+    if config.shard_report:
+        log.log(shard.format_report([config.customer_prefix]))
+        return True
+    if not shard.owns(config.customer_prefix):
+        log.log("Customer %s belongs to shard %d, skipping", config.customer_prefix,
+            shard.owner(config.customer_prefix))
+        return True
+
+    if config.flat_index_file and config.changed_files is not None:
+        index = load_flat_index()
+        if index is not None:
+            return incremental_main(index)
+        log.debug("Falling back to a full run.")
+
+    log.debug("Scanning customer dir %s", config.customer_config_dir)
     customer_files = get_customer_files()
-    log.debug("Found files:\n{files}".format(
-        files="\n".join(customer_files)
-    ))
-    customer_configs = parse_customer_configs(
-        get_customer_files()
-    )
+    if log.enabled(log.DEBUG):
+        log.debug("Found files:\n%s", "\n".join(customer_files))
     if not config.only_validate:
         log.debug("Validation-only mode disabled, Applying configs.")
-        return apply_customer_configs(customer_configs)
+        if config.flat_index_file:
+            return apply_flat_index(build_flat_index(customer_files))
+        return apply_flat_configs(flatten_customer_files(customer_files))
+
+    rules = []
+    for _, customer_config in stream_customer_configs(customer_files):
+        if config.analyze_policies:
+            rules += analyze.collect_rules([customer_config])
+    if config.analyze_policies:
+        with metrics.phase("analyze"):
+            report = analyze.analyze(rules)
+        log.log(analyze.format_report(report))
     log.debug("Validation complete.")
     return True
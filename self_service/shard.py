@@ -0,0 +1,49 @@
+"""Split tenants between several applicator replicas.
+
+Every replica gets the same tenants (batch manifest, or CUSTOMER_PREFIX) and
+SHARD_COUNT, and its own SHARD_INDEX from 0 to SHARD_COUNT - 1. It then only
+parses, flattens and applies the tenants its index owns.
+
+Owners are picked by rendezvous (highest random weight) hashing of the
+customer prefix: every (shard, tenant) pair gets a pseudo random score, and
+the shard with the highest score owns the tenant. No coordination is needed,
+shards get about the same number of tenants, and going from n to n + 1 shards
+only moves the tenants the new shard wins, about 1 / (n + 1) of them. Every
+other tenant stays on the replica whose parse cache is already warm.
+"""
+import hashlib
+
+from . import config
+
+def _score(shard, key):
+    digest = hashlib.blake2b(f"{shard}:{key}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def owner(key, count=None):
+    """The shard that owns key (a customer prefix), out of count (SHARD_COUNT) shards."""
+    count = count or config.shard_count
+    return max(range(count), key=lambda shard: _score(shard, key))
+
+def owns(key):
+    """Whether this replica (SHARD_INDEX) owns key."""
+    return owner(key) == config.shard_index
+
+def assign(keys, count=None):
+    """Return { shard: [keys it owns] } for every shard."""
+    count = count or config.shard_count
+    shards = { shard: [] for shard in range(count) }
+    for key in keys:
+        shards[owner(key, count)].append(key)
+    return shards
+
+def format_report(keys, count=None):
+    """Render which shard owns which tenant."""
+    lines = []
+    for shard, owned in assign(keys, count).items():
+        lines.append("Shard {s} ({n} tenants){mine}:".format(
+            s = shard,
+            n = len(owned),
+            mine = " <- this replica" if shard == config.shard_index else "",
+        ))
+        lines.extend(f"    {key}" for key in sorted(owned))
+    return "\n".join(lines)
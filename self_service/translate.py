@@ -1,16 +1,19 @@
 """Converts a list of CustomerConfigs into one list each of policies,
 groups, approles, and secret paths"""
+import sys
+
 from . import config
 from .parse import Group, AppRole, PolicyRule, Capability
 
 # pylint: disable=too-few-public-methods
 class UnverifiedPolicyRule(PolicyRule):
     """Initializes PolicyRule object with no verification."""
+    __slots__ = []
 
     # pylint: disable=super-init-not-called
     def __init__(self, path, capabilities):
-        self.path = path
-        self.capabilities = [Capability(cap) for cap in capabilities]
+        self.path = sys.intern(path)
+        self.capabilities = Capability.from_names(capabilities)
 
 
 def apply_group_accessors(customer_configs):
@@ -31,48 +34,129 @@ def apply_group_accessors(customer_configs):
                 customer_conf.groups.append(accessor)
 
 
-def flatten(customer_configs):
-    """Converts a list of CustomerConfigs into one list each of policies,
-    groups, approles, and secret paths"""
-    targets = { Group.kind: {}, AppRole.kind: {} }
-    policies = {}
-    all_paths = set([])
+def empty():
+    """The result of flattening no configs at all."""
+    return {
+        "groups": {},
+        "approles": {},
+        "policies": {},
+        "paths": set(),
+    }
 
-    apply_group_accessors(customer_configs)
+def fold(flat, customer_conf):
+    """Merge a single CustomerConfig into the result of flatten, in place."""
+    apply_group_accessors([customer_conf])
 
-    for customer_conf in customer_configs:
-        for target in customer_conf.groups + customer_conf.approles:
+    targets = { Group.kind: flat["groups"], AppRole.kind: flat["approles"] }
+    policies = flat["policies"]
+    all_paths = flat["paths"]
+    for target in customer_conf.groups + customer_conf.approles:
 
-            policy_name = \
-                f"{target.kind}-{target.name}" \
-                if target.kind == AppRole.kind else \
-                f"{target.kind}-{config.customer_prefix}-{target.name}"
+        policy_name = \
+            f"{target.kind}-{target.name}" \
+            if target.kind == AppRole.kind else \
+            f"{target.kind}-{config.customer_prefix}-{target.name}"
 
 
-            targets[target.kind][target.name] = policy_name
+        targets[target.kind][target.name] = policy_name
 
-            if not policy_name in policies:
-                policies[policy_name] = {}
+        if not policy_name in policies:
+            policies[policy_name] = {}
 
-            for pol in target.policies:
-                all_paths.add(pol.path)
+        for pol in target.policies:
+            all_paths.add(pol.path)
 
-                # Intialize the path with an empty set of capabilities.
-                # Use a python set to prevent duplicates.
-                if not pol.path in policies[policy_name]:
-                    policies[policy_name][pol.path] = set()
+            # Add any new capabilities defined for the same target+path.
+            # Flag arithmetic is slow, only merge when the path repeats
+            rules = policies[policy_name]
+            existing = rules.get(pol.path)
+            rules[pol.path] = pol.capabilities if existing is None \
+                else existing | pol.capabilities
+    return flat
 
-                # Add any new capabilities defined for the same target+path
-                policies[policy_name][pol.path].update(
-                    {cap.value for cap in pol.capabilities}
-                )
+def flatten(customer_configs):
+    """Converts a list of CustomerConfigs into one list each of policies,
+    groups, approles, and secret paths
+
+    customer_configs may be any iterable, e.g. a generator of parsed files;
+    each config is merged in as it arrives and is not kept."""
+    flat = empty()
+    for customer_conf in customer_configs:
+        fold(flat, customer_conf)
 
     # keep paths that end in *, but don't contain any +
     #sanitized_paths = { p for p in all_paths if (not '+' in p and p[-1] == '*') }
 
-    return {
-        "groups": targets[Group.kind],
-        "approles": targets[AppRole.kind],
-        "policies": policies,
-        "paths": all_paths,
-    }
+    return flat
+
+TARGET_KINDS = ["groups", "approles", "policies"]
+
+class FlatIndex():
+    """Incrementally maintained result of flatten, with a target -> file index.
+
+    Every file's own flattened contribution is kept, along with which files
+    contribute to each group, approle and policy. When files change, only the
+    targets they touch (before or after the change) are merged again, which
+    gives the same result as flattening every file from scratch."""
+
+    # Bump whenever the flattened format changes, to ignore saved indexes
+    VERSION = 2
+
+    def __init__(self):
+        self.version = FlatIndex.VERSION
+        self.customer_prefix = config.customer_prefix
+        self.files = {}
+        self.owners = { kind: {} for kind in TARGET_KINDS }
+
+    def _unlink(self, path):
+        """Drop a file's contribution, returning the targets it touched."""
+        affected = set()
+        old = self.files.pop(path, None)
+        if old is None:
+            return affected
+        for kind in TARGET_KINDS:
+            for name in old[kind]:
+                affected.add((kind, name))
+                self.owners[kind][name].discard(path)
+                if not self.owners[kind][name]:
+                    del self.owners[kind][name]
+        return affected
+
+    def update(self, path, customer_config):
+        """Add or replace a file's config, returning the affected targets."""
+        affected = self._unlink(path)
+        contribution = flatten([customer_config])
+        self.files[path] = contribution
+        for kind in TARGET_KINDS:
+            for name in contribution[kind]:
+                affected.add((kind, name))
+                self.owners[kind].setdefault(name, set()).add(path)
+        return affected
+
+    def remove(self, path):
+        """Forget a deleted file, returning the affected targets."""
+        return self._unlink(path)
+
+    def flatten(self, affected=None):
+        """Merge contributions into the same shape flatten returns.
+
+        If affected is given, only those (kind, name) targets are included,
+        and targets that no file defines any more are left out."""
+        result = { kind: {} for kind in TARGET_KINDS }
+        result["paths"] = set()
+        if affected is None:
+            affected = {(kind, name) for kind in TARGET_KINDS for name in self.owners[kind]}
+
+        for kind, name in affected:
+            # Sort to merge in a stable order, regardless of set ordering
+            for path in sorted(self.owners[kind].get(name, [])):
+                value = self.files[path][kind][name]
+                if kind != "policies":
+                    result[kind][name] = value
+                    continue
+                merged = result[kind].setdefault(name, {})
+                for rule_path, caps in value.items():
+                    existing = merged.get(rule_path)
+                    merged[rule_path] = caps if existing is None else existing | caps
+                    result["paths"].add(rule_path)
+        return result
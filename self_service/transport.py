@@ -0,0 +1,210 @@
+"""Build the HTTP session used to talk to the vault server.
+
+The default requests session keeps at most 10 connections per host, which
+makes concurrent workers wait for, or throw away and re-open, connections
+(repeating the TLS handshake each time). This session sizes its pool to the
+number of workers, keeps idle connections alive, and counts how many
+connections were opened versus reused. Requests vault throttles are retried,
+at a rate set by ratelimit. With VAULT_READ_ADDR, reads go to standby nodes.
+"""
+import base64
+import socket
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import config, log, metrics, ratelimit
+
+class _Stats():
+    """Thread safe connection counters, shared by every session in the process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+
+    def count_opened(self):
+        """Count a newly opened connection."""
+        with self._lock:
+            self.opened += 1
+
+    def count_request(self):
+        """Count a request sent over any connection."""
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def reused(self):
+        """Requests that did not need to open a new connection."""
+        return max(self.requests - self.opened, 0)
+
+    def reset(self):
+        """Zero all counters."""
+        with self._lock:
+            self.opened = 0
+            self.requests = 0
+
+    def __str__(self):
+        return "{r} requests, {o} connections opened, {u} reused".format(
+            r = self.requests,
+            o = self.opened,
+            u = self.reused,
+        )
+
+stats = _Stats()
+
+class _Consistency():
+    """The newest X-Vault-Index state returned by vault, to require it on reads.
+
+    A state is base64 of 'v1:<cluster id>:<local index>:<replicated index>:<hmac>'.
+    Writes all go to the same active node, so only the newest state is kept;
+    states that do not parse replace the current one."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = None
+        self._index = None
+
+    @staticmethod
+    def _parse(state):
+        try:
+            pieces = base64.b64decode(state, validate=True).decode("utf-8").split(":")
+            return pieces[1], int(pieces[3]), int(pieces[2])
+        except (ValueError, IndexError):
+            return None
+
+    def record(self, state):
+        """Remember a state returned by vault, if it is newer than the current one."""
+        if not state:
+            return
+        index = self._parse(state)
+        with self._lock:
+            if index is not None and self._index is not None and \
+                    index[0] == self._index[0] and index[1:] <= self._index[1:]:
+                return
+            self.state = state
+            self._index = index
+
+    def reset(self):
+        """Forget the current state."""
+        with self._lock:
+            self.state = None
+            self._index = None
+
+consistency = _Consistency()
+
+READ_METHODS = ("GET", "LIST")
+
+def _read_request(request):
+    """A copy of request, sent to VAULT_READ_ADDR and requiring the newest state."""
+    url = urlsplit(request.url)
+    read_addr = urlsplit(config.vault_read_addr)
+    read = request.copy()
+    read.url = urlunsplit((read_addr.scheme, read_addr.netloc, url.path, url.query, url.fragment))
+    state = consistency.state
+    if state:
+        read.headers["X-Vault-Index"] = state
+    return read
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.count_opened()
+        return super()._new_conn()
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.count_opened()
+        return super()._new_conn()
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter that counts connections and enables TCP keep-alive."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        if config.vault_tcp_keepalive:
+            kwargs["socket_options"] = [
+                *HTTPConnectionPool.ConnectionCls.default_socket_options,
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    # pylint: disable=arguments-differ
+    def send(self, request, *args, **kwargs):
+        """Send a request, to VAULT_READ_ADDR if it is a read and that is set.
+
+        A standby that has not caught up with the newest write this process
+        saw answers 412, and the read is sent to the active node instead."""
+        if config.vault_read_addr and request.method in READ_METHODS:
+            res = self._send_retrying(_read_request(request), *args, **kwargs)
+            if res.status_code != 412:
+                return res
+            metrics.count("stale_reads")
+            log.debug("Standby is behind, reading %s from the active node",
+                urlsplit(request.url).path)
+            res.close()
+        res = self._send_retrying(request, *args, **kwargs)
+        consistency.record(res.headers.get("X-Vault-Index"))
+        return res
+
+    def _send_retrying(self, request, *args, **kwargs):
+        """Send a request, retrying it while vault throttles it (see ratelimit)."""
+        attempt = 0
+        while True:
+            token = ratelimit.controller.acquire()
+            status = "error"
+            try:
+                res = self._send_once(request, *args, **kwargs)
+                status = res.status_code
+            finally:
+                retry = ratelimit.controller.finish(token, status, attempt)
+            if not retry:
+                return res
+            delay = ratelimit.backoff(attempt, res.headers.get("Retry-After"))
+            log.debug("Retrying %s %s in %.2fs, vault answered %d",
+                request.method, urlsplit(request.url).path, delay, status)
+            res.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _send_once(self, request, *args, **kwargs):
+        stats.count_request()
+        start = time.perf_counter()
+        status = "error"
+        try:
+            res = super().send(request, *args, **kwargs)
+            status = res.status_code
+            return res
+        finally:
+            metrics.observe(
+                request.method,
+                urlsplit(request.url).path,
+                time.perf_counter() - start,
+                status,
+                len(request.body or b""),
+            )
+
+def build_session(pool_size):
+    """Build a requests session whose connection pool fits pool_size workers.
+
+    Connections are kept open between requests, so each worker pays for at
+    most one TCP and TLS handshake per run. pool_block makes extra workers
+    wait for a free connection instead of opening throwaway ones."""
+    session = requests.Session()
+    adapter = PooledAdapter(
+        # One pool per vault address
+        pool_connections=2 if config.vault_read_addr else 1,
+        pool_maxsize=pool_size,
+        pool_block=True,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def timeout():
+    """The (connect, read) timeout tuple for vault requests."""
+    return (config.vault_connect_timeout, config.vault_read_timeout)
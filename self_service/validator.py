@@ -0,0 +1,225 @@
+"""Validate configs over HTTP, for CI pre-checks without a container start.
+
+Every check otherwise pays for a container start and the Python imports
+before a single file is read. This service stays up and answers
+
+    POST /validate
+    {"customer_prefix": "foo", "invalid_group_prefix": "",
+     "files": {"foo.yml": "groups: ..."}}
+
+with
+
+    {"valid": false,
+     "files": {"foo.yml": {"valid": false, "error": "Error parsing 'foo.yml', ..."}},
+     "error": "Error(s) parsing customer configs:\\n..."}
+
+where each error is the message parse_customer_configs reports for that file,
+and "error" is the message it raises for all of them (null when valid).
+
+It listens on VALIDATE_HOST:VALIDATE_PORT, or on the unix socket
+VALIDATE_SOCKET when set. Requests are served concurrently. YAML is loaded in
+parallel, but validation reads the customer prefix from the global config, so
+it runs one request at a time with the tenant's settings swapped in. Results
+are kept in memory, so unchanged files sent again are not validated again.
+Groups are checked against LDAP_GROUPS_FILE on every request, so the answer
+follows the directory snapshot as it is reloaded.
+"""
+import hashlib
+import json
+import os
+import signal
+import socketserver
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer
+
+from . import config, directory, log, parse
+from .httpjson import JSONHandler
+
+# Larger requests are refused, CI sends a tenant's configs and nothing else
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+MAX_RESULTS = 10000
+TENANT_SETTINGS = ("customer_prefix", "invalid_group_prefix")
+
+_config_lock = threading.Lock()
+_results_lock = threading.Lock()
+_results = OrderedDict()
+
+@contextmanager
+def tenant_config(customer_prefix, invalid_group_prefix):
+    """Swap one tenant's settings into the global config, one thread at a time."""
+    with _config_lock:
+        saved = { key: getattr(config, key) for key in TENANT_SETTINGS }
+        config.customer_prefix = customer_prefix
+        config.invalid_group_prefix = invalid_group_prefix
+        try:
+            yield
+        finally:
+            for key, value in saved.items():
+                setattr(config, key, value)
+
+def _result_key(customer_prefix, invalid_group_prefix, name, content):
+    # Error messages name the file, so the name is part of the key
+    digest = hashlib.sha256()
+    for part in [customer_prefix, invalid_group_prefix, name]:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(content)
+    return digest.hexdigest()
+
+def _cached(result_key):
+    with _results_lock:
+        if result_key not in _results:
+            return False, None
+        _results.move_to_end(result_key)
+        return True, _results[result_key]
+
+def _remember(result_key, result):
+    with _results_lock:
+        _results[result_key] = result
+        while len(_results) > MAX_RESULTS:
+            _results.popitem(last=False)
+
+def validate(customer_prefix, files, invalid_group_prefix=""):
+    """Validate { name: content } for one tenant, returning the response document."""
+    # name: (error, groups referenced), groups only known for valid files
+    results = {}
+    loaded = {}
+    keys = {}
+    for name, content in files.items():
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        keys[name] = _result_key(customer_prefix, invalid_group_prefix, name, content)
+        hit, result = _cached(keys[name])
+        if hit:
+            results[name] = result
+            continue
+        # pylint: disable=broad-except
+        try:
+            loaded[name] = parse.load_content(name, content)
+        except Exception as err:
+            results[name] = (str(err), [])
+            _remember(keys[name], results[name])
+
+    if loaded:
+        with tenant_config(customer_prefix, invalid_group_prefix):
+            for name, content in loaded.items():
+                # pylint: disable=broad-except
+                try:
+                    results[name] = (None, directory.referenced(parse.validate(name, content)))
+                except Exception as err:
+                    results[name] = (str(err), [])
+                _remember(keys[name], results[name])
+
+    errors = {}
+    for name in files:
+        errors[name], groups = results[name]
+        if errors[name] is None and directory.enabled():
+            absent = directory.missing(groups)
+            if absent:
+                errors[name] = directory.format_missing(name, absent)
+    failed = [errors[name] for name in files if errors[name] is not None]
+    return {
+        "valid": not failed,
+        "files": {
+            name: { "valid": errors[name] is None, "error": errors[name] } for name in files
+        },
+        "error": "Error(s) parsing customer configs:\n{e}".format(
+            e="\n-----------\n".join(failed)
+        ) if failed else None,
+    }
+
+def reset():
+    """Forget the results of earlier requests."""
+    with _results_lock:
+        _results.clear()
+
+def _read_request(body):
+    """Parse a request body into validate's arguments, or raise ValueError."""
+    try:
+        request = json.loads(body)
+    except ValueError as err:
+        raise ValueError(f"Request is not valid JSON: {err}") from err
+    if not isinstance(request, dict):
+        raise ValueError("Request must be a JSON object")
+    customer_prefix = request.get("customer_prefix")
+    invalid_group_prefix = request.get("invalid_group_prefix", "")
+    files = request.get("files")
+    if not isinstance(customer_prefix, str) or not customer_prefix:
+        raise ValueError("customer_prefix is required")
+    if not isinstance(invalid_group_prefix, str):
+        raise ValueError("invalid_group_prefix must be a string")
+    if not isinstance(files, dict) or not files \
+            or not all(isinstance(content, str) for content in files.values()):
+        raise ValueError("files must map file names to their content")
+    return customer_prefix, files, invalid_group_prefix
+
+def _handler():
+    class _Handler(JSONHandler):
+        protocol_version = "HTTP/1.1"
+
+        # pylint: disable=invalid-name
+        def do_GET(self):
+            """Serve /healthz."""
+            if self.path == "/healthz":
+                self.reply(200, { "ok": True })
+            else:
+                self.reply(404, { "error": "Not found" })
+
+        def do_POST(self):
+            """Serve /validate."""
+            if self.path != "/validate":
+                # The body is not read, so the connection cannot be reused
+                self.reply(404, { "error": "Not found" }, close=True)
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_REQUEST_BYTES:
+                self.reply(413, { "error": f"Requests are limited to {MAX_REQUEST_BYTES} bytes" },
+                    close=True)
+                return
+            try:
+                args = _read_request(self.rfile.read(length))
+            except ValueError as err:
+                self.reply(400, { "error": str(err) })
+                return
+            result = validate(*args)
+            log.log("Validated %d file(s) for %s, %s", len(args[1]), args[0],
+                "valid" if result["valid"] else "invalid")
+            log.flush()
+            self.reply(200, result)
+    return _Handler
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server():
+    """Bind the server to VALIDATE_SOCKET, or VALIDATE_HOST:VALIDATE_PORT."""
+    if config.validate_socket:
+        if os.path.exists(config.validate_socket):
+            os.remove(config.validate_socket)
+        return _UnixHTTPServer(config.validate_socket, _handler())
+    return ThreadingHTTPServer((config.validate_host, config.validate_port), _handler())
+
+def main():
+    """Serve until SIGTERM or SIGINT."""
+    stopping = threading.Event()
+
+    def _stop(*_):
+        log.log("Stopping.")
+        stopping.set()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    server = make_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.log("Validating on %s", config.validate_socket
+        or f"{config.validate_host}:{config.validate_port}")
+    log.flush()
+    try:
+        stopping.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if config.validate_socket:
+            os.remove(config.validate_socket)
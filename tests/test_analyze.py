@@ -0,0 +1,93 @@
+import random
+from unittest import TestCase, mock
+
+from self_service import analyze, compact, log, parse
+from self_service.parse import Capability
+
+class TestAnalyze(TestCase):
+
+    def setUp(self):
+        self.config = [
+            mock.patch("self_service.parse.config",
+                customer_prefix="customer",
+                invalid_group_prefix="",
+            ),
+            mock.patch("self_service.analyze.config",
+                customer_config_dir="/configs",
+            ),
+        ]
+        for ptch in self.config:
+            ptch.start()
+
+    def tearDown(self):
+        log.flush()
+        for ptch in self.config:
+            ptch.stop()
+
+    # pylint: disable=no-self-use
+    def test_trie_finds_every_overlap(self):
+        rng = random.Random(0)
+        segments = ["a", "b", "ab", "+"]
+        rules = []
+        for i in range(200):
+            path = "customer/" + "/".join(rng.choice(segments) for _ in range(rng.randint(1, 3)))
+            if rng.random() < 0.5:
+                path = path + "/*" if path.endswith("+") else rng.choice([path + "*", path + "/*"])
+            rules.append(analyze.Rule(path, Capability.READ, ("group", str(i)), "a.yml"))
+        trie = analyze.PathTrie()
+        for rule in rules:
+            trie.insert(rule)
+        for rule in rules:
+            found = sorted(r.target[1] for r in trie.overlapping(rule.pattern))
+            expected = sorted(
+                r.target[1] for r in rules if compact.overlaps(r.pattern, rule.pattern)
+            )
+            assert found == expected, rule.pattern.path
+
+    def test_report(self):
+        ops_1 = parse.CustomerConfig(groups=[
+            {"name": "ops", "policies": [
+                {"path": "customer/app/*", "capabilities": ["read", "list"]},
+            ]},
+            {"name": "devs", "policies": [
+                {"path": "customer/app/prod/*", "capabilities": ["deny"]},
+            ]},
+        ])
+        ops_1.source = "/configs/ops.yml"
+        ops_2 = parse.CustomerConfig(groups=[
+            {"name": "ops", "policies": [
+                {"path": "customer/app/prod/*", "capabilities": ["read"]},
+            ]},
+            {"name": "devs", "policies": [
+                {"path": "customer/app/prod/db", "capabilities": ["read"]},
+            ]},
+        ])
+        ops_2.source = "/configs/team/app.yml"
+
+        report = analyze.analyze(analyze.collect_rules([ops_1, ops_2]))
+        assert [(r.target, r.source, d.target) for r, d in report["shadowed"]] == [
+            (("group", "ops"), "team/app.yml", ("group", "devs")),
+        ]
+        assert [(r.pattern.path, o.pattern.path) for r, o in report["conflicts"]] == [
+            ("customer/app/*", "customer/app/prod/*"),
+            ("customer/app/prod/*", "customer/app/prod/db"),
+        ]
+        text = analyze.format_report(report)
+        assert "by deny group 'devs' [deny] on 'customer/app/prod/*' (ops.yml)" in text
+        assert "for tokens with both policies" in text
+
+    def test_narrower_grant_wins(self):
+        conf = parse.CustomerConfig(groups=[
+            {"name": "ops", "policies": [
+                {"path": "customer/app/prod/db", "capabilities": ["read"]},
+                {"path": "customer/app/prod/+", "capabilities": ["read"]},
+            ]},
+            {"name": "devs", "policies": [
+                {"path": "customer/app/prod/*", "capabilities": ["deny"]},
+            ]},
+        ])
+        report = analyze.analyze(analyze.collect_rules([conf]))
+        assert report["shadowed"] == []
+
+    def test_no_findings(self):
+        assert analyze.format_report(analyze.analyze([])) == "No shadowed or conflicting rules."
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
+
+import pytest
+
+from self_service import asyncvault
+from self_service.parse import Capability
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.calls.append((self.command, self.path, json.loads(body)))
+        status = 500 if "broken" in self.path else 204
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # pylint: disable=invalid-name
+    def do_POST(self):
+        self._handle()
+
+    # pylint: disable=invalid-name
+    def do_PUT(self):
+        self._handle()
+
+    def log_message(self, *args):
+        pass
+
+class TestAsyncVault(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.calls = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config = [
+            mock.patch("self_service.asyncvault.config",
+                vault_addr=f"http://127.0.0.1:{self.server.server_port}",
+                async_concurrency=2,
+                vault_connect_timeout=5,
+                vault_read_timeout=5,
+            ),
+            mock.patch("self_service.log.config",
+                quiet=True,
+                verbose=False,
+                log_level="",
+                log_format="text",
+                log_buffer_lines=512,
+            ),
+        ]
+        for ptch in self.config:
+            ptch.start()
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_apply(self):
+        results = asyncvault.apply(
+            token="mock_token",
+            groups={"customer ops": "group-customer-customer ops"},
+            approles={"customer-app": "approle-customer-app"},
+            policies={
+                "group-customer-customer ops": {
+                    "customer/data/foo/*": Capability.READ | Capability.LIST,
+                },
+                "approle-customer-app": {"customer/data/foo/prod": Capability.READ},
+            },
+        )
+        assert all(results.values())
+        assert len(results) == 4
+        assert ("POST", "/v1/auth/ldap/groups/customer%20ops",
+            {"policies": ["group-customer-customer ops"]}) in self.server.calls
+        assert ("POST", "/v1/auth/approle/role/customer-app",
+            {"policies": ["approle-customer-app"]}) in self.server.calls
+        assert ("PUT", "/v1/sys/policy/approle-customer-app",
+            {"policy": json.dumps({"path": {
+                "customer/data/foo/prod": {"capabilities": ["read"]},
+            }})}) in self.server.calls
+        # Policies are written before anything that references them
+        assert self.server.calls[-1][0] == "POST"
+
+    def test_failed_policy_skips_group(self):
+        results = asyncvault.apply(
+            token="mock_token",
+            groups={"ops": "group-broken"},
+            approles={},
+            policies={"group-broken": {"customer/data/foo": Capability.READ}},
+        )
+        assert results == {("policy", "group-broken"): False, ("group", "ops"): False}
+        assert [c[0] for c in self.server.calls] == ["PUT"]
+
+    # pylint: disable=no-self-use,protected-access
+    def test_failed_retry_closes_connections(self):
+        writers = [mock.Mock(), mock.Mock()]
+
+        async def request():
+            client = asyncvault.AsyncVaultClient("http://127.0.0.1:1", "mock_token", 1)
+            client._idle.append((None, writers[0]))
+            with mock.patch.object(client, "_connect", return_value=(None, writers[1])), \
+                    mock.patch.object(client, "_roundtrip", side_effect=ConnectionResetError):
+                await client._request("PUT", "/v1/sys/policy/p", b"{}")
+
+        with pytest.raises(ConnectionResetError):
+            asyncio.run(request())
+        for writer in writers:
+            writer.close.assert_called_once_with()
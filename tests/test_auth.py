@@ -0,0 +1,115 @@
+import json
+import os
+import stat
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from self_service import auth, log
+
+def _auth_response(token, ttl=3600):
+    return {"auth": {"client_token": token, "lease_duration": ttl, "renewable": True}}
+
+class TestAuth(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp_dir.name, "token.json")
+        self.config = mock.patch("self_service.auth.config",
+            vault_addr="mock_vault_addr",
+            vault_token="",
+            vault_role_id="mock_vault_role_id",
+            vault_role_secret="mock_role_secret",
+            vault_token_cache_file=self.cache_file,
+        )
+        self.config.start()
+        auth.reset()
+        self.client = mock.Mock()
+        self.client.auth_approle.return_value = _auth_response("first")
+
+    def tearDown(self):
+        log.flush()
+        self.config.stop()
+        self.tmp_dir.cleanup()
+        auth.reset()
+
+    def test_token_is_reused(self):
+        auth.authenticate(self.client)
+        other_client = mock.Mock()
+        auth.authenticate(other_client)
+        self.client.auth_approle.assert_called_once_with("mock_vault_role_id", "mock_role_secret")
+        other_client.auth_approle.assert_not_called()
+        other_client.is_authenticated.assert_not_called()
+        assert other_client.token == "first"
+
+    def test_token_file(self):
+        auth.authenticate(self.client)
+        assert stat.S_IMODE(os.stat(self.cache_file).st_mode) == 0o600
+        auth.reset()
+        next_run = mock.Mock()
+        auth.authenticate(next_run)
+        next_run.auth_approle.assert_not_called()
+        assert next_run.token == "first"
+
+        # Files readable by others are not trusted
+        auth.reset()
+        os.chmod(self.cache_file, 0o644)
+        auth.authenticate(next_run)
+        next_run.auth_approle.assert_called_once()
+
+    def test_renew_before_expiry(self):
+        with open(self.cache_file, "w", encoding="utf-8") as handle:
+            json.dump({
+                # pylint: disable=protected-access
+                "key": auth._cache_key(),
+                "token": "old",
+                "ttl": 3600,
+                "renewable": True,
+                "expires_at": time.time() + 60,
+            }, handle)
+        os.chmod(self.cache_file, 0o600)
+        self.client.auth.token.renew_self.return_value = _auth_response("old")
+        auth.authenticate(self.client)
+        self.client.auth.token.renew_self.assert_called_once()
+        self.client.auth_approle.assert_not_called()
+        assert self.client.token == "old"
+
+    def _lookup(self, ttl, renewable=True):
+        self.client.auth.token.lookup_self.return_value = {"data": {
+            "ttl": ttl, "creation_ttl": 3600, "renewable": renewable,
+        }}
+
+    def test_static_token(self):
+        self._lookup(3600)
+        with mock.patch("self_service.auth.config.vault_token", "static"):
+            auth.authenticate(self.client)
+            auth.authenticate(self.client)
+        self.client.auth.token.lookup_self.assert_called_once()
+        self.client.auth.token.renew_self.assert_not_called()
+        self.client.auth_approle.assert_not_called()
+        assert self.client.token == "static"
+
+    def test_static_token_is_renewed(self):
+        self._lookup(3600)
+        self.client.auth.token.renew_self.return_value = _auth_response("static")
+        with mock.patch("self_service.auth.config.vault_token", "static"):
+            auth.authenticate(self.client)
+            # Later, in a long running daemon
+            with mock.patch("self_service.auth.time.time", return_value=time.time() + 3000):
+                auth.authenticate(self.client)
+        self.client.auth.token.lookup_self.assert_called_once()
+        self.client.auth.token.renew_self.assert_called_once()
+        assert self.client.token == "static"
+
+    def test_static_token_expiry(self):
+        self._lookup(60, renewable=False)
+        with mock.patch("self_service.auth.config.vault_token", "static"), \
+                mock.patch("self_service.auth.log.critical") as critical:
+            auth.authenticate(self.client)
+            assert "cannot be renewed" in critical.call_args.args[0]
+            assert self.client.token == "static"
+            with mock.patch("self_service.auth.time.time", return_value=time.time() + 120):
+                auth.authenticate(self.client)
+            assert "has expired" in critical.call_args.args[0]
+        self.client.auth.token.renew_self.assert_not_called()
@@ -0,0 +1,117 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+import pytest
+
+from benchmarks.fake_vault import FakeVault
+from self_service import auth, batch, config
+
+class TestBatch(TestCase):
+
+    def setUp(self):
+        self.config = [
+            mock.patch("self_service.config.batch_manifest",
+                "tests/examples/batch-manifest.yml",
+            ),
+            mock.patch("self_service.config.only_validate",
+                False,
+            ),
+            mock.patch("self_service.config.verbose",
+                False,
+            ),
+            mock.patch("self_service.config.quiet",
+                True,
+            ),
+        ]
+        for ptch in self.config:
+            ptch.start()
+        auth.reset()
+        self.hvac_client = mock.Mock()
+        self.hvac_client.is_authenticated.return_value = False
+        self.hvac_client.auth_approle.return_value = {"auth": {
+            "client_token": "mock_token", "lease_duration": 3600, "renewable": True,
+        }}
+        self.hvac_client.auth.ldap.create_or_update_group.return_value = mock.Mock(status_code=204)
+        self.hvac_client.write.return_value = mock.Mock(status_code=204)
+        self.hvac_client.sys.create_or_update_policy.return_value = mock.Mock(status_code=204)
+        self.hvac_patch = mock.patch("self_service.hashivault.hvac")
+        self.hvac = self.hvac_patch.start()
+        self.hvac.Client.return_value = self.hvac_client
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+        self.hvac_patch.stop()
+
+    # pylint: disable=no-self-use
+    def test_parse_manifest(self):
+        tenants = batch.parse_manifest("tests/examples/batch-manifest.yml")
+        assert [t.customer_prefix for t in tenants] == ["customer", "other"]
+        assert tenants[0].customer_config_dir == "tests/examples/customer_dir"
+        assert tenants[0].invalid_group_prefix == ""
+
+    # pylint: disable=no-self-use
+    def test_per_tenant_results(self):
+        prefix = config.customer_prefix
+        with pytest.raises(ValueError) as err:
+            batch.main()
+        assert "Error(s) processing 1 of 2 tenants" in str(err.value)
+        assert "Tenant 'other'" in str(err.value)
+        assert "Tenant 'customer'" not in str(err.value)
+        assert "All policy paths must be children of 'other'" in str(err.value)
+        assert config.customer_prefix == prefix
+
+        # One client and one login shared by every tenant
+        self.hvac.Client.assert_called_once()
+        self.hvac_client.auth_approle.assert_called_once()
+        self.hvac_client.auth.ldap.create_or_update_group.assert_has_calls([
+            mock.call(name="customer-ops",
+                policies=["group-customer-customer-ops"]),
+        ], any_order=True)
+
+    def test_shard(self):
+        # Of two shards, "customer" belongs to 0 and "other" to 1
+        with mock.patch("self_service.config.shard_count", 2), \
+                mock.patch("self_service.config.shard_index", 0):
+            assert batch.main()
+        self.hvac_client.sys.create_or_update_policy.assert_called()
+
+class TestBatchPrune(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.tmp_dir.name, "other.yml"), "w", encoding="utf-8") as handle:
+            handle.write("groups:\n  - name: other-ops\n    policies:\n"
+                "      - path: other/app/*\n        capabilities: [read]\n")
+        self.vault = FakeVault().__enter__()
+        self.config = [
+            mock.patch("self_service.config.vault_addr", self.vault.addr),
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.only_validate", False),
+            mock.patch("self_service.config.prune_orphans", True),
+            mock.patch("self_service.config.quiet", True),
+            mock.patch("self_service.config.verbose", False),
+            mock.patch("self_service.hashivault.auth"),
+        ]
+        for ptch in self.config:
+            ptch.start()
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+        self.vault.__exit__()
+        self.tmp_dir.cleanup()
+
+    def test_prune_per_tenant(self):
+        tenants = [
+            batch.Tenant("customer", "tests/examples/customer_dir"),
+            batch.Tenant("other", self.tmp_dir.name),
+        ]
+        assert batch.run(tenants) == { "customer": None, "other": None }
+        written = { kind: sorted(objects) for kind, objects in self.vault.objects.items() }
+        # Pruning one tenant leaves every other tenant's objects alone
+        assert batch.run(tenants) == { "customer": None, "other": None }
+        assert self.vault.count("DELETE") == 0
+        assert { kind: sorted(objects) for kind, objects in self.vault.objects.items() } == written
+        assert "group-other-other-ops" in written["policies"]
@@ -0,0 +1,31 @@
+from unittest import TestCase, mock
+
+from benchmarks import run
+
+class TestBenchmarks(TestCase):
+
+    def setUp(self):
+        # The benchmark configures the global config, put it back afterwards
+        self.config = [
+            mock.patch("self_service.config." + key)
+            for key in [
+                "customer_prefix", "customer_config_dir", "invalid_group_prefix",
+                "vault_addr", "vault_token", "only_validate", "plan_only",
+                "quiet", "verbose",
+            ]
+        ]
+        for ptch in self.config:
+            ptch.start()
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+
+    # pylint: disable=no-self-use
+    def test_smoke(self):
+        results = run.run(files=2, groups=2, approles=1, rules=2)
+        assert results["objects"] > 0
+        # The second apply only reads, since nothing changed
+        assert results["apply_steady_state_requests"] == results["objects"]
+        assert run.compare(results, {"flatten": results["flatten"] / 10}, 0.5)
+        assert not run.compare(results, {"flatten": results["flatten"]}, 0.5)
@@ -0,0 +1,74 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from self_service import cache, parse
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.config = mock.patch("self_service.config.customer_prefix", "customer")
+        self.cache_config = [
+            mock.patch("self_service.config.parse_cache_dir", self.cache_dir.name),
+            mock.patch("self_service.config.parse_cache_max_entries", 1),
+            mock.patch("self_service.config.invalid_group_prefix", ""),
+            mock.patch("self_service.config.quiet", True),
+            mock.patch("self_service.config.verbose", False),
+        ]
+        self.config.start()
+        for ptch in self.cache_config:
+            ptch.start()
+
+    def tearDown(self):
+        self.config.stop()
+        for ptch in self.cache_config:
+            ptch.stop()
+        self.cache_dir.cleanup()
+
+    # pylint: disable=no-self-use
+    def test_unchanged_file_skips_parsing(self):
+        first = parse.parse_file('tests/examples/correct.yml')
+        with mock.patch("self_service.parse.load_content") as load_content:
+            second = parse.parse_file('tests/examples/correct.yml')
+        load_content.assert_not_called()
+        assert [g.name for g in second.groups] == [g.name for g in first.groups]
+        assert second.groups[0].policies[0].capabilities == \
+            first.groups[0].policies[0].capabilities
+
+    # pylint: disable=no-self-use
+    def test_key_includes_validation_inputs(self):
+        content = b"groups: []"
+        key = cache.key(content)
+        with mock.patch("self_service.config.invalid_group_prefix", "bad-group"):
+            assert cache.key(content) != key
+        with mock.patch("self_service.config.customer_prefix", "other"):
+            assert cache.key(content) != key
+
+    # pylint: disable=no-self-use
+    def test_evict(self):
+        cache.put("old", "value")
+        os.utime(os.path.join(self.cache_dir.name, "old.pickle"), (0, 0))
+        cache.put("new", "value")
+        assert cache.evict() == 1
+        assert cache.get("old") is None
+        assert cache.get("new") == "value"
+
+    def test_only_private_entries_are_loaded(self):
+        cache.put("key", "value")
+        entry = os.path.join(self.cache_dir.name, "key.pickle")
+        assert os.stat(entry).st_mode & 0o777 == 0o600
+        os.chmod(entry, 0o666)
+        assert cache.get("key") is None
+        os.chmod(entry, 0o600)
+        assert cache.get("key") == "value"
+        with mock.patch("self_service.cache.os.getuid", return_value=os.getuid() + 1):
+            assert cache.get("key") is None
+
+    # pylint: disable=no-self-use
+    def test_disabled(self):
+        with mock.patch("self_service.config.parse_cache_dir", ""):
+            cache.put("key", "value")
+            assert cache.get("key") is None
+        assert not os.listdir(self.cache_dir.name)
@@ -0,0 +1,137 @@
+import random
+import re
+from unittest import TestCase, mock
+
+from self_service import compact
+from self_service.compact import Pattern
+from self_service.parse import Capability
+
+def _matches(path, request):
+    pattern = "/".join("[^/]+" if s == "+" else re.escape(s) for s in path.rstrip("*").split("/"))
+    if path.endswith("*"):
+        return re.match(pattern, request) is not None
+    return re.fullmatch(pattern, request) is not None
+
+def _decide(policy, request):
+    """The capabilities vault grants for a request, from the highest priority match."""
+    matching = [p for p in policy if _matches(p, request)]
+    if not matching:
+        return None
+    return policy[max(matching, key=lambda p: Pattern(p).key)]
+
+class TestCompact(TestCase):
+
+    def setUp(self):
+        self.log = mock.patch("self_service.compact.log")
+        self.log.start()
+
+    def tearDown(self):
+        self.log.stop()
+
+    # pylint: disable=no-self-use
+    def test_covers(self):
+        assert compact.covers(Pattern("customer/foo/*"), Pattern("customer/foo/bar"))
+        assert compact.covers(Pattern("customer/foo*"), Pattern("customer/foobar/*"))
+        assert compact.covers(Pattern("customer/+/prod"), Pattern("customer/app/prod"))
+        assert compact.covers(Pattern("customer/+/*"), Pattern("customer/+/prod"))
+        assert not compact.covers(Pattern("customer/foo/*"), Pattern("customer/foo"))
+        assert not compact.covers(Pattern("customer/app/prod"), Pattern("customer/+/prod"))
+        assert not compact.covers(Pattern("customer/foo*"), Pattern("customer/f*"))
+
+    def test_overlaps(self):
+        assert compact.overlaps(Pattern("customer/+/prod"), Pattern("customer/app/+"))
+        assert compact.overlaps(Pattern("customer/fo*"), Pattern("customer/foo/bar"))
+        assert not compact.overlaps(Pattern("customer/foo/*"), Pattern("customer/bar/*"))
+        assert not compact.overlaps(Pattern("customer/foo/bar"), Pattern("customer/foo"))
+
+    def test_removes_covered_rules(self):
+        assert compact.compact_policy({
+            "customer/foo/*": Capability.READ | Capability.LIST,
+            "customer/foo/bar": Capability.READ | Capability.LIST,
+            "customer/+/prod": Capability.READ,
+            "customer/app/prod": Capability.READ,
+        }) == {
+            "customer/foo/*": Capability.READ | Capability.LIST,
+            "customer/+/prod": Capability.READ,
+        }
+
+    def test_keeps_weaker_and_deny_rules(self):
+        policy = {
+            "customer/foo/*": Capability.READ | Capability.LIST,
+            "customer/foo/bar": Capability.READ,
+            "customer/foo/secret": Capability.DENY,
+        }
+        assert compact.compact_policy(policy) == policy
+
+    def test_keeps_rules_shadowed_in_between(self):
+        policy = {
+            "customer/*": Capability.READ,
+            "customer/foo/*": Capability.READ | Capability.UPDATE,
+            "customer/foo/bar": Capability.READ,
+        }
+        assert compact.compact_policy(policy) == policy
+
+    def test_keeps_rules_shadowed_by_other_policies(self):
+        flat = {
+            "groups": {},
+            "approles": {},
+            "policies": {
+                "group-customer-a": {
+                    "customer/*": Capability.READ,
+                    "customer/foo/bar": Capability.READ,
+                    "customer/bar/baz": Capability.READ,
+                },
+                "group-customer-b": {"customer/foo/*": Capability.DENY},
+            },
+            "paths": set(),
+        }
+        with mock.patch("self_service.compact.metrics"):
+            result = compact.compact(flat)
+        # customer/foo/* would decide customer/foo/bar for a token with both
+        assert result["policies"]["group-customer-a"] == {
+            "customer/*": Capability.READ,
+            "customer/foo/bar": Capability.READ,
+        }
+
+    def test_compact_reports_counts(self):
+        flat = {
+            "groups": {},
+            "approles": {},
+            "policies": {"group-customer-ops": {
+                "customer/foo/*": Capability.READ,
+                "customer/foo/bar": Capability.READ,
+            }},
+            "paths": set(),
+        }
+        with mock.patch("self_service.compact.metrics") as metrics:
+            result = compact.compact(flat)
+        assert result["policies"] == {
+            "group-customer-ops": {"customer/foo/*": Capability.READ},
+        }
+        assert len(flat["policies"]["group-customer-ops"]) == 2
+        metrics.count.assert_any_call("policy_rules", 2)
+        metrics.count.assert_any_call("compacted_policy_rules", 1)
+
+    def test_preserves_decisions(self):
+        rng = random.Random(0)
+        segments = ["a", "b", "ab", "+"]
+        capabilities = [Capability.READ, Capability.READ | Capability.LIST, Capability.DENY]
+        requests = [
+            "customer/" + "/".join(p)
+            for p in [(x,) for x in ["a", "b", "ab", "abc"]]
+                + [(x, y) for x in ["a", "b", "ab"] for y in ["a", "b", "ab", "abc"]]
+                + [(x, y, "a") for x in ["a", "ab"] for y in ["a", "b"]]
+        ]
+        for _ in range(300):
+            policy = {}
+            for _ in range(rng.randint(2, 7)):
+                path = "customer/" + "/".join(
+                    rng.choice(segments) for _ in range(rng.randint(1, 2))
+                )
+                if rng.random() < 0.5:
+                    path = rng.choice([path + "*", path + "/*"])
+                policy[path] = rng.choice(capabilities)
+            compacted = compact.compact_policy(policy)
+            for request in requests:
+                assert _decide(policy, request) == _decide(compacted, request), \
+                    (policy, compacted, request)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from self_service import daemon
+
+class TestDaemon(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        for name in os.listdir("tests/examples/customer_dir"):
+            shutil.copy(os.path.join("tests/examples/customer_dir", name), self.tmp_dir.name)
+        self.config = [
+            mock.patch("self_service.config.customer_config_dir", self.tmp_dir.name),
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.invalid_group_prefix", ""),
+            mock.patch("self_service.config.only_validate", False),
+            mock.patch("self_service.config.diff_apply", False),
+            mock.patch("self_service.config.quiet", True),
+            mock.patch("self_service.config.verbose", False),
+        ]
+        for ptch in self.config:
+            ptch.start()
+        self.hvac_patch = mock.patch("self_service.hashivault.hvac")
+        self.hvac = self.hvac_patch.start()
+        self.client = self.hvac.Client.return_value
+        self.client.auth.ldap.create_or_update_group.return_value = mock.Mock(status_code=204)
+        self.client.write.return_value = mock.Mock(status_code=204)
+        self.client.sys.create_or_update_policy.return_value = mock.Mock(status_code=204)
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+        self.hvac_patch.stop()
+        self.tmp_dir.cleanup()
+
+    def _written_policies(self):
+        return {
+            c.kwargs["name"] for c in self.client.sys.create_or_update_policy.call_args_list
+        }
+
+    def _write(self, name, content):
+        with open(os.path.join(self.tmp_dir.name, name), "w", encoding="utf-8") as handle:
+            handle.write(content)
+
+    def test_reconcile_only_changes(self):
+        state = daemon.Daemon()
+        state.reconcile()
+        assert state.status()["ready"]
+        assert state.status()["last_success"]
+        assert len(self._written_policies()) == 5
+        self.client.reset_mock()
+
+        # Nothing changed, nothing written
+        state.reconcile()
+        assert not self._written_policies()
+
+        os.remove(os.path.join(self.tmp_dir.name, "bar-app.yaml"))
+        state.reconcile()
+        assert self._written_policies() == {"group-customer-customer-ops"}
+        # The client is kept warm between reconciles
+        self.hvac.Client.assert_called_once()
+
+    def test_invalid_change_keeps_state(self):
+        state = daemon.Daemon()
+        state.reconcile()
+        self._write("bad.yml", "groups:\n  - name: 'no, commas'\n")
+        state.reconcile()
+        assert not state.status()["last_success"]
+        assert "Invalid group name" in state.status()["last_error"]
+        assert state.status()["ready"]
+        assert state.index is not None
+
+    def test_invalid_file_is_skipped(self):
+        state = daemon.Daemon()
+        state.reconcile()
+        self._write("bad.yml", "groups:\n  - name: 'no, commas'\n")
+        state.reconcile()
+        self.client.reset_mock()
+        # Other changes are applied while the invalid file is unchanged
+        self._write("new.yml", "groups:\n  - name: new\n    policies:\n"
+            "      - path: customer/new/*\n        capabilities: [read]\n")
+        state.reconcile()
+        assert self._written_policies() == {"group-customer-new"}
+        assert state.status()["last_success"]
+
+    def test_invalid_file_at_startup(self):
+        self._write("bad.yml", "groups:\n  - name: 'no, commas'\n")
+        state = daemon.Daemon()
+        state.reconcile()
+        assert state.status()["ready"]
+        assert "Invalid group name" in state.status()["last_error"]
+        # Valid files are applied, and nothing is reparsed until a file changes
+        assert len(self._written_policies()) == 5
+        assert state.index is not None
+        self.client.reset_mock()
+        state.reconcile()
+        assert not self._written_policies()
+
+    def test_polling_watcher(self):
+        with mock.patch("self_service.config.daemon_poll_seconds", 1):
+            watcher = daemon.PollingWatcher(self.tmp_dir.name)
+            assert not watcher.wait(0)
+            os.remove(os.path.join(self.tmp_dir.name, "bar-app.yaml"))
+            assert watcher.wait(0)
+            assert not watcher.wait(0)
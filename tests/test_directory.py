@@ -0,0 +1,109 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import pytest
+
+from self_service import directory, validator
+from self_service.self_service import parse_customer_configs
+
+LDIF = """# extended LDIF
+dn: cn=customer-prod-admin,ou=groups,dc=example,dc=com
+objectClass: groupOfNames
+cn: customer-prod-admin
+
+dn: cn=Customer-Dev-Admin,ou=groups,dc=example,dc=com
+cn: Customer-Dev-Admin
+
+dn: cn=customer-a-very-long-group-name-folded-across-lines,ou=groups,dc=exam
+ ple,dc=com
+cn: customer-a-very-long-group-name-fol
+ ded-across-lines
+
+dn: cn=customer-encoded,ou=groups,dc=example,dc=com
+cn:: Y3VzdG9tZXItZW5jb2RlZA==
+"""
+
+class TestDirectory(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.groups_file = os.path.join(self.tmp_dir.name, "groups.ldif")
+        self._write(LDIF)
+        self.config = [
+            mock.patch("self_service.config.ldap_groups_file", self.groups_file),
+            mock.patch("self_service.config.ldap_group_attribute", "cn"),
+            mock.patch("self_service.config.ldap_groups_ttl", 300),
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.invalid_group_prefix", ""),
+            mock.patch("self_service.config.parse_cache_dir", ""),
+            mock.patch("self_service.config.parse_workers", 1),
+            mock.patch("self_service.config.quiet", True),
+        ]
+        for ptch in self.config:
+            ptch.start()
+        directory.reset()
+        validator.reset()
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+        directory.reset()
+        self.tmp_dir.cleanup()
+
+    def _write(self, text):
+        with open(self.groups_file, "w", encoding="utf-8") as handle:
+            handle.write(text)
+
+    # pylint: disable=no-self-use
+    def test_parse_snapshot(self):
+        assert directory.parse_snapshot(LDIF) == {
+            "customer-prod-admin",
+            "Customer-Dev-Admin",
+            "customer-a-very-long-group-name-folded-across-lines",
+            "customer-encoded",
+        }
+        assert directory.parse_snapshot("# stand-in\ncustomer-ops\n\n  customer-devs \n") == {
+            "customer-ops", "customer-devs",
+        }
+
+    def test_accessor_groups(self):
+        assert parse_customer_configs(["tests/examples/approle-accessors.yml"])
+        self._write("customer-dev-admin\n")
+        directory.reset()
+        with pytest.raises(ValueError) as err:
+            parse_customer_configs(["tests/examples/approle-accessors.yml"])
+        assert str(err.value).endswith(
+            "Error parsing 'tests/examples/approle-accessors.yml', "
+            "no LDAP group named 'customer-prod-admin'"
+        )
+
+    def test_one_load_per_snapshot(self):
+        names = [f"customer-group-{i}" for i in range(5000)]
+        self._write("\n".join(names))
+        with mock.patch("self_service.directory.parse_snapshot",
+                wraps=directory.parse_snapshot) as load:
+            assert directory.missing(names + ["customer-typo"]) == ["customer-typo"]
+            assert directory.missing(["Customer-Group-1"]) == []
+            assert load.call_count == 1
+            # Reloaded once stale, but only if the file changed
+            with mock.patch("self_service.config.ldap_groups_ttl", 0):
+                directory.groups()
+                assert load.call_count == 1
+                self._write("customer-typo\n")
+                os.utime(self.groups_file, ns=(0, 0))
+                assert directory.missing(["customer-typo", "customer-group-1"]) \
+                    == ["customer-group-1"]
+                assert load.call_count == 2
+
+    def test_validator(self):
+        with open("tests/examples/correct.yml", encoding="utf-8") as handle:
+            files = { "correct.yml": handle.read() }
+        result = validator.validate("customer", files)
+        assert result["files"]["correct.yml"]["error"] == \
+            "Error parsing 'correct.yml', no LDAP group named " \
+            "'customer-prod-reader', 'customer-dev-reader'"
+        self._write(LDIF + "\ndn: cn=r\ncn: customer-prod-reader\ncn: customer-dev-reader\n")
+        directory.reset()
+        assert validator.validate("customer", files)["valid"]
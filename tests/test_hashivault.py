@@ -1,7 +1,13 @@
+import io
+import json
 from unittest import TestCase, mock
 #import pytest
+import hvac
+from hvac.exceptions import InvalidPath
 
-from self_service import hashivault
+from benchmarks.fake_vault import FakeVault
+from self_service import hashivault, log, reconcile
+from self_service.parse import Capability
 
 class TestApply(TestCase):
 
@@ -17,10 +23,12 @@ class TestApply(TestCase):
     # pylint: disable=no-self-use
     def test_mangle(self):
         in_policy = {
-            'customer/app/prod/*': [ 'create', 'read', 'update', 'delete', 'list' ],
-            'customer/app/dev/*': [ 'deny' ],
-            'auth/approle/role/foo-Approle-1/role-id': [ 'read' ],
-            'auth/approle/role/foo-Approle-1/secret-id': [ 'create', 'update' ],
+            'customer/app/prod/*':
+                Capability.from_names([ 'create', 'read', 'update', 'delete', 'list' ]),
+            'customer/app/dev/*': Capability.from_names([ 'deny' ]),
+            'auth/approle/role/foo-Approle-1/role-id': Capability.from_names([ 'read' ]),
+            'auth/approle/role/foo-Approle-1/secret-id':
+                Capability.from_names([ 'create', 'update' ]),
         }
         # pylint: disable=protected-access
         out_policy = hashivault._mangle_kv_v2_policy(in_policy)
@@ -34,11 +42,240 @@ class TestApply(TestCase):
             'auth/approle/role/foo-Approle-1/role-id',
             'auth/approle/role/foo-Approle-1/secret-id',
         }
-        assert set(out_policy['customer/data/app/dev/*']) == {'deny'}
-        assert set(out_policy['customer/data/app/prod/*']) == {'create', 'read', 'update', 'delete'}
-        assert set(out_policy['customer/metadata/app/prod/*']) == {'read', 'delete', 'list'}
-        assert set(out_policy['customer/delete/app/prod/*']) == {'update'}
-        assert set(out_policy['customer/destroy/app/prod/*']) == {'update'}
-        assert set(out_policy['customer/undelete/app/prod/*']) == {'update'}
-        assert set(out_policy['auth/approle/role/foo-Approle-1/role-id']) == {'read'}
-        assert set(out_policy['auth/approle/role/foo-Approle-1/secret-id']) == {'create', 'update'}
+        assert out_policy['customer/data/app/dev/*'].names() == ['deny']
+        assert out_policy['customer/data/app/prod/*'].names() == \
+            ['create', 'delete', 'read', 'update']
+        assert out_policy['customer/metadata/app/prod/*'].names() == ['delete', 'list', 'read']
+        assert out_policy['customer/delete/app/prod/*'].names() == ['update']
+        assert out_policy['customer/destroy/app/prod/*'].names() == ['update']
+        assert out_policy['customer/undelete/app/prod/*'].names() == ['update']
+        assert out_policy['auth/approle/role/foo-Approle-1/role-id'].names() == ['read']
+        assert out_policy['auth/approle/role/foo-Approle-1/secret-id'].names() == \
+            ['create', 'update']
+
+
+class TestDiffApply(TestCase):
+
+    def setUp(self):
+        self.config = mock.patch('self_service.hashivault.config',
+            diff_apply=True,
+            plan_only=False,
+            apply_concurrency=4,
+            apply_backend="threads",
+        )
+        self.config.start()
+        self.client = mock.Mock()
+        self.client.auth.ldap.read_group.return_value = {
+            'data': {'policies': ['group-customer-ops']},
+        }
+        self.client.read.return_value = {
+            'data': {'token_policies': ['approle-customer-app']},
+        }
+        self.client.sys.read_policy.return_value = {
+            'data': {'rules': json.dumps({'path': {
+                'customer/data/app/*': {'capabilities': ['read']},
+            }})},
+        }
+
+    def tearDown(self):
+        log.flush()
+        self.config.stop()
+
+    def _apply(self, policy_caps):
+        return hashivault.apply_flat_config(
+            groups={'ops': 'group-customer-ops'},
+            approles={'customer-app': 'approle-customer-app'},
+            policies={
+                'group-customer-ops': {'customer/app/*': policy_caps},
+                'approle-customer-app': {'customer/app/*': policy_caps},
+            },
+            paths=set(),
+            client=self.client,
+        )
+
+    def test_unchanged_state_skips_writes(self):
+        assert self._apply(Capability.READ)
+        self.client.auth.ldap.create_or_update_group.assert_not_called()
+        self.client.write.assert_not_called()
+        self.client.sys.create_or_update_policy.assert_not_called()
+
+    def test_only_changes_are_written(self):
+        self.client.auth.ldap.read_group.side_effect = InvalidPath
+        self.client.sys.create_or_update_policy.return_value = mock.Mock(status_code=204)
+        self.client.auth.ldap.create_or_update_group.return_value = mock.Mock(status_code=204)
+        assert self._apply(Capability.READ | Capability.UPDATE)
+        self.client.auth.ldap.create_or_update_group.assert_called_once_with(
+            name='ops', policies=['group-customer-ops'],
+        )
+        self.client.write.assert_not_called()
+        assert self.client.sys.create_or_update_policy.call_count == 2
+
+    def test_plan_only(self):
+        self.client.sys.read_policy.side_effect = InvalidPath
+        with mock.patch('self_service.hashivault.config.plan_only', True):
+            assert self._apply(Capability.READ)
+        self.client.sys.create_or_update_policy.assert_not_called()
+
+    # pylint: disable=no-self-use
+    def test_policy_names_ignore_case(self):
+        changes = reconcile.plan(
+            desired={
+                'groups': {'Ops': ['group-customer-Ops']},
+                'approles': {'foo-Approle-1': ['approle-foo-Approle-1']},
+                'policies': {},
+            },
+            current={
+                'groups': {'Ops': ['group-customer-ops']},
+                'approles': {'foo-Approle-1': ['approle-foo-approle-1']},
+                'policies': {},
+            },
+        )
+        assert reconcile.count(changes) == 0
+
+    # pylint: disable=no-self-use
+    def test_format_plan(self):
+        changes = reconcile.plan(
+            desired={
+                'groups': {'ops': ['group-customer-ops']},
+                'approles': {},
+                'policies': {
+                    'group-customer-ops': {'customer/data/a': Capability.READ | Capability.LIST},
+                },
+            },
+            current={
+                'groups': {'ops': ['group-customer-ops']},
+                'approles': {},
+                'policies': {'group-customer-ops': {'customer/data/a': Capability.READ}},
+            },
+        )
+        assert reconcile.count(changes) == 1
+        assert "~ policy group-customer-ops" in reconcile.format_plan(changes)
+        assert "customer/data/a ['read'] -> ['list', 'read']" in reconcile.format_plan(changes)
+
+
+class TestPrune(TestCase):
+
+    def setUp(self):
+        self.patches = [
+            mock.patch('self_service.hashivault.config',
+                customer_prefix="customer",
+                diff_apply=True,
+                plan_only=False,
+                apply_concurrency=4,
+                apply_backend="threads",
+                prune_max_deletions=10,
+            ),
+            mock.patch('self_service.hashivault.auth'),
+        ]
+        for ptch in self.patches:
+            ptch.start()
+        self.vault = FakeVault().__enter__()
+        self.client = hvac.Client(self.vault.addr, token="token")
+        policy = {'customer/app/*': Capability.READ}
+        assert self._apply(['ops', 'old'], ['customer-app', 'customer-gone'], policy)
+        # Another customer, whose prefix starts with this one's
+        self.vault.objects["policies"]["group-customer-bar-ops"] = {"rules": json.dumps(
+            {"path": {"customer-bar/data/*": {"capabilities": ["read"]}}},
+        )}
+        self.vault.objects["groups"]["bar-ops"] = {"policies": ["group-customer-bar-ops"]}
+        # Its approle, and the LDAP group 'x' given access to it
+        self.vault.objects["policies"]["approle-customer-bar-app"] = {"rules": json.dumps(
+            {"path": {"customer-bar/data/app/*": {"capabilities": ["read"]}}},
+        )}
+        self.vault.objects["approles"]["customer-bar-app"] = {
+            "token_policies": ["approle-customer-bar-app"],
+        }
+        self.vault.objects["policies"]["group-customer-bar-x"] = {"rules": json.dumps({"path": {
+            "auth/approle/role/customer-bar-app/role-id": {"capabilities": ["read"]},
+        }})}
+        self.vault.objects["groups"]["x"] = {"policies": ["group-customer-bar-x"]}
+
+    def tearDown(self):
+        log.flush()
+        self.vault.__exit__()
+        for ptch in self.patches:
+            ptch.stop()
+
+    def _apply(self, groups, approles, policy, prune=False):
+        return hashivault.apply_flat_config(
+            groups={ g: f"group-customer-{g}" for g in groups },
+            approles={ a: f"approle-{a}" for a in approles },
+            policies={
+                **{ f"group-customer-{g}": policy for g in groups },
+                **{ f"approle-{a}": policy for a in approles },
+            },
+            paths=set(),
+            client=self.client,
+            prune=prune,
+        )
+
+    def test_find_orphans(self):
+        assert hashivault.find_orphans(self.client, {
+            "groups": ["ops"],
+            "approles": ["customer-app"],
+            "policies": ["group-customer-OPS", "approle-customer-app"],
+        }) == {
+            "groups": ["old"],
+            "approles": ["customer-gone"],
+            "policies": ["approle-customer-gone", "group-customer-old"],
+        }
+
+    def test_accessor_groups(self):
+        accessor = {
+            'auth/approle/role/customer-gone/role-id': Capability.READ,
+            'auth/approle/role/customer-gone/secret-id': Capability.CREATE | Capability.UPDATE,
+        }
+        assert hashivault.apply_flat_config(
+            groups={ "gone-users": "group-customer-gone-users" },
+            approles={},
+            policies={ "group-customer-gone-users": accessor },
+            paths=set(),
+            client=self.client,
+        )
+        orphans = hashivault.find_orphans(self.client, {
+            "groups": ["ops", "old"],
+            "approles": ["customer-app"],
+            "policies": ["group-customer-ops", "group-customer-old", "approle-customer-app"],
+        })
+        # Only the accessor group of this customer's removed approle
+        assert orphans["groups"] == ["gone-users"]
+        assert orphans["approles"] == ["customer-gone"]
+
+    def test_prune(self):
+        assert self._apply(['ops'], ['customer-app'], {'customer/app/*': Capability.READ}, True)
+        assert sorted(self.vault.objects["groups"]) == ["bar-ops", "ops", "x"]
+        assert sorted(self.vault.objects["approles"]) == ["customer-app", "customer-bar-app"]
+        assert sorted(self.vault.objects["policies"]) == [
+            "approle-customer-app", "approle-customer-bar-app",
+            "group-customer-bar-ops", "group-customer-bar-x", "group-customer-ops",
+        ]
+        # Policies are only deleted after what is attached to them
+        deletes = [p for m, p in self.vault.requests if m == "DELETE"]
+        assert deletes.index("/v1/auth/ldap/groups/old") < \
+            deletes.index("/v1/sys/policies/acl/group-customer-old")
+
+    def test_failed_write_record(self):
+        self.vault.error_rate = 1.0
+        log.flush()
+        with mock.patch("self_service.config.log_format", "json"), \
+                mock.patch("sys.stdout", new_callable=io.StringIO) as output:
+            assert not self._apply(['ops'], [], {'customer/other/*': Capability.READ})
+            log.flush()
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        failed = [r for r in records if r.get("kind") == "policy"]
+        assert failed == [mock.ANY]
+        assert failed[0]["name"] == "group-customer-ops" and failed[0]["status"] == 500
+        assert failed[0]["latency"] > 0
+        assert "injected error" in records[records.index(failed[0]) + 1]["msg"]
+
+    def test_max_deletions(self):
+        with mock.patch('self_service.hashivault.config.prune_max_deletions', 3):
+            assert not self._apply([], [], {'customer/app/*': Capability.READ}, True)
+        assert self.vault.count("DELETE") == 0
+
+    def test_plan_only(self):
+        with mock.patch('self_service.hashivault.config.plan_only', True), \
+                mock.patch('self_service.hashivault.log') as mock_log:
+            assert self._apply(['ops'], ['customer-app'], {'customer/app/*': Capability.READ}, True)
+        assert self.vault.count("DELETE") == 0
+        assert "- group old" in mock_log.log.call_args_list[-1][0][0]
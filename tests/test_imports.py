@@ -0,0 +1,44 @@
+import os
+import re
+import subprocess
+import sys
+from unittest import TestCase
+
+# Importing the vault client stack alone takes about 100ms
+IMPORT_BUDGET_MS = 150
+VAULT_CLIENT_STACK = ("hvac", "requests", "urllib3")
+
+def _import_times(args, env):
+    """Run python -X importtime, returning { module: cumulative microseconds }."""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        env={ **os.environ, **env },
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in res.stderr.splitlines():
+        match = re.match(r"^import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)", line)
+        if match:
+            times[match.group(2)] = int(match.group(1))
+    return times
+
+class TestImports(TestCase):
+
+    # pylint: disable=no-self-use
+    def test_validate_only_skips_vault_client(self):
+        times = _import_times(["entrypoint.py"], {
+            "ONLY_VALIDATE": "True",
+            "CUSTOMER_CONFIG_DIR": "tests/examples/customer_dir",
+            "CUSTOMER_PREFIX": "customer",
+            "QUIET": "True",
+        })
+        assert "self_service.parse" in times
+        assert [m for m in times if m.split(".")[0] in VAULT_CLIENT_STACK] == []
+        assert "self_service.hashivault" not in times
+
+    def test_import_budget(self):
+        times = _import_times(["-c", "import self_service"], {})
+        assert times["self_service"] < IMPORT_BUDGET_MS * 1000, \
+            f"import self_service took {times['self_service'] / 1000:.0f}ms"
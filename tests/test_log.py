@@ -0,0 +1,73 @@
+import io
+import json
+from unittest import TestCase, mock
+
+from self_service import log
+
+class TestLog(TestCase):
+
+    def setUp(self):
+        self.config = mock.patch("self_service.log.config",
+            quiet=False,
+            verbose=False,
+            log_level="",
+            log_format="json",
+            log_buffer_lines=100,
+            customer_prefix="customer",
+        )
+        self.config.start()
+        log.flush()
+        self.stdout = mock.patch("sys.stdout", new_callable=io.StringIO)
+        self.output = self.stdout.start()
+
+    def tearDown(self):
+        log.flush()
+        self.stdout.stop()
+        self.config.stop()
+
+    def records(self):
+        log.flush()
+        return [json.loads(line) for line in self.output.getvalue().splitlines()]
+
+    def test_formatting_is_deferred(self):
+        formatted = []
+
+        # pylint: disable=too-few-public-methods
+        class Arg():
+            def __str__(self):
+                formatted.append(self)
+                return "arg"
+        log.debug("not shown %s", Arg())
+        assert not formatted
+        assert self.records() == []
+
+    def test_buffered_until_flush(self):
+        log.log("Found %d files", 3)
+        assert self.output.getvalue() == ""
+        assert [(r["level"], r["msg"], r["tenant"]) for r in self.records()] == [
+            ("info", "Found 3 files", "customer"),
+        ]
+
+    def test_critical_flushes(self):
+        log.log("first")
+        log.critical("Failed to apply %s", "group foo")
+        assert len(self.output.getvalue().splitlines()) == 2
+
+    def test_record_fields(self):
+        with mock.patch("self_service.log.config.log_level", "debug"):
+            with log.context(tenant="other"):
+                log.record("policy", "group-other-ops", 204, 0.0125)
+            log.record("group", "customer-ops", 500, 0.5)
+        succeeded, failed = self.records()
+        assert succeeded["level"] == "debug"
+        assert (succeeded["tenant"], succeeded["kind"], succeeded["name"],
+            succeeded["status"], succeeded["latency"]) == \
+            ("other", "policy", "group-other-ops", 204, 0.0125)
+        assert failed["level"] == "critical"
+        assert failed["tenant"] == "customer"
+
+    def test_text_format(self):
+        with mock.patch("self_service.log.config.log_format", "text"):
+            log.log("%s is valid.", "correct.yml", file="/configs/correct.yml")
+            log.flush()
+        assert self.output.getvalue() == "correct.yml is valid.\n"
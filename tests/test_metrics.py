@@ -0,0 +1,57 @@
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from self_service import metrics
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = mock.patch("self_service.metrics.config",
+            metrics_prometheus_file=os.path.join(self.tmp_dir.name, "self_service.prom"),
+            metrics_json_file=os.path.join(self.tmp_dir.name, "self_service.json"),
+        )
+        self.config.start()
+        metrics.reset()
+
+    def tearDown(self):
+        self.config.stop()
+        self.tmp_dir.cleanup()
+        metrics.reset()
+
+    # pylint: disable=no-self-use
+    def test_endpoint_labels(self):
+        assert metrics.endpoint("POST", "/v1/auth/ldap/groups/customer ops") == \
+            "POST /v1/auth/ldap/groups/:name"
+        assert metrics.endpoint("GET", "/v1/sys/policy/group-foo?list=true") == \
+            "GET /v1/sys/policy/:name"
+        assert metrics.endpoint("GET", "/v1/auth/token/lookup-self") == \
+            "GET /v1/auth/token/lookup-self"
+
+    def test_write(self):
+        with metrics.phase("parse"):
+            pass
+        metrics.count("files", 3)
+        metrics.observe("PUT", "/v1/sys/policy/a", 0.02, 204, 100)
+        metrics.observe("PUT", "/v1/sys/policy/b", 0.2, 500, 50)
+        metrics.write()
+
+        with open(os.path.join(self.tmp_dir.name, "self_service.json"), encoding="utf-8") as handle:
+            summary = json.load(handle)
+        assert "parse" in summary["phases"]
+        assert summary["counts"] == {"files": 3}
+        req = summary["requests"]["PUT /v1/sys/policy/:name"]
+        assert req["count"] == 2
+        assert req["bytes_sent"] == 150
+        assert req["statuses"] == {"204": 1, "500": 1}
+
+        with open(os.path.join(self.tmp_dir.name, "self_service.prom"), encoding="utf-8") as handle:
+            prom = handle.read()
+        assert 'self_service_count{name="files"} 3' in prom
+        assert 'self_service_vault_request_seconds_bucket' \
+            '{endpoint="PUT /v1/sys/policy/:name",le="0.025"} 1' in prom
+        assert 'self_service_vault_request_seconds_count{endpoint="PUT /v1/sys/policy/:name"} 2' \
+            in prom
@@ -1,7 +1,7 @@
 from unittest import TestCase, mock
 import pytest
 
-from self_service import parse
+from self_service import log, parse
 
 class TestParse(TestCase):
 
@@ -13,6 +13,7 @@ class TestParse(TestCase):
         self.config.start()
 
     def tearDown(self):
+        log.flush()
         self.config.stop()
 
     # pylint: disable=no-self-use
@@ -65,10 +66,23 @@ class TestParse(TestCase):
             [g for g in custom_config.groups if g.name == 'customer-prod-reader'][0]
         test_pol = test_group.policies[0]
         assert test_pol.path == 'customer/prod/*'
-        assert test_pol.capabilities == [
-            parse.Capability.READ,
-            parse.Capability.LIST,
-        ]
+        assert test_pol.capabilities == \
+            parse.Capability.READ | parse.Capability.LIST
+
+    # pylint: disable=no-self-use
+    def test_json_config(self):
+        yaml_config = parse.parse_file('tests/examples/correct.yml')
+        json_config = parse.parse_file('tests/examples/correct.json')
+        assert [g.name for g in json_config.groups] == [g.name for g in yaml_config.groups]
+        assert [a.name for a in json_config.approles] == [a.name for a in yaml_config.approles]
+        assert json_config.groups[2].policies[0].capabilities == \
+            parse.Capability.READ | parse.Capability.LIST
+
+    # pylint: disable=no-self-use
+    def test_invalid_json(self):
+        with pytest.raises(ValueError) as err:
+            assert parse.load_content('broken.json', b'{"groups": [')
+        assert "Error parsing 'broken.json'" in str(err.value)
 
     # pylint: disable=no-self-use
     def test_illegal_approle_name(self):
@@ -0,0 +1,96 @@
+from unittest import TestCase, mock
+
+import pytest
+
+from benchmarks.fake_vault import FakeVault
+from self_service import log, metrics, ratelimit, transport
+
+class TestRateController(TestCase):
+
+    def setUp(self):
+        self.controller = ratelimit.RateController(8)
+
+    def tearDown(self):
+        log.flush()
+        ratelimit.reset()
+
+    def test_aimd(self):
+        tokens = [self.controller.acquire() for _ in range(4)]
+        # Requests in flight together only halve the limit once
+        for token in tokens:
+            self.controller.release(token, 429)
+        assert self.controller.limit == 4.0
+        token = self.controller.acquire()
+        self.controller.release(token, 503)
+        assert self.controller.limit == 2.0
+
+        for _ in range(3):
+            self.controller.release(self.controller.acquire(), 204)
+        assert 3.0 < self.controller.limit < 4.0
+        # Not found is a fine answer, errors are not
+        self.controller.release(self.controller.acquire(), 404)
+        limit = self.controller.limit
+        self.controller.release(self.controller.acquire(), 500)
+        assert self.controller.limit == limit
+
+    def test_limit(self):
+        self.controller.reset(2)
+        assert self.controller.try_acquire()[0] is not None
+        assert self.controller.try_acquire()[0] is not None
+        assert self.controller.try_acquire() == (None, None)
+        self.controller.pause(5)
+        token, wait = self.controller.try_acquire()
+        assert token is None and 4 < wait <= 5
+
+    def test_circuit_breaker(self):
+        with mock.patch("self_service.ratelimit.config.vault_error_threshold", 50):
+            for status in [204, 404] * 10 + [500] * 19:
+                self.controller.record(status)
+            self.controller.acquire()
+            self.controller.record("error")
+        with pytest.raises(ratelimit.CircuitOpenError):
+            self.controller.acquire()
+        self.controller.reset(8)
+        self.controller.acquire()
+
+    # pylint: disable=no-self-use
+    def test_retry_after(self):
+        assert ratelimit.parse_retry_after("2") == 2.0
+        assert ratelimit.parse_retry_after("3600") == ratelimit.MAX_RETRY_AFTER
+        assert ratelimit.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+        assert ratelimit.parse_retry_after("soon") is None
+        assert ratelimit.parse_retry_after(None) is None
+
+class TestRetries(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        ratelimit.controller.reset(4)
+
+    def tearDown(self):
+        log.flush()
+        ratelimit.reset()
+
+    # pylint: disable=no-self-use
+    def _put(self, vault, count):
+        session = transport.build_session(4)
+        return [
+            session.put(f"{vault.addr}/v1/sys/policy/p{i}", json={"policy": "{}"}).status_code
+            for i in range(count)
+        ]
+
+    def test_throttled_writes_are_retried(self):
+        with FakeVault(error_rate=0.3, error_status=429, retry_after=0) as vault, \
+                mock.patch("self_service.ratelimit.BACKOFF_BASE", 0.001):
+            assert self._put(vault, 20) == [204] * 20
+            assert len(vault.objects["policies"]) == 20
+            retries = vault.count("PUT") - 20
+        counts = metrics.summary()["counts"]
+        assert 0 < retries == counts["retries"]
+        assert counts["rate_limit_decreases"] > 0
+
+    def test_errors_open_the_circuit(self):
+        with FakeVault(error_rate=1.0, error_status=500) as vault:
+            with pytest.raises(ratelimit.CircuitOpenError):
+                self._put(vault, 50)
+            assert vault.count("PUT") == ratelimit.BREAKER_MIN_REQUESTS
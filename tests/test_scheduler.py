@@ -0,0 +1,45 @@
+from unittest import TestCase, mock
+#import pytest
+
+from self_service import scheduler
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        self.config = mock.patch("self_service.log.config",
+            quiet=True,
+            verbose=False,
+            log_level="",
+            log_format="text",
+            log_buffer_lines=512,
+        )
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+
+    # pylint: disable=no-self-use
+    def test_dependencies_run_first(self):
+        order = []
+        def task(key):
+            return lambda: order.append(key) or True
+        results = scheduler.run(
+            tasks={k: task(k) for k in ["group", "policy", "approle"]},
+            dependencies={"group": ["policy"], "approle": ["policy"]},
+            concurrency=4,
+        )
+        assert results == {"group": True, "policy": True, "approle": True}
+        assert order[0] == "policy"
+
+    # pylint: disable=no-self-use
+    def test_failed_dependency_skips_dependents(self):
+        def fail():
+            raise ValueError("permission denied")
+        group = mock.Mock(return_value=True)
+        results = scheduler.run(
+            tasks={"policy": fail, "group": group, "other": lambda: True},
+            dependencies={"group": ["policy"], "other": ["not-a-task"]},
+            concurrency=2,
+        )
+        assert results == {"policy": False, "group": False, "other": True}
+        group.assert_not_called()
@@ -1,8 +1,12 @@
 
+import io
+import os
+import tempfile
 from unittest import TestCase, mock
-#import pytest
+import pytest
+from hvac.exceptions import InvalidPath
 
-from self_service import self_service
+from self_service import auth, log, parse, self_service, translate
 
 class TestApply(TestCase):
 
@@ -19,6 +23,17 @@ class TestApply(TestCase):
                 vault_addr="mock_vault_addr",
                 vault_role_id="mock_vault_role_id",
                 vault_role_secret="mock_role_secret",
+                diff_apply=True,
+                plan_only=False,
+                apply_concurrency=4,
+                apply_backend="threads",
+            ),
+            mock.patch("self_service.auth.config",
+                vault_addr="mock_vault_addr",
+                vault_token="",
+                vault_role_id="mock_vault_role_id",
+                vault_role_secret="mock_role_secret",
+                vault_token_cache_file="",
             ),
             mock.patch("self_service.translate.config",
                 customer_prefix="customer",
@@ -29,11 +44,18 @@ class TestApply(TestCase):
         ]
         for ptch in self.config:
             ptch.start()
+        auth.reset()
         self.hvac_client = mock.Mock()
         self.hvac_client.is_authenticated.return_value = False
+        self.hvac_client.auth_approle.return_value = {"auth": {
+            "client_token": "mock_token", "lease_duration": 3600, "renewable": True,
+        }}
         self.hvac_client.auth.ldap.create_or_update_group.return_value = mock.Mock(status_code=204)
         self.hvac_client.write.return_value = mock.Mock(status_code=204)
         self.hvac_client.sys.create_or_update_policy.return_value = mock.Mock(status_code=204)
+        self.hvac_client.auth.ldap.read_group.side_effect = InvalidPath
+        self.hvac_client.read.return_value = None
+        self.hvac_client.sys.read_policy.side_effect = InvalidPath
         self.hvac_patch = mock.patch("self_service.hashivault.hvac")
         self.hvac = self.hvac_patch.start()
         self.hvac.Client.return_value = self.hvac_client
@@ -46,10 +68,8 @@ class TestApply(TestCase):
     # pylint: disable=no-self-use
     def test_full_stack(self):
         self_service.main()
-        self.hvac.Client.assert_has_calls(
-            [mock.call("mock_vault_addr")],
-            any_order=True,
-        )
+        self.hvac.Client.assert_called_once()
+        assert self.hvac.Client.call_args.args == ("mock_vault_addr",)
         self.hvac_client.auth_approle.assert_has_calls(
             [mock.call("mock_vault_role_id", "mock_role_secret")],
             any_order=True,
@@ -123,3 +143,190 @@ class TestApply(TestCase):
                     },
                 }}),
         ], any_order=True)
+
+
+class TestIncremental(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = [
+            mock.patch("self_service.config.customer_config_dir", "tests/examples/customer_dir"),
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.invalid_group_prefix", ""),
+            mock.patch("self_service.config.only_validate", False),
+            mock.patch("self_service.config.diff_apply", False),
+            mock.patch("self_service.config.quiet", True),
+            mock.patch("self_service.config.verbose", False),
+            mock.patch("self_service.config.flat_index_file",
+                os.path.join(self.tmp_dir.name, "index.pickle"),
+            ),
+            mock.patch("self_service.config.changed_files", None),
+        ]
+        for ptch in self.config:
+            ptch.start()
+        self.hvac_patch = mock.patch("self_service.hashivault.hvac")
+        self.hvac = self.hvac_patch.start()
+        self.client = self.hvac.Client.return_value
+        self.client.auth.ldap.create_or_update_group.return_value = mock.Mock(status_code=204)
+        self.client.write.return_value = mock.Mock(status_code=204)
+        self.client.sys.create_or_update_policy.return_value = mock.Mock(status_code=204)
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+        self.hvac_patch.stop()
+        self.tmp_dir.cleanup()
+
+    def _written_policies(self):
+        return {
+            c.kwargs["name"] for c in self.client.sys.create_or_update_policy.call_args_list
+        }
+
+    def test_only_affected_targets_are_applied(self):
+        assert self_service.main()
+        assert len(self._written_policies()) == 5
+        self.client.reset_mock()
+
+        with mock.patch("self_service.config.changed_files",
+            "configs/foo-app.yml\nREADME.md",
+        ):
+            assert self_service.main()
+        # customer-ops is shared with bar-app.yml, so it is re-merged from both files
+        assert self._written_policies() == {
+            "group-customer-customer-ops",
+            "group-customer-customer-foo-dev",
+            "approle-customer-foo-prod",
+        }
+        ops = [
+            c.kwargs["policy"] for c in self.client.sys.create_or_update_policy.call_args_list
+            if c.kwargs["name"] == "group-customer-customer-ops"
+        ][0]
+        assert "customer/data/bar/*" in ops["path"]
+        assert "customer/data/foo/*" in ops["path"]
+
+
+class TestParallelParse(TestCase):
+
+    def setUp(self):
+        self.config = [
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.invalid_group_prefix", "bad-group"),
+            mock.patch("self_service.config.parse_workers", 2),
+            mock.patch("self_service.config.quiet", True),
+            mock.patch("self_service.config.verbose", False),
+        ]
+        for ptch in self.config:
+            ptch.start()
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+
+    # pylint: disable=no-self-use
+    def test_errors_in_file_order(self):
+        files = [
+            "tests/examples/bad-group-name.yml",
+            "tests/examples/correct.yml",
+            "tests/examples/bad-capability.yml",
+            "tests/examples/bad-group-name-prefix.yml",
+        ]
+        with pytest.raises(ValueError) as err:
+            self_service.parse_customer_configs(files)
+        errors = str(err.value).split("\n-----------\n")
+        assert len(errors) == 3
+        assert "bad-group-name.yml" in errors[0]
+        assert "bad-capability.yml" in errors[1]
+        assert "bad-group-name-prefix.yml" in errors[2]
+
+    def test_worker_logs(self):
+        files = ["tests/examples/correct.yml", "tests/examples/correct.json"]
+        with mock.patch("self_service.config.quiet", False), \
+                mock.patch("sys.stdout", new_callable=io.StringIO) as output:
+            assert len(list(self_service.stream_customer_configs(files))) == 2
+            log.flush()
+        assert output.getvalue().splitlines() == ["correct.yml is valid.", "correct.json is valid."]
+
+    # pylint: disable=no-self-use
+    def test_plan_only_needs_apply_mode(self):
+        with mock.patch("self_service.config.customer_config_dir", "tests/examples/customer_dir"), \
+                mock.patch("self_service.config.only_validate", True), \
+                mock.patch("self_service.config.plan_only", True), \
+                mock.patch("self_service.self_service.log.warning") as warning:
+            assert self_service.main()
+        assert "ONLY_VALIDATE=False" in warning.call_args.args[0]
+
+    def test_configs_are_returned(self):
+        configs = self_service.parse_customer_configs([
+            "tests/examples/correct.yml",
+            "tests/examples/approle-accessors.yml",
+        ])
+        assert len(configs) == 2
+        assert configs[0].groups[0].name == "customer-prod-admin"
+
+
+class TestStreaming(TestCase):
+
+    def setUp(self):
+        # pylint: disable=consider-using-with
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = [
+            mock.patch("self_service.config.customer_config_dir", self.tmp_dir.name),
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.invalid_group_prefix", "bad-group"),
+            mock.patch("self_service.config.parse_workers", 1),
+            mock.patch("self_service.config.quiet", True),
+            mock.patch("self_service.config.verbose", False),
+        ]
+        for ptch in self.config:
+            ptch.start()
+        for name in ["b.yml", "a.json", "notes.txt", ".hidden.yml",
+                     "team/c.yaml", "team/deeper/d.yml", ".git/e.yml"]:
+            os.makedirs(os.path.dirname(os.path.join(self.tmp_dir.name, name)), exist_ok=True)
+            with open(os.path.join(self.tmp_dir.name, name), "w", encoding="utf-8") as handle:
+                handle.write("")
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+        self.tmp_dir.cleanup()
+
+    def _relative(self, files):
+        return [os.path.relpath(f, self.tmp_dir.name) for f in files]
+
+    def test_scan(self):
+        assert self._relative(self_service.get_customer_files()) == ["a.json", "b.yml"]
+        with mock.patch("self_service.config.customer_config_recursive", True):
+            assert self._relative(self_service.get_customer_files()) == [
+                "a.json", "b.yml", "team/c.yaml", "team/deeper/d.yml",
+            ]
+
+    # pylint: disable=no-self-use
+    def test_stream_is_lazy(self):
+        parsed = []
+        parse_file = parse.parse_file
+        files = iter([
+            "tests/examples/correct.yml",
+            "tests/examples/bad-capability.yml",
+            "tests/examples/approle-accessors.yml",
+        ])
+
+        def _parse(customer_file):
+            parsed.append(customer_file)
+            return parse_file(customer_file)
+
+        with mock.patch("self_service.parse.parse_file", side_effect=_parse):
+            stream = self_service.stream_customer_configs(files)
+            customer_file, _ = next(stream)
+            assert parsed == [customer_file]
+            customer_file, _ = next(stream)
+            assert customer_file.endswith("approle-accessors.yml")
+            with pytest.raises(ValueError) as err:
+                next(stream)
+        assert "bad-capability.yml" in str(err.value)
+
+    # pylint: disable=no-self-use
+    def test_flatten_customer_files(self):
+        files = ["tests/examples/correct.yml", "tests/examples/approle-accessors.yml"]
+        assert self_service.flatten_customer_files(files) == \
+            translate.flatten(self_service.parse_customer_configs(files))
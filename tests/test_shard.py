@@ -0,0 +1,29 @@
+from unittest import TestCase, mock
+
+from self_service import shard
+
+class TestShard(TestCase):
+
+    def setUp(self):
+        self.tenants = [f"tenant-{i}" for i in range(1000)]
+
+    # pylint: disable=no-self-use
+    def test_balanced(self):
+        shards = shard.assign(self.tenants, 4)
+        assert sorted(sum(shards.values(), [])) == sorted(self.tenants)
+        assert all(200 < len(owned) < 300 for owned in shards.values())
+
+    def test_stable_when_growing(self):
+        before = { t: shard.owner(t, 4) for t in self.tenants }
+        after = { t: shard.owner(t, 5) for t in self.tenants }
+        moved = [t for t in self.tenants if before[t] != after[t]]
+        # Only the tenants the new shard wins move, about a fifth of them
+        assert all(after[t] == 4 for t in moved)
+        assert 150 < len(moved) < 250
+
+    def test_owns(self):
+        with mock.patch("self_service.shard.config", shard_count=3, shard_index=1):
+            assert [t for t in self.tenants if shard.owns(t)] == shard.assign(self.tenants)[1]
+            report = shard.format_report(["a", "b", "c"])
+        assert report.count("Shard") == 3
+        assert "Shard 1 (" in report and "<- this replica" in report
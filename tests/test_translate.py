@@ -1,7 +1,8 @@
 from unittest import TestCase, mock
 #import pytest
 
-from self_service import translate, parse
+from self_service import log, parse, translate
+from self_service.parse import Capability
 
 class TestParse(TestCase):
 
@@ -16,6 +17,7 @@ class TestParse(TestCase):
         self.config2.start()
 
     def tearDown(self):
+        log.flush()
         self.config.stop()
         self.config2.stop()
 
@@ -52,19 +54,64 @@ class TestParse(TestCase):
         ret = translate.flatten([customer_config_1, customer_config_2])
         assert ret["groups"]["Group-1"] == "group-foo-Group-1"
         assert ret["policies"]["group-foo-Group-1"] == {
-            "foo/bar": {"read", "list", "create", "update"},
-            "auth/approle/role/foo-Approle-1/role-id": {"read"},
-            "auth/approle/role/foo-Approle-1/secret-id": {"create", "update"},
+            "foo/bar": Capability.CREATE | Capability.READ | Capability.UPDATE | Capability.LIST,
+            "auth/approle/role/foo-Approle-1/role-id": Capability.READ,
+            "auth/approle/role/foo-Approle-1/secret-id": Capability.CREATE | Capability.UPDATE,
         }
         assert ret["approles"]["foo-Approle-1"] == "approle-foo-Approle-1"
         assert ret["policies"]["approle-foo-Approle-1"] == {
-            "foo/bar": {"read", "list"}
+            "foo/bar": Capability.READ | Capability.LIST
         }
         assert ret["groups"]["Group-2"] == "group-foo-Group-2"
         assert ret["policies"]["group-foo-Group-2"] == {
-            "foo/baz": {"read", "list"}
+            "foo/baz": Capability.READ | Capability.LIST
         }
         assert ret["policies"]["group-foo-Group-3"] == {
-            "auth/approle/role/foo-Approle-1/role-id": {"read"},
-            "auth/approle/role/foo-Approle-1/secret-id": {"create", "update"},
+            "auth/approle/role/foo-Approle-1/role-id": Capability.READ,
+            "auth/approle/role/foo-Approle-1/secret-id": Capability.CREATE | Capability.UPDATE,
         }
+
+    # pylint: disable=no-self-use
+    def test_flat_index_matches_flatten(self):
+        def configs():
+            return {
+                "a.yml": parse.CustomerConfig(
+                    groups=[
+                        {"name": "Group-1", "policies": [
+                            {"path": "foo/bar", "capabilities": ['read', 'list']},
+                        ]},
+                    ],
+                    approles=[
+                        {"name": "foo-Approle-1", "policies": [
+                            {"path": "foo/bar", "capabilities": ['read']},
+                        ], "accessor_groups": ["Group-2"]},
+                    ],
+                ),
+                "b.yml": parse.CustomerConfig(
+                    groups=[
+                        {"name": "Group-1", "policies": [
+                            {"path": "foo/bar", "capabilities": ['update']},
+                            {"path": "foo/baz", "capabilities": ['deny']},
+                        ]},
+                        {"name": "Group-2", "policies": [
+                            {"path": "foo/qux", "capabilities": ['read']},
+                        ]},
+                    ],
+                ),
+            }
+
+        index = translate.FlatIndex()
+        for name, conf in configs().items():
+            index.update(name, conf)
+        assert index.flatten() == translate.flatten(list(configs().values()))
+
+        affected = index.remove("b.yml")
+        assert affected == {
+            ("groups", "Group-1"), ("groups", "Group-2"),
+            ("policies", "group-foo-Group-1"), ("policies", "group-foo-Group-2"),
+        }
+        partial = index.flatten(affected)
+        assert partial["policies"]["group-foo-Group-1"] == \
+            {"foo/bar": Capability.READ | Capability.LIST}
+        assert "approle-foo-Approle-1" not in partial["policies"]
+        assert index.flatten() == translate.flatten([configs()["a.yml"]])
@@ -0,0 +1,132 @@
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
+
+from self_service import log, transport
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+class TestTransport(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        transport.stats.reset()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # pylint: disable=no-self-use
+    def test_connections_are_reused(self):
+        session = transport.build_session(2)
+        url = f"http://127.0.0.1:{self.server.server_port}/v1/sys/health"
+        for _ in range(5):
+            assert session.get(url, timeout=transport.timeout()).status_code == 200
+        assert transport.stats.requests == 5
+        assert transport.stats.opened == 1
+        assert transport.stats.reused == 4
+
+def _state(local, replicated=0, cluster="c1"):
+    return base64.b64encode(f"v1:{cluster}:{local}:{replicated}:hmac".encode()).decode()
+
+def _local_index(state):
+    return int(base64.b64decode(state).decode().split(":")[2])
+
+def _node(name, index, seen):
+    """A vault node at state index, that answers 412 to reads requiring a newer one."""
+    class _Node(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, headers):
+            self.send_response(status)
+            for key, val in headers.items():
+                self.send_header(key, val)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        # pylint: disable=invalid-name
+        def do_GET(self):
+            seen.append((name, "GET", self.headers.get("X-Vault-Index")))
+            required = self.headers.get("X-Vault-Index")
+            if required and _local_index(required) > index[0]:
+                return self._reply(412, {})
+            return self._reply(200, {})
+
+        # pylint: disable=invalid-name
+        def do_PUT(self):
+            seen.append((name, "PUT", self.headers.get("X-Vault-Index")))
+            index[0] += 1
+            return self._reply(204, {"X-Vault-Index": _state(index[0])})
+
+        def log_message(self, *args):
+            pass
+    return _Node
+
+class TestReadRouting(TestCase):
+
+    def setUp(self):
+        self.seen = []
+        self.active_index = [10]
+        self.standby_index = [10]
+        self.servers = [
+            ThreadingHTTPServer(("127.0.0.1", 0), _node("active", self.active_index, self.seen)),
+            ThreadingHTTPServer(("127.0.0.1", 0), _node("standby", self.standby_index, self.seen)),
+        ]
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.active, self.standby = [
+            f"http://127.0.0.1:{s.server_port}" for s in self.servers
+        ]
+        self.config = mock.patch("self_service.transport.config.vault_read_addr", self.standby)
+        self.config.start()
+        transport.consistency.reset()
+
+    def tearDown(self):
+        log.flush()
+        self.config.stop()
+        transport.consistency.reset()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_reads_go_to_standby_until_it_is_stale(self):
+        session = transport.build_session(2)
+        assert session.get(self.active + "/v1/sys/policy/a").status_code == 200
+        assert session.put(self.active + "/v1/sys/policy/a").status_code == 204
+        assert session.get(self.active + "/v1/sys/policy/a").status_code == 200
+        self.standby_index[0] = 11
+        assert session.get(self.active + "/v1/sys/policy/a").status_code == 200
+        assert self.seen == [
+            ("standby", "GET", None),
+            ("active", "PUT", None),
+            # The standby has not seen the write yet
+            ("standby", "GET", _state(11)),
+            ("active", "GET", None),
+            ("standby", "GET", _state(11)),
+        ]
+
+    # pylint: disable=no-self-use
+    def test_newest_state_is_kept(self):
+        transport.consistency.record(_state(5, 2))
+        transport.consistency.record(_state(7, 1))
+        assert transport.consistency.state == _state(5, 2)
+        transport.consistency.record(_state(6, 2))
+        assert transport.consistency.state == _state(6, 2)
+        transport.consistency.record(_state(1, 1, cluster="c2"))
+        assert transport.consistency.state == _state(1, 1, cluster="c2")
+        transport.consistency.record("not base64")
+        assert transport.consistency.state == "not base64"
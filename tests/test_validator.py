@@ -0,0 +1,132 @@
+import http.client
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+
+import pytest
+
+from self_service import config, parse, validator
+from self_service.self_service import parse_customer_configs
+
+EXAMPLES = [
+    "tests/examples/correct.yml",
+    "tests/examples/correct.json",
+    "tests/examples/bad-capability.yml",
+    "tests/examples/bad-group-name-prefix.yml",
+    "tests/examples/never-allowed-path.yml",
+]
+
+def _read(path):
+    with open(path, encoding="utf-8") as handle:
+        return handle.read()
+
+class TestValidate(TestCase):
+
+    def setUp(self):
+        self.config = [
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.invalid_group_prefix", ""),
+            mock.patch("self_service.config.parse_cache_dir", ""),
+            mock.patch("self_service.config.parse_workers", 1),
+            mock.patch("self_service.config.quiet", True),
+        ]
+        for ptch in self.config:
+            ptch.start()
+        validator.reset()
+
+    def tearDown(self):
+        for ptch in self.config:
+            ptch.stop()
+
+    # pylint: disable=no-self-use
+    def test_same_errors_as_parse(self):
+        with pytest.raises(ValueError) as err:
+            parse_customer_configs(EXAMPLES)
+        result = validator.validate("customer", { path: _read(path) for path in EXAMPLES })
+        assert not result["valid"]
+        assert result["error"] == str(err.value)
+        assert [name for name, file in result["files"].items() if file["valid"]] == [
+            EXAMPLES[0], EXAMPLES[1], EXAMPLES[3],
+        ]
+
+    def test_tenant_settings(self):
+        files = { "correct.yml": _read("tests/examples/correct.yml") }
+        assert validator.validate("customer", files)["valid"]
+        result = validator.validate("other", files)
+        assert not result["valid"] and "other" in result["files"]["correct.yml"]["error"]
+        # The global config is left as it was
+        assert config.customer_prefix == "customer"
+
+    def test_results_are_reused(self):
+        files = { "correct.yml": _read("tests/examples/correct.yml"), "bad.yml": "groups: [" }
+        first = validator.validate("customer", files)
+        with mock.patch("self_service.validator.parse.load_content") as load:
+            assert validator.validate("customer", files) == first
+        load.assert_not_called()
+        assert validator.validate("customer", { "renamed.yml": files["bad.yml"] })["error"] \
+            != first["error"]
+
+class TestServer(TestCase):
+
+    def setUp(self):
+        self.config = [
+            mock.patch("self_service.config.validate_host", "127.0.0.1"),
+            mock.patch("self_service.config.validate_port", 0),
+            mock.patch("self_service.config.validate_socket", ""),
+            mock.patch("self_service.config.customer_prefix", "customer"),
+            mock.patch("self_service.config.invalid_group_prefix", ""),
+            mock.patch("self_service.config.parse_cache_dir", ""),
+            mock.patch("self_service.config.quiet", True),
+        ]
+        for ptch in self.config:
+            ptch.start()
+        validator.reset()
+        self.server = validator.make_server()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for ptch in self.config:
+            ptch.stop()
+
+    def _post(self, body, path="/validate"):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=10)
+        try:
+            conn.request("POST", path, body=body, headers={ "Content-Type": "application/json" })
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_concurrent_tenants(self):
+        content = _read("tests/examples/correct.yml")
+        def check(prefix):
+            return self._post(json.dumps({
+                "customer_prefix": prefix,
+                "files": { "correct.yml": content.replace("customer", prefix) },
+            }))
+        prefixes = ["customer", "foo", "bar", "baz"] * 10
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(check, prefixes))
+        assert results == [(200, mock.ANY)] * len(prefixes)
+        assert all(result["valid"] for _, result in results), results
+
+    def test_bad_requests(self):
+        assert self._post("{")[0] == 400
+        status, result = self._post(json.dumps({ "files": { "a.yml": "" } }))
+        assert status == 400 and result["error"] == "customer_prefix is required"
+        assert self._post(json.dumps({ "customer_prefix": "customer", "files": [] }))[0] == 400
+        assert self._post("{}", path="/other")[0] == 404
+
+    def test_invalid_file(self):
+        status, result = self._post(json.dumps({
+            "customer_prefix": "customer",
+            "files": { "bad.yml": _read("tests/examples/bad-capability.yml") },
+        }))
+        with pytest.raises(ValueError) as err:
+            parse.validate("bad.yml", parse.load_content("bad.yml",
+                _read("tests/examples/bad-capability.yml")))
+        assert status == 200 and not result["valid"]
+        assert result["files"]["bad.yml"]["error"] == str(err.value)
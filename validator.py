@@ -0,0 +1,4 @@
+from self_service import validator
+
+if __name__ == "__main__":
+    validator.main()